@@ -0,0 +1,670 @@
+"""A compact, array-backed Markov model for large corpora.
+
+  Dict-based models key on tuples of strings and keep a Transitions object
+  per prefix, which costs a few hundred bytes of Python objects per state. An
+  ArrayModel interns every token to an integer id and stores the whole table
+  in flat arrays, CSR style:
+
+    vocab       -- token for each id.
+    prefixes    -- the order token ids of each row, back to back.
+    offsets     -- row i owns edges offsets[i] up to offsets[i+1].
+    successors  -- the token id each edge leads to.
+    cumulative  -- running count of the edges within their row, so the last
+                   one is the row total and sampling is a bisection.
+    next_rows   -- the row each edge leads to, or -1 where the chain ends.
+    head_rows   -- the row of each head.
+    tail_ids    -- the order token ids of each tail, sorted.
+
+  Every array holds 4-byte integers, so a model costs 4 * order bytes per
+  state and 12 per edge. Rows are sorted by their prefix ids, and a prefix is
+  found by binary search over them: nothing is kept per state but its place
+  in the arrays. Walking a chain needs no lookups at all, as each edge knows
+  the row it leads to; walk() does that for every model laid out this way.
+
+  An ArrayModel is a drop-in for the dict models: `prefix in model`,
+  `model[prefix].sample()`, `model[prefix].total`, `model.heads` and
+  `model.tails` all behave like they do on a dict of Transitions.
+
+  With NumPy installed, generate_batch and sample_sentences advance many
+  chains in lockstep, drawing the next token for every lane at once.
+
+"""
+
+import random
+from array import array
+from bisect import bisect_right
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# While building, token ids are packed into one integer per prefix, ID_BITS
+# bits apiece.
+ID_BITS = 32
+ID_MASK = (1 << ID_BITS) - 1
+
+
+def pack(ids):
+  """Pack a sequence of token ids into a single integer key."""
+  key = 0
+  for i in ids:
+    key = (key << ID_BITS) | i
+  return key
+
+def unpack(key, length):
+  """Inverse of pack for a key of length ids."""
+  ids = [0] * length
+  for i in range(length - 1, -1, -1):
+    ids[i] = key & ID_MASK
+    key >>= ID_BITS
+  return ids
+
+
+def search(table, width, ids):
+  """Find the entry equal to the list ids in a sorted table of width ids each.
+
+  Returns its index, or -1.
+  """
+  lo = 0
+  hi = len(table) // width
+  while lo < hi:
+    mid = (lo + hi) // 2
+    if table[mid * width:(mid + 1) * width].tolist() < ids:
+      lo = mid + 1
+    else:
+      hi = mid
+  if lo < len(table) // width and table[lo * width:(lo + 1) * width].tolist() == ids:
+    return lo
+  return -1
+
+def walk(model, row, tokens):
+  """Yield the tokens of one chain, from row on until it runs out.
+
+  Keyword arguments:
+  model -- Anything laid out like an ArrayModel: offsets, successors,
+           cumulative and next_rows.
+  row -- The row to start from, e.g. a head's.
+  tokens -- Maps successor ids to the tokens to yield.
+
+  """
+  offsets = model.offsets
+  successors = model.successors
+  cumulative = model.cumulative
+  next_rows = model.next_rows
+
+  while row >= 0:
+    lo = offsets[row]
+    hi = offsets[row + 1]
+    if hi - lo == 1:
+      edge = lo
+    else:
+      edge = bisect_right(cumulative, int(random.random() * cumulative[hi - 1]),
+          lo, hi)
+    yield tokens[successors[edge]]
+    row = next_rows[edge]
+
+
+class Row(object):
+  """The successors of one prefix, with the same interface as Transitions."""
+
+  __slots__ = ('model', 'row')
+
+  def __init__(self, model, row):
+    self.model = model
+    self.row = row
+
+  @property
+  def total(self):
+    return self.model.cumulative[self.model.offsets[self.row + 1] - 1]
+
+  def sample(self):
+    """Pick a suffix at random, weighted by how often it was seen."""
+    model = self.model
+    lo = model.offsets[self.row]
+    hi = model.offsets[self.row + 1]
+    if hi - lo == 1:
+      return model.vocab[model.successors[lo]]
+
+    r = int(random.random() * model.cumulative[hi - 1])
+    return model.vocab[model.successors[bisect_right(model.cumulative, r, lo, hi)]]
+
+  def items(self):
+    model = self.model
+    previous = 0
+    for edge in range(model.offsets[self.row], model.offsets[self.row + 1]):
+      yield model.vocab[model.successors[edge]], model.cumulative[edge] - previous
+      previous = model.cumulative[edge]
+
+  def __len__(self):
+    return self.model.offsets[self.row + 1] - self.model.offsets[self.row]
+
+  def __iter__(self):
+    for suffix, count in self.items():
+      yield suffix
+
+  def __contains__(self, suffix):
+    for candidate in self:
+      if candidate == suffix:
+        return True
+    return False
+
+  def __repr__(self):
+    return 'Row(%r)' % (dict(self.items()),)
+
+
+class HeadView(object):
+  """The heads of a model as a sequence of prefix tuples."""
+
+  def __init__(self, model):
+    self.model = model
+
+  def __len__(self):
+    return len(self.model.head_rows)
+
+  def __getitem__(self, i):
+    return self.model.prefix(self.model.head_rows[i])
+
+
+class TailView(object):
+  """The tails of a model as a set-like of token tuples."""
+
+  def __init__(self, model):
+    self.model = model
+
+  def __len__(self):
+    return len(self.model.tail_ids) // self.model.order
+
+  def __contains__(self, tokens):
+    ids = self.model.key(tokens)
+    return ids is not None and search(self.model.tail_ids, self.model.order,
+        ids) >= 0
+
+  def __iter__(self):
+    model = self.model
+    for i in range(len(self)):
+      start = i * model.order
+      yield tuple(model.vocab[j] for j in model.tail_ids[start:start + model.order])
+
+
+class ArrayModel(object):
+
+  def __init__(self, order):
+    self.order = order
+    self.vocab = []
+    self.ids = {}
+    self.prefixes = array('I')
+    self.offsets = array('I', [0])
+    self.successors = array('I')
+    self.cumulative = array('I')
+    self.next_rows = array('i')
+    self.head_rows = array('I')
+    self.tail_ids = array('I')
+
+  @classmethod
+  def build(cls, sequences, order, vocab=None):
+    """Build a model straight from tokenized text.
+
+    Heads are the first order tokens of each sequence and tails are the last
+    order tokens, following markov() and MarkovTable.chainify. Sequences
+    shorter than order+1 are skipped.
+
+    Keyword arguments:
+    sequences -- An iterable of sequences of characters or words.
+    order -- The order of the Markov model.
+    vocab -- If specified, the sequences are already ids into this list of
+             tokens, e.g. a TokenStream's, and are used as they are.
+
+    """
+    model = cls(order)
+    if vocab is not None:
+      model.vocab = list(vocab)
+      model.ids = dict((token, i) for i, token in enumerate(model.vocab))
+    edges = {}
+    heads = {}
+    tails = set()
+    width = (1 << (ID_BITS * (order + 1))) - 1
+
+    for sequence in sequences:
+      if len(sequence) < order + 1:
+        continue
+
+      if vocab is None:
+        ids = [model._intern(token) for token in sequence]
+      else:
+        ids = sequence
+      heads[pack(ids[:order])] = None
+      tails.add(pack(ids[-order:]))
+
+      # Slide a packed (order+1)-gram along the sequence.
+      key = pack(ids[:order])
+      for i in ids[order:]:
+        key = ((key << ID_BITS) | i) & width
+        edges[key] = edges.get(key, 0) + 1
+
+    model._freeze(edges, heads, tails)
+    return model
+
+  @classmethod
+  def from_chains(cls, chains, order, heads, tails=()):
+    """Convert a dict of Transitions, as built by markov() or MarkovTable.
+
+    Keyword arguments:
+    chains -- A dict mapping prefix tuples to Transitions.
+    order -- The order of the Markov model.
+    heads -- The heads to start chains from.
+    tails -- If specified, tuples where a sentence may end.
+
+    """
+    model = cls(order)
+    edges = {}
+    for prefix, transitions in chains.items():
+      key = pack([model._intern(token) for token in prefix])
+      for suffix, count in transitions.items():
+        edges[(key << ID_BITS) | model._intern(suffix)] = count
+
+    model._freeze(edges,
+        dict.fromkeys(pack([model._intern(token) for token in head])
+            for head in heads),
+        set(pack([model._intern(token) for token in tail]) for tail in tails))
+    return model
+
+  @property
+  def heads(self):
+    return HeadView(self)
+
+  @property
+  def tails(self):
+    return TailView(self)
+
+  def key(self, tokens):
+    """Return the list of ids of a tuple of tokens, or None if one is unseen."""
+    ids = []
+    for token in tokens:
+      i = self.ids.get(token)
+      if i is None:
+        return None
+      ids.append(i)
+    return ids
+
+  def prefix(self, row):
+    """Return the prefix tuple for a row."""
+    start = row * self.order
+    return tuple(self.vocab[i] for i in self.prefixes[start:start + self.order])
+
+  def get(self, prefix, default=None):
+    if len(prefix) != self.order:
+      return default
+    ids = self.key(prefix)
+    if ids is None:
+      return default
+    row = search(self.prefixes, self.order, ids)
+    if row < 0:
+      return default
+    return Row(self, row)
+
+  def iter_text(self, split_words=False):
+    """Yield the tokens of an endless text, as TweetList.iter_tokens does.
+
+    Each chain starts at a random head and runs until it reaches a prefix
+    with no successors. Over letters, a space marks the start of the next.
+    """
+    while True:
+      row = self.head_rows[int(random.random() * len(self.head_rows))]
+      for token in self.prefix(row):
+        yield token
+      for token in walk(self, row, self.vocab):
+        yield token
+
+      # Mark the end of a sentence.
+      if split_words:
+        yield ' '
+
+  def items(self):
+    for row in range(len(self)):
+      yield self.prefix(row), Row(self, row)
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __iter__(self):
+    for row in range(len(self)):
+      yield self.prefix(row)
+
+  def __contains__(self, prefix):
+    return self.get(prefix) is not None
+
+  def __getitem__(self, prefix):
+    row = self.get(prefix)
+    if row is None:
+      raise KeyError(prefix)
+    return row
+
+  def generate_batch(self, n, length, split_words, seed=None):
+    """Generate n texts at once, like TweetList.generate_text does one.
+
+    Every lane starts from a random head and takes one step per iteration. A
+    lane that runs off the end of a chain restarts from a fresh head, and
+    drops out once it has length characters.
+
+    Keyword arguments:
+    n -- How many texts to generate.
+    length -- The minimum length of each text, in characters.
+    split_words -- If true, the model is over letters rather than words.
+    seed -- If specified, seeds the random generator.
+
+    """
+    tables = self._tables()
+    rng = numpy.random.default_rng(seed)
+
+    heads = rng.integers(len(tables['heads']), size=n)
+    lanes = numpy.arange(n)
+    rows = tables['heads'][heads]
+    lengths = tables['head_lengths'][heads]
+
+    # Only the lanes still running are kept, packed. Each step records them,
+    # and per lane the edge taken (>= 0) or the head restarted from (-1 - head).
+    steps = []
+    codes = []
+    while True:
+      running = lengths < length
+      if not running.all():
+        lanes = lanes[running]
+        rows = rows[running]
+        lengths = lengths[running]
+      if not len(lanes):
+        break
+
+      dead = rows < 0
+      if dead.any():
+        code = numpy.empty(len(lanes), dtype=numpy.int64)
+        restart = rng.integers(len(tables['heads']), size=int(dead.sum()))
+        code[dead] = -1 - restart
+        rows[dead] = tables['heads'][restart]
+        lengths[dead] += tables['head_lengths'][restart]
+
+        live = ~dead
+        edges = self._draw(tables, rows[live], rng)
+        code[live] = edges
+        rows[live] = tables['next_rows'][edges]
+        lengths[live] += tables['edge_lengths'][edges]
+      else:
+        code = self._draw(tables, rows, rng)
+        rows = tables['next_rows'][code]
+        lengths += tables['edge_lengths'][code]
+
+      steps.append(lanes)
+      codes.append(code)
+
+    if split_words:
+      separator = ''
+    else:
+      separator = ' '
+
+    # Heads come up again and again; join each one's tokens once.
+    joined = {}
+    def head_text(head):
+      text = joined.get(head)
+      if text is None:
+        text = joined[head] = separator.join(self.heads[head])
+      return text
+
+    # Line the steps up lane by lane, and turn every one into a piece of text
+    # at once: a token, or the head a lane restarted from.
+    pieces = numpy.empty(0, dtype=object)
+    bounds = [0] * (n + 1)
+    if steps:
+      steps = numpy.concatenate(steps)
+      codes = numpy.concatenate(codes)
+      ordered = numpy.argsort(steps, kind='stable')
+      codes = codes[ordered]
+      bounds = numpy.searchsorted(steps[ordered], numpy.arange(n + 1)).tolist()
+      pieces = tables['vocab'][tables['successors'][numpy.maximum(codes, 0)]]
+      restarts = numpy.flatnonzero(codes < 0)
+      for i, code in zip(restarts.tolist(), codes[restarts].tolist()):
+        # Mark the end of a sentence.
+        if split_words:
+          pieces[i] = ' ' + head_text(-1 - code)
+        else:
+          pieces[i] = head_text(-1 - code)
+
+    texts = []
+    for lane, head in enumerate(heads.tolist()):
+      text = [head_text(head)]
+      text.extend(pieces[bounds[lane]:bounds[lane + 1]].tolist())
+      texts.append(separator.join(text).encode('utf-8'))
+    return texts
+
+  def sample_sentences(self, n, min_length=10, seed=None, max_length=None,
+      starts=None):
+    """Walk n sentences at once, the way MarkovTable.genSeed walks one.
+
+    A sentence starts at a random head and runs until it reaches a dead end,
+    reaches a tail after at least min_length tokens, or repeats one token
+    three times in a row. Returns the sentences as token lists, along with
+    the number of branches each one passed, as genSeed counts them.
+
+    Keyword arguments:
+    n -- How many sentences to walk.
+    min_length -- How many tokens a sentence needs before a tail can end it.
+    seed -- If specified, seeds the random generator.
+    max_length -- If specified, sentences end at this many tokens, wherever
+                  they are.
+    starts -- If specified, the indices into heads to start from, e.g. the
+              heads that can meet a randomness threshold. Any head by default.
+
+    """
+    tables = self._tables()
+    rng = numpy.random.default_rng(seed)
+    done = numpy.iinfo(numpy.int64).min
+
+    if starts is None:
+      heads = rng.integers(len(tables['heads']), size=n)
+    else:
+      heads = numpy.asarray(starts, dtype=numpy.int64)[
+          rng.integers(len(starts), size=n)]
+    first = self._draw(tables, tables['heads'][heads], rng)
+    rows = tables['next_rows'][first]
+    last = tables['successors'][first]
+    before = tables['head_last'][heads]
+    sizes = numpy.full(n, self.order + 1, dtype=numpy.int64)
+    branches = numpy.zeros(n, dtype=numpy.int64)
+    active = numpy.flatnonzero(rows >= 0)
+
+    steps = []
+    while len(active):
+      codes = numpy.full(n, done, dtype=numpy.int64)
+      current = rows[active]
+      branches[active] += tables['totals'][current] - 1
+
+      edges = self._draw(tables, current, rng)
+      codes[active] = edges
+      successors = tables['successors'][edges]
+      rows[active] = tables['next_rows'][edges]
+      sizes[active] += 1
+
+      # Stop at dead ends, at tails once we're long enough, and when the same
+      # token comes up three times running.
+      stop = rows[active] < 0
+      stop |= (sizes[active] >= min_length) & tables['tail_rows'][
+          numpy.maximum(rows[active], 0)]
+      stop |= (successors == last[active]) & (last[active] == before[active])
+      if max_length is not None:
+        stop |= sizes[active] >= max_length
+      before[active] = last[active]
+      last[active] = successors
+
+      steps.append(codes)
+      active = active[~stop]
+
+    sentences = []
+    for lane in range(n):
+      text = list(self.heads[int(heads[lane])])
+      text.append(self.vocab[self.successors[int(first[lane])]])
+      for codes in steps:
+        code = int(codes[lane])
+        if code == done:
+          break
+        text.append(self.vocab[self.successors[code]])
+      sentences.append(text)
+    return sentences, branches
+
+  def _draw(self, tables, rows, rng):
+    """Pick one weighted edge out of each of rows."""
+    # Rows with a single edge need no draw, and most rows have one at high
+    # orders.
+    edges = tables['firsts'][rows]
+    several = numpy.flatnonzero(tables['widths'][rows] > 1)
+    if len(several):
+      rows = rows[several]
+      # The draws are non-negative, so truncating them floors them.
+      targets = tables['bases'][rows] + (rng.random(len(rows)) *
+          tables['totals'][rows]).astype(numpy.int64)
+      # Sorted targets make searchsorted walk cumulative in order.
+      ordered = numpy.argsort(targets)
+      edges[several[ordered]] = numpy.searchsorted(tables['cumulative'],
+          targets[ordered], side='right')
+    return edges
+
+  def _tables(self):
+    """Build, once, the NumPy arrays that lockstep generation runs on."""
+    if numpy is None:
+      raise ImportError('Batch generation needs NumPy.')
+
+    tables = self.__dict__.get('_vectors')
+    if tables is not None:
+      return tables
+
+    offsets = numpy.array(self.offsets, dtype=numpy.int64)
+    within = numpy.array(self.cumulative, dtype=numpy.int64)
+    successors = numpy.array(self.successors, dtype=numpy.int64)
+
+    # Turn the per-row running counts into one running count over all edges,
+    # so a single searchsorted can serve every lane.
+    counts = within.copy()
+    rest = numpy.ones(len(counts), dtype=bool)
+    rest[offsets[:-1]] = False
+    rest = numpy.flatnonzero(rest)
+    counts[rest] -= within[rest - 1]
+    cumulative = numpy.cumsum(counts)
+    totals = within[offsets[1:] - 1]
+    bases = cumulative[offsets[1:] - 1] - totals
+
+    next_rows = numpy.array(self.next_rows, dtype=numpy.int64)
+    token_lengths = numpy.array([len(token) for token in self.vocab],
+        dtype=numpy.int64)
+    heads = numpy.array(self.head_rows, dtype=numpy.int64)
+    prefixes = numpy.array(self.prefixes, dtype=numpy.int64).reshape(-1,
+        self.order)
+
+    # Rows and tails are both sorted, so one pass over each finds the rows
+    # that are tails.
+    tail_rows = numpy.zeros(len(self), dtype=bool)
+    tails = list(zip(*[iter(self.tail_ids)] * self.order))
+    t = 0
+    for row, prefix in enumerate(zip(*[iter(self.prefixes)] * self.order)):
+      while t < len(tails) and tails[t] < prefix:
+        t += 1
+      if t < len(tails) and tails[t] == prefix:
+        tail_rows[row] = True
+
+    tables = {
+      'cumulative': cumulative,
+      'totals': totals,
+      'bases': bases,
+      'firsts': offsets[:-1],
+      'widths': numpy.diff(offsets),
+      'successors': successors,
+      'next_rows': next_rows,
+      'vocab': numpy.array(self.vocab, dtype=object),
+      'token_lengths': token_lengths,
+      'edge_lengths': token_lengths[successors],
+      'heads': heads,
+      'head_lengths': token_lengths[prefixes[heads]].sum(axis=1),
+      'head_last': prefixes[heads, -1],
+      'tail_rows': tail_rows,
+    }
+    self._vectors = tables
+    return tables
+
+  # The NumPy tables are derived data; rebuild them after loading.
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state.pop('_vectors', None)
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    if 'index' in state:
+      self._upgrade()
+
+  def _upgrade(self):
+    """Models pickled by older versions found rows through a dict of packed
+    prefixes, and kept 8-byte arrays. Lay them out like new ones."""
+    index = self.__dict__.pop('index')
+    tails = self.__dict__.pop('tail_keys')
+    for name in ('prefixes', 'offsets', 'successors', 'cumulative',
+        'head_rows'):
+      setattr(self, name, array('I', getattr(self, name)))
+    self.next_rows = self._link(index)
+    self.tail_ids = array('I')
+    for tail in sorted(tails):
+      self.tail_ids.extend(unpack(tail, self.order))
+
+  def _intern(self, token):
+    i = self.ids.get(token)
+    if i is None:
+      i = self.ids[token] = len(self.vocab)
+      self.vocab.append(token)
+    return i
+
+  def _freeze(self, edges, heads, tails):
+    """Lay the packed edge counts out as sorted CSR rows, and link them up.
+
+    Keyword arguments:
+    edges -- A dict mapping packed (prefix + suffix) keys to counts.
+    heads -- Packed head prefixes, in the order they were first seen.
+    tails -- Packed tails.
+
+    """
+    # Packed prefix -> row. Only needed until the rows are linked.
+    rows = {}
+    last = None
+    running = 0
+    for key in sorted(edges):
+      prefix = key >> ID_BITS
+      if prefix != last:
+        if last is not None:
+          self.offsets.append(len(self.successors))
+        rows[prefix] = len(rows)
+        self.prefixes.extend(unpack(prefix, self.order))
+        last = prefix
+        running = 0
+
+      running += edges[key]
+      self.successors.append(key & ID_MASK)
+      self.cumulative.append(running)
+
+    if last is not None:
+      self.offsets.append(len(self.successors))
+
+    self.next_rows = self._link(rows)
+    for head in heads:
+      if head in rows:
+        self.head_rows.append(rows[head])
+
+    # Packed keys sort the same way as their ids do.
+    for tail in sorted(tails):
+      self.tail_ids.extend(unpack(tail, self.order))
+
+  def _link(self, rows):
+    """Return next_rows, given a dict mapping packed prefixes to rows in row
+    order. Each edge leads to the prefix that drops its row's first id and
+    appends its own."""
+    width = (1 << (ID_BITS * self.order)) - 1
+    next_rows = array('i')
+    for prefix, row in rows.items():
+      for edge in range(self.offsets[row], self.offsets[row + 1]):
+        following = ((prefix << ID_BITS) | self.successors[edge]) & width
+        next_rows.append(rows.get(following, -1))
+    return next_rows
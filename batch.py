@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+"""Generates text for many cached accounts in one invocation.
+
+  Usage: batch.py [options] FILE
+
+  FILE lists one username per line, optionally followed by how many texts to
+  generate for them. The work is split into chunks of at most --chunk texts,
+  spread across a pool of worker processes, and every text is written out as
+  a line of JSON as soon as its chunk is done:
+
+    {"user": "someone", "text": "..."}
+
+  Lines come out in the order chunks finish, not the order of FILE, and the
+  chunks of one busy account may run on several workers at once. Accounts
+  that can't be generated for get a single {"user", "error"} line.
+  Only accounts already in the cache are used; fetch new ones with the
+  regular scripts (twittov2.py --warm can fetch a whole list at once).
+
+  With --models DIR, workers generate from mapped models (see mappedmodel.py)
+  kept in DIR instead of unpickling the cache, so all of them share one copy
+  of each model in memory. A model missing from DIR is exported there from
+  the cache the first time it is needed. The files are snapshots: delete them
+  after updating the cache to have them exported again.
+
+  Workers keep every account they load in memory. With --memory-budget, each
+  keeps only the most recently used accounts, up to that many bytes.
+
+"""
+
+import os, io, sys, json, sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from optparse import OptionParser
+from cachestore import CacheStore
+from cachemanager import CacheManager, parse_size
+from mappedmodel import MappedModel
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# Each worker process opens the cache once and keeps what it has loaded, or,
+# given a memory budget, what the CacheManager keeps.
+_store = None
+_loaded = {}
+_models = None
+
+def _start_worker(cache, engine, models=None, memory_budget=None):
+  global _store, _models
+  _store = CacheManager(CacheStore(cache, engine), memory_budget=memory_budget)
+  _models = models
+
+def _load(username):
+  if _store.memory_budget is not None:
+    return _store[username]
+  if username not in _loaded:
+    _loaded[username] = _store[username]
+  return _loaded[username]
+
+def mapped_path(directory, username, settings):
+  """Return where the mapped model for username and settings lives."""
+  if settings['engine'] == 'twittov':
+    name = '%s.%d%s' % (username, settings['order'],
+        'x' if settings['split_words'] else 'w')
+  else:
+    name = username
+  return os.path.join(directory, '%s.%s.twm' % (name, settings['engine']))
+
+def _load_mapped(username, settings):
+  """Map username's model from _models, exporting it from the cache first if
+  it isn't there yet. The cached entry itself isn't kept."""
+  path = mapped_path(_models, username, settings)
+  if path not in _loaded:
+    if not os.path.exists(path):
+      model = _store.store[username]
+      if settings['engine'] == 'twittov':
+        model.export(path, settings['order'], settings['split_words'])
+      else:
+        model.export(path)
+
+    if settings['engine'] == 'twittov':
+      _loaded[path] = MappedModel(path)
+    else:
+      # Only imported here, as unpickling the cache would import it anyway.
+      from twittov2 import MarkovTable
+      _loaded[path] = MarkovTable.mapped(path, username)
+  return _loaded[path]
+
+def generate(username, count, settings):
+  """Generate count texts for username, in a worker process.
+
+  Returns a list of texts, or raises KeyError if the user isn't cached.
+
+  Keyword arguments:
+  username -- The string username of the twitter user.
+  count -- How many texts to generate.
+  settings -- A dict of engine, order, length, max_length, split_words,
+              backend and randomness, as on the twittov.py and twittov2.py
+              command lines.
+
+  """
+  texts = []
+
+  # Bounded texts need the tweets themselves, so those come from the cache.
+  if _models is not None and (settings['engine'] == 'twittov2'
+      or settings['max_length'] is None):
+    model = _load_mapped(username, settings)
+    for i in range(count):
+      if settings['engine'] == 'twittov':
+        from twittov import write_tokens
+        text = io.StringIO()
+        write_tokens(text, model.iter_text(), settings['length'],
+            settings['split_words'])
+        texts.append(text.getvalue())
+      else:
+        texts.append(model.markov(settings['length'], settings['randomness']))
+    return texts
+
+  model = _load(username)
+  if settings['engine'] == 'twittov':
+    order = settings['order']
+    split_words = settings['split_words']
+    backend = settings['backend']
+
+    # Store freshly compiled models, so the next batch can skip the build.
+    # Cache writes only ever append, so workers can't clobber each other.
+    if not model.is_compiled(order, split_words, backend):
+      model.compile(order, split_words, backend)
+      try:
+        _store[username] = model
+      except sqlite3.Error:
+        pass
+
+    # Batches can't be bounded, so bounded texts are generated one by one.
+    if (backend == 'array' and numpy is not None and count > 1
+        and settings['max_length'] is None):
+      texts = model.generate_batch(count, order, settings['length'], split_words)
+    else:
+      texts = [model.generate_text(order, settings['length'], split_words, backend,
+          settings['max_length']) for i in range(count)]
+    texts = [text.decode('utf-8') for text in texts]
+
+  else:
+    if numpy is not None and count > 1:
+      texts = model.generate_batch(count, settings['length'], settings['randomness'])
+    else:
+      texts = [model.markov(settings['length'], settings['randomness'])
+          for i in range(count)]
+
+  return texts
+
+def read_jobs(path, default_count):
+  """Read (username, count) pairs from path, skipping blank lines."""
+  jobs = []
+  with open(path) as f:
+    for line in f:
+      fields = line.split()
+      if not fields:
+        continue
+      if len(fields) > 1:
+        jobs.append((fields[0], int(fields[1])))
+      else:
+        jobs.append((fields[0], default_count))
+  return jobs
+
+def run(jobs, settings, cache, workers=None, chunk=100, out=sys.stdout,
+    models=None, memory_budget=None):
+  """Generate for every job across a process pool, writing JSON lines to out.
+
+  Returns the number of texts written. If models is a directory, workers
+  generate from the mapped models in it. If memory_budget is given, each
+  worker keeps at most that many bytes of loaded accounts.
+  """
+  written = 0
+  failed = set()
+  with ProcessPoolExecutor(workers, initializer=_start_worker,
+      initargs=(cache, settings['engine'], models, memory_budget)) as pool:
+    futures = {}
+    for username, count in jobs:
+      for start in range(0, count, chunk):
+        future = pool.submit(generate, username, min(chunk, count - start),
+            settings)
+        futures[future] = username
+
+    for future in as_completed(futures):
+      username = futures[future]
+      try:
+        texts = future.result()
+      except SystemExit:
+        error = 'could not generate; try less randomness'
+      except KeyError:
+        error = 'not cached'
+      except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+      else:
+        for text in texts:
+          out.write(json.dumps({'user': username, 'text': text}) + '\n')
+        written += len(texts)
+        out.flush()
+        continue
+
+      # Report each failing user once, not once per chunk.
+      if username not in failed:
+        failed.add(username)
+        out.write(json.dumps({'user': username, 'error': error}) + '\n')
+        out.flush()
+
+  return written
+
+
+if __name__ == '__main__':
+
+  parser = OptionParser(usage='Usage: batch.py [options] FILE')
+  parser.set_defaults(engine='twittov', count=1, order=3, length=None, max_length=None, split_words=False, backend='dict', randomness=15, cache='.twittov.cache', workers=None, chunk=100, output=None, models=None, memory_budget=None)
+
+  parser.add_option('-e', '--engine', type='choice', choices=['twittov', 'twittov2'], dest='engine', help='Generate like twittov.py or like twittov2.py. Default is twittov.')
+  parser.add_option('-n', '--count', type='int', dest='count', help='How many texts per user, for lines that don\'t say. Default is 1.')
+  parser.add_option('-l', '--length', type='int', dest='length', help='The *minimum* length of each text: characters for twittov (default 160), words for twittov2 (default 1).')
+  parser.add_option('-m', '--max-length', type='int', dest='max_length', help='twittov: the *maximum* length of each text, in characters. Unbounded by default.')
+  parser.add_option('-o', '--order', type='int', dest='order', help='twittov: the order of the markov chains. Default is 3.')
+  parser.add_option('-x', '--split', action='store_true', dest='split_words', help='twittov: operate on groups of letters rather than words.')
+  parser.add_option('-b', '--backend', type='choice', choices=['dict', 'array', 'char'], dest='backend', help='twittov: how to store the model. Default is dict.')
+  parser.add_option('-r', '--randomness', type='int', dest='randomness', help='twittov2: the randomness of the output. Default is 15.')
+  parser.add_option('-c', '--cache-file', dest='cache', type='string', metavar='FILE', help='Sets the cache file. By default, we read .twittov.cache')
+  parser.add_option('-j', '--workers', type='int', dest='workers', help='How many worker processes. Default is one per CPU.')
+  parser.add_option('--chunk', type='int', dest='chunk', help='The most texts one task generates. Default is 100.')
+  parser.add_option('--models', dest='models', type='string', metavar='DIR', help='Generate from mapped models in DIR, shared by every worker, exporting any that are missing. Dict, array and char backends all map to the same format.')
+  parser.add_option('--memory-budget', dest='memory_budget', type='string', metavar='SIZE', help='The most each worker keeps of the accounts it loads, e.g. 200M, counted as cached. By default, everything is kept.')
+  parser.add_option('--output', dest='output', type='string', metavar='FILE', help='Write the JSON lines to FILE instead of stdout.')
+
+  (options, args) = parser.parse_args()
+
+  if len(args) != 1:
+    parser.error('Incorrect number of arguments. Remember to specify a file of usernames.')
+
+  if options.length is None:
+    options.length = 160 if options.engine == 'twittov' else 1
+
+  for name in ('count', 'length', 'chunk'):
+    if getattr(options, name) <= 0:
+      parser.error('%s must be a positive integer.' % name.capitalize())
+
+  if options.max_length is not None and options.max_length < options.length:
+    parser.error('Max length must be at least the length.')
+
+  if options.memory_budget is not None:
+    try:
+      options.memory_budget = parse_size(options.memory_budget)
+    except ValueError as error:
+      parser.error(str(error))
+
+  settings = {
+    'engine': options.engine,
+    'order': options.order,
+    'length': options.length,
+    'max_length': options.max_length,
+    'split_words': bool(options.split_words),
+    'backend': options.backend,
+    'randomness': options.randomness,
+  }
+
+  if options.output:
+    out = open(options.output, 'w')
+  else:
+    out = sys.stdout
+
+  try:
+    run(read_jobs(args[0], options.count), settings, options.cache,
+        options.workers, options.chunk, out, options.models,
+        options.memory_budget)
+  finally:
+    if out is not sys.stdout:
+      out.close()
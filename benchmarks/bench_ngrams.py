@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""Compares util's n-gram extraction with the old list-shifting ingrams.
+
+  Usage: bench_ngrams.py [options]
+
+  The old ingrams kept its window in a list and deleted the first item for
+  every n-gram. The new one zips shifted slices of anything sliceable and
+  shifted tees of plain iterators, so the tuples are built in C; ngram_ids
+  extracts a whole corpus into one flat array of ids. Every variant must
+  produce the same n-grams before we time it.
+
+  On a tweet's worth of words the two cost the same, as setting up the
+  window outweighs the few tuples it makes, so word lists and iterators are
+  timed on one long sequence, where the old deletes and generator steps add
+  up.
+
+"""
+
+import os, sys, random
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import util
+from timing import best_of
+
+WORDS = ('I am the cat and a bat found under my closet today so what was '
+    'really going on here').split()
+
+def old_ingrams(sequence, n):
+  """The old util.ingrams, with next() spelt for Python 3.
+
+  Running out of items while filling the window used to raise StopIteration
+  out of the generator, which Python 3.7 and up turn into a RuntimeError, so
+  short sequences return instead.
+  """
+  sequence = iter(sequence)
+  history = []
+  while n > 1:
+    try:
+      history.append(next(sequence))
+    except StopIteration:
+      return
+    n -= 1
+  for item in sequence:
+    history.append(item)
+    yield tuple(history)
+    del history[0]
+
+def corpus(tweets, seed=0):
+  rng = random.Random(seed)
+  return [[rng.choice(WORDS) for j in range(rng.randint(4, 25))]
+      for i in range(tweets)]
+
+def old_ids(sequences, n):
+  """Interning tuple by tuple, as a caller of the old ingrams had to."""
+  ids = {}
+  grams = []
+  for sequence in sequences:
+    for gram in old_ingrams(sequence, n):
+      grams.extend(ids.setdefault(item, len(ids)) for item in gram)
+  return grams, ids
+
+def run(extract, sequences, n):
+  grams = []
+  for sequence in sequences:
+    grams.extend(extract(sequence, n))
+  return grams
+
+if __name__ == '__main__':
+  parser = OptionParser(usage='Usage: bench_ngrams.py [options]')
+  parser.set_defaults(repeat=5, tweets=20000, n=3, length=100000)
+  parser.add_option('-r', '--repeat', type='int', dest='repeat', help='Take the best of this many runs. Default is 5.')
+  parser.add_option('-t', '--tweets', type='int', dest='tweets', help='How many synthetic tweets to extract from. Default is 20000.')
+  parser.add_option('-n', type='int', dest='n', help='The degree of the n-grams. Default is 3.')
+  parser.add_option('-l', '--length', type='int', dest='length', help='The length of the single long sequence. Default is 100000.')
+  (options, args) = parser.parse_args()
+
+  sequences = corpus(options.tweets)
+  letters = [' '.join(sequence) for sequence in sequences]
+  n = options.n
+  iterate = lambda sequence, n: util.ingrams(iter(sequence), n)
+
+  for source in (sequences, letters):
+    expected = run(old_ingrams, source, n)
+    if run(util.ingrams, source, n) != expected or run(iterate, source, n) != expected:
+      print ('ingrams disagrees with the old implementation.')
+      sys.exit(1)
+  grams, ids = util.ngram_ids(sequences, n)
+  if list(grams) != old_ids(sequences, n)[0]:
+    print ('ngram_ids disagrees with interning the old ngrams.')
+    sys.exit(1)
+
+  print ('%d tweets, %d-grams.' % (len(sequences), n))
+  for name, old, new in [
+      ('letters (-x)', (run, old_ingrams, letters, n), (run, util.ingrams, letters, n)),
+      ('word ids into an array', (old_ids, sequences, n), (util.ngram_ids, sequences, n))]:
+    old = best_of(options.repeat, *old)
+    new = best_of(options.repeat, *new)
+    print ('%-24s old %6.1f ms, new %6.1f ms, %.1fx' % (name, old * 1000, new * 1000, old / new))
+
+  long = [random.choice(WORDS) for i in range(options.length)]
+  for name, extract in [('one long sequence', util.ingrams),
+      ('one long iterator', iterate)]:
+    old = best_of(options.repeat, lambda: list(old_ingrams(iter(long), n)))
+    new = best_of(options.repeat, lambda: list(extract(long, n)))
+    print ('%-24s old %6.1f ms, new %6.1f ms, %.1fx' % (name, old * 1000, new * 1000, old / new))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""Compares twittov2's streaming page parser with the old BeautifulSoup path.
+
+  Usage: bench_scrape.py [options] [page.html ...]
+
+  Each saved page is parsed both ways; with no pages given, we time the
+  synthetic timeline pages saved in pages/ (see corpus.py) instead. Both
+  parsers must find the same tweets, word for word, before we time them.
+
+"""
+
+import os, sys
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import twittov2
+import corpus
+from timing import best_of
+
+def soup_parse(page):
+  """The old scrape() path: a SoupStrainer-limited BeautifulSoup tree."""
+  from bs4 import BeautifulSoup, SoupStrainer
+  entries = BeautifulSoup(page, 'html.parser',
+      parse_only=SoupStrainer('span', 'entry-content'))
+  return [' '.join(entry.find_all(string=True)) for entry in entries]
+
+def stream_parse(page, chunk_size):
+  chunks = [page[i:i + chunk_size] for i in range(0, len(page), chunk_size)]
+  return list(twittov2.entries(chunks))
+
+if __name__ == '__main__':
+  parser = OptionParser(usage='Usage: bench_scrape.py [options] [page.html ...]')
+  parser.set_defaults(repeat=20, chunk_size=twittov2.CHUNK_SIZE)
+  parser.add_option('-n', '--repeat', type='int', dest='repeat', help='Take the best of this many runs. Default is 20.')
+  parser.add_option('--chunk-size', type='int', dest='chunk_size', help='Feed the streaming parser this many bytes at a time.')
+  (options, args) = parser.parse_args()
+
+  pages = [(path, open(path, 'rb').read()) for path in args]
+  if not pages:
+    pages = corpus.saved_pages()
+
+  for name, page in pages:
+    old = [tweet.split() for tweet in soup_parse(page)]
+    new = [tweet.split() for tweet in stream_parse(page, options.chunk_size)]
+    if old != new:
+      print ('%s: the parsers disagree (%d vs %d tweets).' % (name, len(old), len(new)))
+      sys.exit(1)
+
+    soup = best_of(options.repeat, soup_parse, page)
+    stream = best_of(options.repeat, stream_parse, page, options.chunk_size)
+    print ('%s: %d tweets, %d bytes. soupstrainer %.2f ms, streaming %.2f ms, %.1fx'
+        % (name, len(new), len(page), soup * 1000, stream * 1000, soup / stream))
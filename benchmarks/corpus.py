@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Seeded synthetic tweets and timeline pages for the benchmarks.
+
+  Usage: corpus.py [options]
+
+  Everything here is a pure function of its arguments, so every run of a
+  benchmark, on any machine, sees the same input. Run as a script, it
+  rewrites the saved pages in pages/ that run.py times scrape() against.
+
+  Word frequencies follow a Zipf law of exponent skew over a vocabulary of
+  made-up words: skew 0 makes every word equally likely, and around 1 is
+  what real text looks like. Tweets are 4 to 25 words long, and some of them
+  carry the mentions, URLs and retweet markers that normalize.py deals with.
+
+"""
+
+import os, random
+from itertools import accumulate
+from optparse import OptionParser
+
+PAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pages')
+
+SYLLABLES = ('ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'ze', 'po', 'da',
+    'fe', 'gu', 'hi', 'jo', 'bu')
+
+
+def vocabulary(size):
+  """Return size distinct made-up words, shortest first."""
+  words = []
+  length = 1
+  while len(words) < size:
+    count = len(SYLLABLES) ** length
+    for index in range(min(count, size - len(words))):
+      word = ''
+      for j in range(length):
+        index, k = divmod(index, len(SYLLABLES))
+        word += SYLLABLES[k]
+      words.append(word)
+    length += 1
+  return words
+
+def tweets(count, vocabulary_size=5000, skew=1.0, seed=0):
+  """Return count synthetic tweets, as strings.
+
+  Keyword arguments:
+  count -- How many tweets.
+  vocabulary_size -- How many distinct words to draw from.
+  skew -- The Zipf exponent of the word frequencies; 0 is uniform.
+  seed -- Seeds the random generator.
+
+  """
+  rng = random.Random(seed)
+  words = vocabulary(vocabulary_size)
+  weights = list(accumulate(1.0 / (rank ** skew)
+      for rank in range(1, vocabulary_size + 1)))
+
+  result = []
+  for i in range(count):
+    tweet = rng.choices(words, cum_weights=weights, k=rng.randint(4, 25))
+    roll = rng.random()
+    if roll < 0.05:
+      tweet[:0] = ['RT', '@%s:' % rng.choice(words)]
+    elif roll < 0.15:
+      tweet.insert(rng.randrange(len(tweet)), '@%s' % rng.choice(words))
+    elif roll < 0.2:
+      tweet.append('http://t.co/%x' % rng.getrandbits(32))
+    result.append(' '.join(tweet))
+  return result
+
+def page(count=20, seed=0):
+  """Return the HTML of one page of tweets, padded with timeline markup."""
+  rng = random.Random(seed)
+  items = []
+  for i, tweet in enumerate(tweets(count, 500, 1.0, seed)):
+    words = tweet.split()
+    words[rng.randrange(len(words))] = '<a href="/someone" class="tweet-url username">@someone</a>'
+    items.append('<li class="hentry status u-someone" id="status_%d">'
+        '<span class="status-body"><span class="status-content">'
+        '<span class="entry-content">%s <a href="http://t.co/%d">http://t.co/%d</a></span>'
+        '</span><span class="meta entry-meta"><a class="entry-date" href="/s/%d">'
+        '<span class="published timestamp">%d minutes ago</span></a>'
+        '<span>from <a href="http://x" rel="nofollow">web</a></span></span></span>'
+        '<ul class="actions-hover"><li><span class="reply"><i></i><a href="#">Reply'
+        '</a></span></li></ul></li>' % (i, ' '.join(words), i, i, i, i))
+  return ('<!DOCTYPE html><html><head><title>timeline</title>'
+      '<script type="text/javascript">var page = {"user": "someone"};</script>'
+      '<link rel="stylesheet" href="/a.css"></head><body><div id="container">'
+      '<div id="side">%s</div><ol id="timeline" class="statuses">%s</ol>'
+      '</div></body></html>\n' % ('<div class="stats">x</div>' * 200,
+      ''.join(items))).encode('utf-8')
+
+def saved_pages():
+  """Return (name, html) for every saved page, in name order."""
+  return [(name, open(os.path.join(PAGES, name), 'rb').read())
+      for name in sorted(os.listdir(PAGES)) if name.endswith('.html')]
+
+
+if __name__ == '__main__':
+  parser = OptionParser(usage='Usage: corpus.py [options]')
+  parser.set_defaults(pages=3, tweets=20)
+  parser.add_option('-p', '--pages', type='int', dest='pages', help='How many pages to save. Default is 3.')
+  parser.add_option('-t', '--tweets', type='int', dest='tweets', help='How many tweets per page. Default is 20, as on twitter.com.')
+  (options, args) = parser.parse_args()
+
+  if not os.path.isdir(PAGES):
+    os.makedirs(PAGES)
+  for i in range(options.pages):
+    path = os.path.join(PAGES, 'timeline-%d.html' % (i + 1))
+    with open(path, 'wb') as f:
+      f.write(page(options.tweets, i))
+    print ('Wrote %s.' % path)
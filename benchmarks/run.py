@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+"""Runs the benchmark suite and keeps the results of every commit.
+
+  Usage: run.py [options]
+
+  Every benchmark runs on seeded synthetic tweets (see corpus.py) or on the
+  saved pages in pages/, so the suite needs no network and every run sees
+  the same input. It covers:
+
+    tokenize  -- TokenStream over the raw tweets.
+    ngrams    -- util.ingrams over every tweet's words.
+    build     -- twittov models, for each backend, over words and letters
+                 at several orders, and twittov2 tables.
+    cache     -- storing and loading a compiled TweetList in a CacheStore.
+    generate  -- single texts from both engines, and NumPy batches when
+                 NumPy is installed.
+    scrape    -- twittov2's page parser over the saved pages.
+
+  Each benchmark is timed as the best of --repeat runs. The results are
+  written to results/COMMIT.json, COMMIT being the checked out commit, with
+  -dirty appended if the tree has uncommitted changes, and --compare prints
+  them next to those of another commit.
+
+"""
+
+import os, sys, json, time, random, shutil, platform, tempfile, subprocess
+import functools
+from fnmatch import fnmatch
+from optparse import OptionParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+RESULTS = os.path.join(HERE, 'results')
+
+sys.path.insert(0, ROOT)
+import corpus, util, twittov, twittov2
+from timing import best_of
+from normalize import TokenStream
+from cachestore import CacheStore
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# Single texts generated per timed run.
+TEXTS = 100
+
+# The randomness of twittov2 texts. Synthetic tweets branch much less than
+# real ones, and uniform ones hardly at all, so a corpus whose heads can't
+# meet it is generated from at the highest randomness they can meet.
+RANDOMNESS = 2
+
+
+def tweet_list(tweets):
+  """Make a TweetList of tweets, as if they had just been fetched."""
+  model = twittov.TweetList.__new__(twittov.TweetList)
+  model.username = 'benchmark'
+  model.tweets = tweets
+  model.newest_id = len(tweets)
+  model.models = {}
+  model.tokens = TokenStream(tweets)
+  return model
+
+def just(function, *args):
+  """Set up a benchmark that times function(*args) and needs nothing else."""
+  return lambda: functools.partial(function, *args)
+
+def build(tweets, order, split_words, backend):
+  tweet_list(tweets).compile(order, split_words, backend)
+
+def generate(tweets, order, split_words, backend):
+  model = tweet_list(tweets)
+  model.compile(order, split_words, backend)
+  return lambda: [model.generate_text(order, 160, split_words, backend)
+      for i in range(TEXTS)]
+
+def generate_batch(tweets, order, split_words):
+  model = tweet_list(tweets)
+  model.compile(order, split_words, 'array')
+  return lambda: model.generate_batch(TEXTS, order, 160, split_words)
+
+def generate_table(tweets, batch):
+  table = twittov2.buildTable(tweets, 'benchmark')
+  # Every head meets randomness 0, so this always finds one.
+  randomness = RANDOMNESS
+  while not table.reach(randomness)[1]:
+    randomness -= 1
+  if batch:
+    # The first batch converts the chains; that's setup, not generation.
+    table.generate_batch(1, 1, randomness)
+    return lambda: table.generate_batch(TEXTS, 20, randomness)
+  return lambda: [table.markov(20, randomness) for i in range(TEXTS)]
+
+def ngrams(tweets, n):
+  sequences = list(TokenStream(tweets))
+  def extract():
+    for sequence in sequences:
+      for gram in util.ingrams(sequence, n):
+        pass
+  return extract
+
+def cache(path, tweets, order, load):
+  """Store a compiled TweetList in a fresh CacheStore, and time storing it
+  again, or loading it back."""
+  model = tweet_list(tweets)
+  model.compile(order, False, 'dict')
+  store = CacheStore(path, 'twittov')
+  store['benchmark'] = model
+  if load:
+    return lambda: store['benchmark']
+  return lambda: store.__setitem__('benchmark', model)
+
+def benchmarks(options, directory):
+  """Yield (name, setup) for every benchmark the options ask for.
+
+  A name is a path of its settings, e.g. build/twittov/array/words/order=3/
+  tweets=1000/skew=1.0, so results of the same benchmark line up across
+  runs. setup() prepares whatever the benchmark needs outside the timings,
+  and returns the function to time, or None if it can't run.
+
+  Keyword arguments:
+  options -- The parsed command line.
+  directory -- A scratch directory for cache files.
+
+  """
+  for skew in options.skews:
+    for size in options.sizes:
+      tweets = corpus.tweets(size, options.vocabulary, skew)
+      corpus_name = 'tweets=%d/skew=%s' % (size, skew)
+
+      yield ('tokenize/%s' % corpus_name, just(TokenStream, tweets))
+      yield ('ngrams/n=3/%s' % corpus_name, functools.partial(ngrams, tweets,
+          3))
+
+      for split_words, orders in ((False, options.orders),
+          (True, options.letter_orders)):
+        mode = 'letters' if split_words else 'words'
+        for order in orders:
+          for backend in ('dict', 'array', 'char'):
+            if backend == 'char' and not split_words:
+              continue
+            settings = '%s/%s/order=%d/%s' % (backend, mode, order, corpus_name)
+            yield ('build/twittov/%s' % settings, just(build, tweets, order,
+                split_words, backend))
+            yield ('generate/twittov/%s' % settings, functools.partial(generate,
+                tweets, order, split_words, backend))
+
+          if numpy is not None:
+            yield ('generate_batch/twittov/%s/order=%d/%s' % (mode, order,
+                corpus_name), functools.partial(generate_batch, tweets, order,
+                split_words))
+
+      yield ('build/twittov2/%s' % corpus_name, just(twittov2.buildTable,
+          tweets, 'benchmark'))
+      yield ('generate/twittov2/%s' % corpus_name,
+          functools.partial(generate_table, tweets, False))
+      if numpy is not None:
+        yield ('generate_batch/twittov2/%s' % corpus_name,
+            functools.partial(generate_table, tweets, True))
+
+      path = os.path.join(directory, '%d-%s.cache' % (size, skew))
+      yield ('cache/store/%s' % corpus_name, functools.partial(cache, path,
+          tweets, options.orders[0], False))
+      yield ('cache/load/%s' % corpus_name, functools.partial(cache, path,
+          tweets, options.orders[0], True))
+
+  pages = [page for name, page in corpus.saved_pages()]
+  yield ('scrape/pages=%d' % len(pages), just(lambda: [twittov2.parse(page)
+      for page in pages]))
+
+def run(options, out=sys.stdout):
+  """Run every benchmark that matches options.only.
+
+  Returns (results, skipped): results map benchmark names to their best
+  time, in seconds, and skipped maps the names of those that couldn't run
+  to why not.
+  """
+  results = {}
+  skipped = {}
+  directory = tempfile.mkdtemp(prefix='twittov-bench-')
+  try:
+    for name, setup in benchmarks(options, directory):
+      if options.only and not any(fnmatch(name, pattern)
+          for pattern in options.only):
+        continue
+
+      # Every benchmark starts from the same random state.
+      random.seed(0)
+      function = setup()
+      if function is None:
+        skipped[name] = 'skipped'
+        out.write('%-72s skipped\n' % name)
+        continue
+
+      # twittov2 exits when it can't meet the randomness, even in a batch.
+      try:
+        results[name] = best_of(options.repeat, function)
+      except SystemExit:
+        skipped[name] = 'failed'
+        out.write('%-72s failed\n' % name)
+        continue
+      out.write('%-72s %10.2f ms\n' % (name, results[name] * 1000))
+      out.flush()
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+  return results, skipped
+
+def commit():
+  """Return the checked out commit, with -dirty if the tree has changes."""
+  def git(*args):
+    return subprocess.check_output(('git',) + args, cwd=ROOT,
+        stderr=subprocess.DEVNULL).decode('utf-8').strip()
+
+  try:
+    name = git('rev-parse', '--short', 'HEAD')
+    if git('status', '--porcelain', '--untracked-files=no'):
+      name += '-dirty'
+  except (OSError, subprocess.CalledProcessError):
+    name = 'unknown'
+  return name
+
+def load_results(reference):
+  """Load results by path, or by the commit (or a prefix of it) they're for."""
+  if os.path.exists(reference):
+    path = reference
+  else:
+    matches = sorted(name for name in os.listdir(RESULTS)
+        if name.startswith(reference) and name.endswith('.json'))
+    if not matches:
+      raise IOError('No results for %s in %s.' % (reference, RESULTS))
+    path = os.path.join(RESULTS, matches[0])
+  with open(path) as f:
+    return json.load(f)
+
+def compare(old, new, out=sys.stdout):
+  """Print the benchmarks both runs have, slowest change first."""
+  names = [name for name in new['results'] if name in old['results']]
+  rows = sorted(names, key=lambda name:
+      old['results'][name] / new['results'][name])
+
+  out.write('%-72s %10s %10s %7s\n' % ('%s -> %s' % (old['commit'],
+      new['commit']), 'old ms', 'new ms', 'speedup'))
+  for name in rows:
+    before = old['results'][name]
+    after = new['results'][name]
+    out.write('%-72s %10.2f %10.2f %6.2fx\n' % (name, before * 1000,
+        after * 1000, before / after))
+
+
+if __name__ == '__main__':
+  parser = OptionParser(usage='Usage: run.py [options]')
+  parser.set_defaults(repeat=3, sizes='1000,10000', skews='0,1.0', orders='2,3', letter_orders='4,8', vocabulary=5000, only=[], compare=None, save=True)
+  parser.add_option('-r', '--repeat', type='int', dest='repeat', help='Take the best of this many runs. Default is 3.')
+  parser.add_option('-s', '--sizes', dest='sizes', help='Comma-separated corpus sizes, in tweets. Default is 1000,10000; up to 1000000 works given the memory.')
+  parser.add_option('-k', '--skews', dest='skews', help='Comma-separated Zipf exponents of the word frequencies. 0 is uniform. Default is 0,1.0.')
+  parser.add_option('-o', '--orders', dest='orders', help='Comma-separated orders for words. Default is 2,3.')
+  parser.add_option('-x', '--letter-orders', dest='letter_orders', help='Comma-separated orders for letters (-x). Default is 4,8.')
+  parser.add_option('-v', '--vocabulary', type='int', dest='vocabulary', help='How many distinct words the corpora use. Default is 5000.')
+  parser.add_option('--only', action='append', dest='only', metavar='PATTERN', help='Only run benchmarks whose name matches this glob, e.g. "build/*". May be repeated.')
+  parser.add_option('-c', '--compare', dest='compare', metavar='COMMIT', help='Compare with the results of COMMIT (or a results file) when done.')
+  parser.add_option('-n', '--no-save', action='store_false', dest='save', help='Don\'t write the results to results/.')
+  (options, args) = parser.parse_args()
+
+  options.sizes = [int(size) for size in options.sizes.split(',')]
+  options.skews = [float(skew) for skew in options.skews.split(',')]
+  options.orders = [int(order) for order in options.orders.split(',')]
+  options.letter_orders = [int(order) for order in options.letter_orders.split(',')]
+
+  reference = None
+  if options.compare:
+    reference = load_results(options.compare)
+
+  results, skipped = run(options)
+  report = {
+    'commit': commit(),
+    'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'numpy': numpy is not None,
+    'options': {
+      'repeat': options.repeat,
+      'sizes': options.sizes,
+      'skews': options.skews,
+      'orders': options.orders,
+      'letter_orders': options.letter_orders,
+      'vocabulary': options.vocabulary,
+    },
+    'results': results,
+    'skipped': skipped,
+  }
+
+  if options.save:
+    if not os.path.isdir(RESULTS):
+      os.makedirs(RESULTS)
+    path = os.path.join(RESULTS, report['commit'] + '.json')
+    with open(path, 'w') as f:
+      json.dump(report, f, indent=2, sort_keys=True)
+    print ('Wrote %s.' % path)
+
+  if reference is not None:
+    compare(reference, report)
@@ -0,0 +1,19 @@
+"""Timing helpers shared by the benchmarks."""
+
+import time
+
+
+def best_of(repeat, function, *args):
+  """Call function(*args) repeat times and return the fastest, in seconds.
+
+  The best run is the one least disturbed by everything else on the machine,
+  so it is the steadiest to compare between commits.
+  """
+  best = None
+  for i in range(repeat):
+    start = time.perf_counter()
+    function(*args)
+    elapsed = time.perf_counter() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
@@ -0,0 +1,234 @@
+"""Keeps a cache of accounts within a budget, and its entries fresh.
+
+  A CacheStore keeps every account it was ever given, forever. A
+  CacheManager wraps one and bounds it:
+
+    disk budget   -- enforce() evicts the coldest accounts until the live
+                     entries fit in disk_budget bytes. It then compacts the
+                     file once enough of it is garbage, budget or not.
+    memory budget -- loaded accounts are kept in memory, for processes that
+                     serve many requests, until they add up to memory_budget
+                     bytes (as pickled); then the coldest are dropped.
+    TTL           -- an account stored more than ttl seconds ago is stale.
+                     get() hands stale accounts to a refresh function, and
+                     stores what it returns.
+
+  Coldness follows the policy: 'lru' evicts what was read least recently,
+  'lfu' what was read least often, with the least recent first among ties.
+  Reads and stores are tracked in the store itself, so the policy sees every
+  process that shares the file.
+
+  stats() reports hits, misses, evictions and refreshes. They are also
+  counted in metrics.py, so --profile shows them.
+
+  A CacheManager can be used like the store itself: `name in manager`,
+  `manager[name]` and `manager[name] = value` all work.
+
+"""
+
+import re, time
+from collections import OrderedDict
+import metrics
+
+POLICIES = ('lru', 'lfu')
+
+UNITS = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+DURATIONS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def parse_size(text):
+  """Parse a byte count like '500M' or '2g' (powers of 1024).
+
+  >>> parse_size('1.5k')
+  1536
+  """
+  match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$', text, re.I)
+  if match is None:
+    raise ValueError('Not a size: %r' % text)
+  return int(float(match.group(1)) * UNITS[match.group(2).lower()])
+
+def parse_duration(text):
+  """Parse a number of seconds, or a duration like '90m', '12h' or '7d'.
+
+  >>> parse_duration('2h')
+  7200
+  """
+  match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([smhdw]?)\s*$', text, re.I)
+  if match is None:
+    raise ValueError('Not a duration: %r' % text)
+  return int(float(match.group(1)) * DURATIONS[match.group(2).lower()])
+
+
+class CacheManager(object):
+  """Bounds and refreshes a CacheStore.
+
+  Keyword arguments:
+  store -- The CacheStore to manage.
+  disk_budget -- If specified, the most bytes the live entries may take.
+  memory_budget -- If specified, keep up to this many bytes of loaded
+                   entries in memory. By default, nothing is kept.
+  policy -- 'lru' or 'lfu'.
+  ttl -- If specified, how many seconds an entry stays fresh.
+
+  """
+
+  def __init__(self, store, disk_budget=None, memory_budget=None,
+      policy='lru', ttl=None):
+    if policy not in POLICIES:
+      raise ValueError('policy must be one of %s' % ', '.join(POLICIES))
+
+    self.store = store
+    self.disk_budget = disk_budget
+    self.memory_budget = memory_budget
+    self.policy = policy
+    self.ttl = ttl
+
+    # name -> [value, size, hits], least recently used first.
+    self.loaded = OrderedDict()
+    self.memory_used = 0
+    self.counts = dict.fromkeys(('hits', 'memory_hits', 'misses', 'stores',
+        'evictions', 'memory_evictions', 'refreshes'), 0)
+
+  def get(self, name, refresh=None):
+    """Return the entry for name, refreshing it first if it's stale.
+
+    Raises KeyError if name isn't cached.
+
+    Keyword arguments:
+    name -- The entry's name.
+    refresh -- If specified, called with a stale entry; whatever it returns
+               is stored and returned in its place.
+
+    """
+    entry = self.loaded.get(name)
+    if entry is not None:
+      self.loaded.move_to_end(name)
+      entry[2] += 1
+      # The store still hears of the read, for enforce() and other processes.
+      self.store.touch(name)
+      self._count('memory_hits')
+      value = entry[0]
+    else:
+      try:
+        value = self.store[name]
+      except KeyError:
+        self._count('misses')
+        raise
+      self._remember(name, value)
+
+    self._count('hits')
+    if refresh is not None and self.is_stale(name):
+      value = refresh(value)
+      self[name] = value
+    return value
+
+  def is_stale(self, name):
+    """Check whether name was stored more than ttl seconds ago."""
+    if self.ttl is None:
+      return False
+    info = self.store.info(name)
+    return info is not None and time.time() - info[0] > self.ttl
+
+  def enforce(self, keep=()):
+    """Evict the coldest entries until the rest fit in the disk budget, then
+    compact the store if enough of it is garbage.
+
+    Returns the names evicted, coldest first.
+
+    Keyword arguments:
+    keep -- Names never to evict, e.g. the account just generated for.
+
+    """
+    evicted = []
+    usage = self.store.usage() if self.disk_budget is not None else []
+    total = sum(size for name, stored, accessed, hits, size in usage)
+    for name, stored, accessed, hits, size in sorted(usage, key=self._coldness):
+      if total <= self.disk_budget:
+        break
+      if name in keep:
+        continue
+      del self.store[name]
+      self.forget(name)
+      total -= size
+      evicted.append(name)
+      self._count('evictions')
+
+    # Evicting only writes tombstones; compacting gives the space back.
+    self.store.maybe_compact()
+    return evicted
+
+  def forget(self, name):
+    """Drop name from memory, if it's there."""
+    entry = self.loaded.pop(name, None)
+    if entry is not None:
+      self.memory_used -= entry[1]
+
+  def stats(self):
+    """Return the counts so far, and what the cache holds now."""
+    stats = dict(self.counts)
+    usage = self.store.usage()
+    stats['entries'] = len(usage)
+    stats['disk_bytes'] = sum(row[4] for row in usage)
+    stats['memory_entries'] = len(self.loaded)
+    stats['memory_bytes'] = self.memory_used
+    return stats
+
+  def close(self):
+    self.loaded.clear()
+    self.memory_used = 0
+    self.store.close()
+
+  def __contains__(self, name):
+    return name in self.loaded or name in self.store
+
+  def __getitem__(self, name):
+    return self.get(name)
+
+  def __setitem__(self, name, value):
+    # Storing over a stale entry refreshes it, however it was fetched.
+    if self.is_stale(name):
+      self._count('refreshes')
+    self.store[name] = value
+    self._count('stores')
+    self.forget(name)
+    self._remember(name, value)
+
+  def __delitem__(self, name):
+    self.forget(name)
+    del self.store[name]
+
+  def __len__(self):
+    return len(self.store)
+
+  def __iter__(self):
+    return iter(self.store)
+
+  def _coldness(self, row):
+    """Sort key putting the entries to evict first."""
+    name, stored, accessed, hits, size = row
+    if self.policy == 'lfu':
+      return (hits, accessed)
+    return (accessed,)
+
+  def _remember(self, name, value):
+    """Keep a loaded entry in memory, evicting others to make room."""
+    if not self.memory_budget:
+      return
+    info = self.store.info(name)
+    if info is None or info[3] > self.memory_budget:
+      return
+
+    self.forget(name)
+    self.loaded[name] = [value, info[3], 1]
+    self.memory_used += info[3]
+    while self.memory_used > self.memory_budget:
+      if self.policy == 'lfu':
+        coldest = min(self.loaded, key=lambda name: self.loaded[name][2])
+      else:
+        coldest = next(iter(self.loaded))
+      self.forget(coldest)
+      self._count('memory_evictions')
+
+  def _count(self, name):
+    self.counts[name] += 1
+    metrics.count('cache_' + name)
@@ -0,0 +1,313 @@
+"""An indexed, lazily loaded cache of per-user models.
+
+  The cache used to be one pickled dict, so every run unpickled every account
+  just to look up one username. A CacheStore keeps each entry pickled in its
+  own row of an SQLite database instead, and only unpickles the rows that are
+  asked for. Lookups go through an index on the name, so startup costs the
+  same whether one user or thousands are cached.
+
+  Both twittov.py and twittov2.py default to .twittov.cache, so entries are
+  namespaced by kind: the name of the module whose objects they hold.
+
+  Writes are append-only: storing an entry inserts a new row and never touches
+  existing ones, and reads pick the newest row for a name. Every insert is
+  atomic under SQLite's file lock and the database runs in WAL mode, so any
+  number of generators can share one cache without clobbering each other's
+  entries. Superseded rows pile up until compact() rewrites the file.
+
+  A cache file still in the old pickle format is migrated the first time it
+  is opened. The old file is kept next to the new one with a .pickle suffix,
+  and only set aside once the new one holds every entry, so a migration that
+  fails is simply tried again on the next open.
+  Opening holds a lock on a .lock file next to the cache, so a process never
+  takes a database another one is still creating for an old cache, and only
+  one of them migrates it.
+
+  Next to the log, a usage table records when each entry was stored and last
+  read, how often it was read and how many bytes it takes. A CacheManager
+  (see cachemanager.py) decides from those which entries are cold or stale.
+
+"""
+
+import os, io, sys, time, pickle, sqlite3, importlib
+from contextlib import contextmanager
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+# The first byte of a pickled dict: a protocol marker, or protocol 0 or 1's
+# opcode for an empty dict.
+PICKLE_STARTS = (b'\x80', b'(', b'}')
+
+# How long to wait for another process's write lock, in seconds.
+LOCK_TIMEOUT = 30
+
+# Compact automatically once this fraction of the rows is superseded.
+COMPACT_THRESHOLD = 0.5
+
+
+class _Unpickler(pickle.Unpickler):
+  """Finds classes pickled from a script run as __main__ in their module."""
+
+  def __init__(self, f, kind):
+    pickle.Unpickler.__init__(self, f)
+    self.kind = kind
+
+  def find_class(self, module, name):
+    if module == '__main__' and not hasattr(sys.modules['__main__'], name):
+      module = self.kind
+      importlib.import_module(module)
+    return pickle.Unpickler.find_class(self, module, name)
+
+
+class CacheStore(object):
+
+  def __init__(self, path, kind):
+    """Open (and if needed create or migrate) the cache at path.
+
+    Keyword arguments:
+    path -- The cache file.
+    kind -- The module whose objects the entries hold, e.g. 'twittov'.
+
+    """
+    self.path = path
+    self.kind = kind
+
+    with _locked(path + '.lock'):
+      # A migration that got as far as setting the old file aside only has
+      # the new database left to move into place.
+      migrated = path + '.migrating'
+      if not os.path.exists(path) and os.path.exists(migrated):
+        os.rename(migrated, path)
+
+      if is_pickle(path):
+        # Copy everything into a new database before touching the old file,
+        # so a migration that fails leaves it in place to be tried again.
+        for leftover in (migrated, migrated + '-journal'):
+          if os.path.exists(leftover):
+            os.remove(leftover)
+        self._connect(migrated)
+        try:
+          self._track()
+          self.migrate(path)
+        finally:
+          self.db.close()
+        os.rename(path, path + '.pickle')
+        os.rename(migrated, path)
+
+      self._connect(path)
+      self.db.execute('PRAGMA journal_mode=WAL')
+      self._track()
+
+  def _connect(self, path):
+    """Open the database at path, creating the log if needed."""
+    # Autocommit, so we can take SQLite's write lock explicitly.
+    self.db = sqlite3.connect(path, timeout=LOCK_TIMEOUT, isolation_level=None)
+    self.db.execute('CREATE TABLE IF NOT EXISTS log (id INTEGER PRIMARY KEY '
+        'AUTOINCREMENT, kind TEXT, name TEXT, data BLOB)')
+    self.db.execute('CREATE INDEX IF NOT EXISTS log_names ON log (kind, name, id)')
+
+  def migrate(self, path):
+    """Copy every entry of an old pickled cache dict into the store.
+
+    Returns the number of entries copied.
+
+    Keyword arguments:
+    path -- The old pickle file.
+
+    """
+    with open(path, 'rb') as f:
+      try:
+        cache = _Unpickler(f, self.kind).load()
+      except EOFError:
+        cache = {}
+
+    with self._transaction():
+      for name, value in cache.items():
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self._append(name, data)
+        self._record(name, len(data))
+    return len(cache)
+
+  def compact(self):
+    """Drop superseded and deleted rows, then rewrite the file.
+
+    This takes the write lock for the duration, so other writers wait rather
+    than fail. Returns the number of rows dropped.
+    """
+    with self._transaction():
+      dropped = self.db.execute('DELETE FROM log WHERE id NOT IN (SELECT '
+          'MAX(id) FROM log GROUP BY kind, name) OR data IS NULL').rowcount
+      self.db.execute('DELETE FROM usage WHERE NOT EXISTS (SELECT 1 FROM log '
+          'WHERE log.kind = usage.kind AND log.name = usage.name)')
+
+    self.db.execute('VACUUM')
+    return dropped
+
+  def maybe_compact(self, threshold=COMPACT_THRESHOLD):
+    """Compact if at least threshold of the rows are garbage.
+
+    Returns the number of rows dropped.
+    """
+    if self.garbage() < threshold:
+      return 0
+    return self.compact()
+
+  def garbage(self):
+    """Return the fraction of rows that compact() would drop."""
+    total, live = self.db.execute('SELECT COUNT(*), (SELECT COUNT(*) FROM log '
+        'WHERE id IN (SELECT MAX(id) FROM log GROUP BY kind, name) AND data IS '
+        'NOT NULL) FROM log').fetchone()
+    if not total:
+      return 0.0
+    return (total - live) / float(total)
+
+  def keys(self):
+    return [row[0] for row in self.db.execute('SELECT name FROM log WHERE id IN '
+        '(SELECT MAX(id) FROM log WHERE kind = ? GROUP BY name) AND data IS NOT '
+        'NULL ORDER BY name', (self.kind,))]
+
+  def usage(self):
+    """Return (name, stored, accessed, hits, size) for every live entry.
+
+    stored and accessed are Unix times, and size is the pickled size in bytes.
+    """
+    return self.db.execute('SELECT name, stored, accessed, hits, size FROM '
+        'usage WHERE kind = ? ORDER BY name', (self.kind,)).fetchall()
+
+  def info(self, name):
+    """Return (stored, accessed, hits, size) for name, or None if not cached."""
+    return self.db.execute('SELECT stored, accessed, hits, size FROM usage '
+        'WHERE kind = ? AND name = ?', (self.kind, name)).fetchone()
+
+  def touch(self, name):
+    """Record a read of name. This is only bookkeeping, so if another process
+    holds the write lock, we skip it rather than wait."""
+    self.db.execute('PRAGMA busy_timeout = 0')
+    try:
+      self.db.execute('UPDATE usage SET accessed = ?, hits = hits + 1 WHERE '
+          'kind = ? AND name = ?', (time.time(), self.kind, name))
+    except sqlite3.OperationalError:
+      pass
+    finally:
+      self.db.execute('PRAGMA busy_timeout = %d' % (LOCK_TIMEOUT * 1000))
+
+  def close(self):
+    self.db.close()
+
+  def __len__(self):
+    return len(self.keys())
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def __contains__(self, name):
+    return self._latest(name) is not None
+
+  def __getitem__(self, name):
+    data = self._latest(name)
+    if data is None:
+      raise KeyError(name)
+    value = _Unpickler(io.BytesIO(data), self.kind).load()
+    self.touch(name)
+    return value
+
+  def __setitem__(self, name, value):
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    with self._transaction():
+      self._append(name, data)
+      self._record(name, len(data))
+
+  def __delitem__(self, name):
+    if name not in self:
+      raise KeyError(name)
+    with self._transaction():
+      # A NULL row is a tombstone.
+      self._append(name, None)
+      self.db.execute('DELETE FROM usage WHERE kind = ? AND name = ?',
+          (self.kind, name))
+
+  def _latest(self, name):
+    row = self.db.execute('SELECT data FROM log WHERE kind = ? AND name = ? '
+        'ORDER BY id DESC LIMIT 1', (self.kind, name)).fetchone()
+    if row is None:
+      return None
+    return row[0]
+
+  def _append(self, name, data):
+    self.db.execute('INSERT INTO log (kind, name, data) VALUES (?, ?, ?)',
+        (self.kind, name, data))
+
+  def _record(self, name, size):
+    """Record that name was just stored, taking size bytes."""
+    now = time.time()
+    # Storing an entry anew keeps its read count: it's the same account.
+    self.db.execute('INSERT INTO usage (kind, name, stored, accessed, hits, '
+        'size) VALUES (?, ?, ?, ?, 0, ?) ON CONFLICT (kind, name) DO UPDATE '
+        'SET stored = excluded.stored, accessed = excluded.accessed, size = '
+        'excluded.size', (self.kind, name, now, now, size))
+
+  @contextmanager
+  def _transaction(self):
+    """Run the body of a with statement as one transaction, holding SQLite's
+    write lock from the start. Anything raised, even KeyboardInterrupt, rolls
+    it back."""
+    self.db.execute('BEGIN IMMEDIATE')
+    try:
+      yield
+    except BaseException:
+      self.db.execute('ROLLBACK')
+      raise
+    self.db.execute('COMMIT')
+
+  def _track(self):
+    """Create the usage table, if needed, with a row for every live entry.
+
+    Entries stored before usage was tracked count as stored and read now, so
+    they aren't all evicted or refreshed the moment tracking starts.
+    """
+    if self.db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND "
+        "name = 'usage'").fetchone() is not None:
+      return
+
+    with self._transaction():
+      self.db.execute('CREATE TABLE IF NOT EXISTS usage (kind TEXT, name TEXT, '
+          'stored REAL, accessed REAL, hits INTEGER, size INTEGER, PRIMARY KEY '
+          '(kind, name))')
+      now = time.time()
+      self.db.execute('INSERT OR IGNORE INTO usage SELECT kind, name, ?, ?, 0, '
+          'LENGTH(data) FROM log WHERE id IN (SELECT MAX(id) FROM log GROUP BY '
+          'kind, name) AND data IS NOT NULL', (now, now))
+
+
+@contextmanager
+def _locked(path):
+  """Hold an exclusive lock on the file at path for the body of a with
+  statement. Without fcntl, as on Windows, nothing is locked."""
+  if fcntl is None:
+    yield
+    return
+
+  with open(path, 'a') as f:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(f, fcntl.LOCK_UN)
+
+def is_pickle(path):
+  """Check whether path holds a cache in the old pickle format.
+
+  An empty file isn't one: it may be a database another process has only
+  just created.
+  """
+  try:
+    with open(path, 'rb') as f:
+      header = f.read(len(SQLITE_HEADER))
+  except IOError:
+    return False
+  return header[:1] in PICKLE_STARTS
@@ -0,0 +1,180 @@
+"""A character-level Markov model over integer-coded prefixes.
+
+  With split_words, the dict models key on tuples of one-character strings
+  and keep a Transitions per prefix: hundreds of bytes of Python objects for
+  every state, and a tuple to build and hash at every step. At orders of 8
+  and up nearly every position in the corpus is a state of its own, so that
+  cost is paid per character of input.
+
+  A CharModel maps every character to a small id and codes each prefix as
+  one integer, updated in place as the window slides along the text:
+
+    exact  -- while order ids fit in 64 bits, the code is the ids packed
+              side by side, so distinct prefixes never collide.
+    hashed -- past that, the code is a polynomial rolling hash modulo the
+              Mersenne prime 2**61 - 1. Two prefixes only share a row if they
+              collide, which for a million states happens with a probability
+              around 1e-7.
+
+  Codes are only needed while building. The table is laid out CSR style, like
+  an ArrayModel, and every edge records the row it leads to, so generation
+  never looks a prefix up at all:
+
+    offsets     -- row i owns edges offsets[i] up to offsets[i+1].
+    successors  -- the character id each edge leads to.
+    cumulative  -- running count of the edges within their row.
+    next_rows   -- the row each edge leads to, or -1 where the chain ends.
+
+  That is 4 bytes per state and 10 per edge for alphabets of up to 65536
+  characters, whatever the order.
+
+"""
+
+import random
+from array import array
+from arraymodel import walk
+
+CODE_BITS = 64
+
+# The rolling hash, for orders whose exact codes don't fit in CODE_BITS.
+HASH_PRIME = (1 << 61) - 1
+HASH_BASE = 1000003
+
+
+class CharModel(object):
+
+  def __init__(self, order, alphabet):
+    self.order = order
+    self.alphabet = alphabet
+    self.ids = dict((char, i) for i, char in enumerate(alphabet))
+    self.bits = max(1, (len(alphabet) - 1).bit_length())
+    self.hashed = self.bits * order > CODE_BITS
+
+    if len(alphabet) > 1 << 16:
+      typecode = 'I'
+    else:
+      typecode = 'H'
+    self.offsets = array('I', [0])
+    self.successors = array(typecode)
+    self.cumulative = array('I')
+    self.next_rows = array('i')
+    self.heads = []
+    self.head_rows = array('I')
+
+  @classmethod
+  def build(cls, texts, order):
+    """Build a model from raw strings, one chain per string.
+
+    Heads are the first order characters of each string, as with markov().
+    Strings of order characters or fewer are skipped.
+
+    Keyword arguments:
+    texts -- An iterable of strings.
+    order -- The order of the Markov model.
+
+    """
+    texts = [text for text in texts if len(text) > order]
+    alphabet = ''.join(sorted(set().union(*texts)))
+    model = cls(order, alphabet)
+    ids = model.ids
+    bits = model.bits
+    mask = (1 << (bits * order)) - 1
+    high = pow(HASH_BASE, order - 1, HASH_PRIME)
+
+    edges = {}
+    heads = {}
+    # A hash can't be unrolled, so remember the first id of each prefix.
+    firsts = {}
+    for text in texts:
+      codes = [ids[char] for char in text]
+      code = 0
+      for i in codes[:order]:
+        if model.hashed:
+          code = (code * HASH_BASE + i) % HASH_PRIME
+        else:
+          code = (code << bits) | i
+      heads.setdefault(text[:order], code)
+
+      # This loop runs once per character of input, so keep it tight.
+      if model.hashed:
+        for old, new in zip(codes, codes[order:]):
+          key = (code << bits) | new
+          edges[key] = edges.get(key, 0) + 1
+          firsts[code] = old
+          code = ((code - old * high) * HASH_BASE + new) % HASH_PRIME
+      else:
+        for new in codes[order:]:
+          key = (code << bits) | new
+          edges[key] = edges.get(key, 0) + 1
+          code = key & mask
+
+    model._freeze(edges, heads, firsts)
+    return model
+
+  def iter_text(self):
+    """Yield the characters of an endless text.
+
+    Each chain starts at a random head and runs until it reaches a prefix
+    with no successors; a space marks the start of the next one, as in
+    TweetList.generate_text.
+    """
+    while True:
+      i = int(random.random() * len(self.heads))
+      for char in self.heads[i]:
+        yield char
+      for char in walk(self, self.head_rows[i], self.alphabet):
+        yield char
+
+      # Mark the end of a sentence.
+      yield ' '
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def _freeze(self, edges, heads, firsts):
+    """Lay the edge counts out as sorted CSR rows, and link the rows up.
+
+    Keyword arguments:
+    edges -- A dict mapping (prefix code << bits | successor id) to counts.
+    heads -- A dict mapping head strings to their codes, in first seen order.
+    firsts -- For hashed codes, a dict mapping each to its first id.
+
+    """
+    bits = self.bits
+    id_mask = (1 << bits) - 1
+    rows = {}
+    last = None
+    running = 0
+    for key in sorted(edges):
+      prefix = key >> bits
+      if prefix != last:
+        if last is not None:
+          self.offsets.append(len(self.successors))
+        rows[prefix] = len(rows)
+        last = prefix
+        running = 0
+
+      running += edges[key]
+      self.successors.append(key & id_mask)
+      self.cumulative.append(running)
+
+    if last is not None:
+      self.offsets.append(len(self.successors))
+
+    # Each edge leads to the prefix that drops its row's first id and
+    # appends its own. Rows come out of the dict in the order they were laid
+    # out, so next_rows lines up with the edges.
+    code_mask = (1 << (bits * self.order)) - 1
+    high = pow(HASH_BASE, self.order - 1, HASH_PRIME)
+    for prefix, row in rows.items():
+      for edge in range(self.offsets[row], self.offsets[row + 1]):
+        new = self.successors[edge]
+        if self.hashed:
+          following = ((prefix - firsts[prefix] * high) * HASH_BASE + new) % HASH_PRIME
+        else:
+          following = ((prefix << bits) | new) & code_mask
+        self.next_rows.append(rows.get(following, -1))
+
+    for head, code in heads.items():
+      self.heads.append(head)
+      self.head_rows.append(rows[code])
@@ -0,0 +1,235 @@
+"""Concurrent page fetching for many accounts at once.
+
+  Fetching one page at a time for one user per process leaves us waiting on
+  round trips. This module fetches the pages of many usernames concurrently
+  on one asyncio loop:
+
+    ConnectionPool -- keeps HTTP/1.1 connections open and reuses them.
+    RateLimit      -- a token bucket, one per host.
+    Fetcher        -- ties both together under a global concurrency limit.
+
+  fetch_users() is the entry point: it walks the pages of every username
+  until one comes back empty, and returns what parse found on each of them.
+  Everything is plain HTTP GETs against a base URL, so it can be pointed at a
+  local stand-in server just as well as at the real thing.
+
+"""
+
+import asyncio, ssl, time
+from urllib.parse import urlsplit
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+class HTTPError(Exception):
+  def __init__(self, url, code):
+    self.url = url
+    self.code = code
+  def __str__(self):
+    return '%s returned HTTP %d' % (self.url, self.code)
+
+
+class RateLimit(object):
+  """Allows at most rate requests per period seconds, in bursts of up to rate."""
+
+  def __init__(self, rate, period=1.0):
+    self.rate = rate
+    self.period = period
+    self.tokens = float(rate)
+    self.updated = time.monotonic()
+    self.lock = asyncio.Lock()
+
+  async def acquire(self):
+    async with self.lock:
+      while True:
+        now = time.monotonic()
+        self.tokens = min(self.rate,
+            self.tokens + (now - self.updated) * self.rate / self.period)
+        self.updated = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        await asyncio.sleep((1 - self.tokens) * self.period / self.rate)
+
+
+class ConnectionPool(object):
+  """Reuses keep-alive connections, per scheme, host and port."""
+
+  def __init__(self):
+    self.idle = {}
+
+  async def get(self, url, headers=None):
+    """GET url and return (status, headers, body).
+
+    Keyword arguments:
+    url -- An http or https URL.
+    headers -- If specified, a dict of extra request headers.
+
+    """
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.hostname,
+        parts.port or DEFAULT_PORTS[parts.scheme])
+    path = parts.path or '/'
+    if parts.query:
+      path += '?' + parts.query
+
+    lines = ['GET %s HTTP/1.1' % path, 'Host: %s' % parts.netloc,
+        'Connection: keep-alive']
+    for name, value in (headers or {}).items():
+      lines.append('%s: %s' % (name, value))
+    request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    while True:
+      reused = bool(self.idle.get(key))
+      reader, writer = await self._connect(key)
+      try:
+        writer.write(request)
+        await writer.drain()
+        status, response_headers, body, keep = await self._read(reader)
+      except (ConnectionError, asyncio.IncompleteReadError):
+        writer.close()
+        # The server may have dropped an idle connection; try a fresh one.
+        if reused:
+          continue
+        raise
+
+      if keep:
+        self.idle.setdefault(key, []).append((reader, writer))
+      else:
+        writer.close()
+      return status, response_headers, body
+
+  def close(self):
+    for connections in self.idle.values():
+      for reader, writer in connections:
+        writer.close()
+    self.idle = {}
+
+  async def _connect(self, key):
+    if self.idle.get(key):
+      return self.idle[key].pop()
+
+    scheme, host, port = key
+    if scheme == 'https':
+      return await asyncio.open_connection(host, port,
+          ssl=ssl.create_default_context())
+    return await asyncio.open_connection(host, port)
+
+  async def _read(self, reader):
+    status_line = await reader.readline()
+    if not status_line:
+      raise asyncio.IncompleteReadError(b'', None)
+    version, status = status_line.split(None, 2)[:2]
+
+    headers = {}
+    while True:
+      line = await reader.readline()
+      if line in (b'\r\n', b'\n', b''):
+        break
+      name, value = line.decode('latin-1').split(':', 1)
+      headers[name.strip().lower()] = value.strip()
+
+    keep = version == b'HTTP/1.1' and headers.get('connection') != 'close'
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+      chunks = []
+      while True:
+        size = int((await reader.readline()).split(b';')[0], 16)
+        if not size:
+          await reader.readline()
+          break
+        chunks.append(await reader.readexactly(size))
+        await reader.readline()
+      body = b''.join(chunks)
+    elif 'content-length' in headers:
+      body = await reader.readexactly(int(headers['content-length']))
+    else:
+      body = await reader.read()
+      keep = False
+
+    return int(status), headers, body, keep
+
+
+class Fetcher(object):
+  """Fetches pages through a shared pool, within the concurrency and rate limits.
+
+  Keyword arguments:
+  concurrency -- The most requests in flight at once, across all hosts.
+  rate -- If specified, the most requests per period to any one host.
+  period -- The rate limit window, in seconds.
+  headers -- If specified, a dict of headers to send with every request.
+
+  """
+
+  def __init__(self, concurrency=16, rate=None, period=1.0, headers=None):
+    self.pool = ConnectionPool()
+    self.slots = asyncio.Semaphore(concurrency)
+    self.rate = rate
+    self.period = period
+    self.headers = headers
+    self.limits = {}
+
+  async def get(self, url):
+    if self.rate:
+      host = urlsplit(url).hostname
+      if host not in self.limits:
+        self.limits[host] = RateLimit(self.rate, self.period)
+      await self.limits[host].acquire()
+
+    async with self.slots:
+      status, headers, body = await self.pool.get(url, self.headers)
+    # A redirect's body is no page of ours, so anything but 2xx is an error.
+    if not 200 <= status < 300:
+      raise HTTPError(url, status)
+    return body
+
+  def close(self):
+    self.pool.close()
+
+
+async def fetch_pages(fetcher, url, parse, lookahead=1):
+  """Fetch url + '1', url + '2', ... until a page parses to nothing.
+
+  Keyword arguments:
+  fetcher -- A Fetcher.
+  url -- The page URL, up to the page number.
+  parse -- Turns a page body into a list of items.
+  lookahead -- How many pages of one user to request at once.
+
+  """
+  items = []
+  page = 1
+  while True:
+    bodies = await asyncio.gather(*[fetcher.get(url + str(page + i))
+        for i in range(lookahead)])
+    for body in bodies:
+      found = parse(body)
+      if not found:
+        return items
+      items.extend(found)
+    page += lookahead
+
+async def fetch_many(usernames, url_for, parse, lookahead=1, **limits):
+  fetcher = Fetcher(**limits)
+  try:
+    results = await asyncio.gather(*[fetch_pages(fetcher, url_for(username),
+        parse, lookahead) for username in usernames], return_exceptions=True)
+  finally:
+    fetcher.close()
+  return dict(zip(usernames, results))
+
+def fetch_users(usernames, url_for, parse, lookahead=1, **limits):
+  """Fetch every page of every username concurrently.
+
+  Returns a dict mapping each username to the items parsed from their pages,
+  or to the exception that stopped their fetch, so one bad account doesn't
+  sink the rest.
+
+  Keyword arguments:
+  usernames -- The usernames to fetch.
+  url_for -- Maps a username to its page URL, up to the page number.
+  parse -- Turns a page body into a list of items.
+  lookahead -- How many pages of one user to request at once.
+  limits -- concurrency, rate, period and headers, as for Fetcher.
+
+  """
+  return asyncio.run(fetch_many(usernames, url_for, parse, lookahead, **limits))
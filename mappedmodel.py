@@ -0,0 +1,269 @@
+"""A binary model format that is sampled straight off the disk.
+
+  A pickled TweetList or MarkovTable has to be unpickled into every process
+  that uses it, so sixteen workers hold sixteen copies of the same model. A
+  mapped model is written once and then mmap'ed read-only: nothing is
+  deserialized, opening one takes the same time whatever its size, and every
+  process maps the same pages of the OS page cache.
+
+  The file is a fixed header followed by the arrays of an ArrayModel, all of
+  them little-endian 32-bit integers starting on 8-byte boundaries:
+
+    header         -- HEADER, below: magic, version, flags, order and the
+                      length of every section.
+    vocab_offsets  -- token i is blob[vocab_offsets[i]:vocab_offsets[i+1]].
+    vocab_order    -- the token ids, sorted by their UTF-8 bytes.
+    prefixes       -- the order token ids of each row, back to back.
+    offsets        -- row i owns edges offsets[i] up to offsets[i+1].
+    successors     -- the token id each edge leads to.
+    cumulative     -- running count of the edges within their row.
+    next_rows      -- the row each edge leads to, or -1 where the chain ends;
+                      the only signed section.
+    head_rows      -- the row of each head.
+    tails          -- the order token ids of each tail, sorted.
+    blob           -- the tokens, UTF-8 encoded, back to back.
+
+  Rows are sorted by prefix ids just like an ArrayModel's, and tokens and
+  tails are sorted too, so every lookup is a binary search over fixed-width
+  entries rather than a dict. A MappedModel has the same interface as the
+  ArrayModel it was saved from, and iter_text() walks it like a CharModel,
+  following next_rows without looking any prefix up (see arraymodel.walk).
+
+"""
+
+import os, sys, mmap, random, struct
+from array import array
+from arraymodel import Row, HeadView, TailView, search, walk
+
+MAGIC = b'TWMM'
+
+# Bump this whenever the layout changes; older files are then refused.
+FORMAT_VERSION = 1
+
+# magic, version, flags, order, then the number of tokens, blob bytes, rows,
+# edges, heads and tails.
+HEADER = struct.Struct('<4sIII6Q')
+
+# Set in the flags of models over letters rather than words.
+LETTERS = 1
+
+
+def save_mapped(model, path, split_words=False):
+  """Write model to path in the mapped format.
+
+  The file is written next to path and renamed into place, so processes that
+  have the old file mapped keep reading it undisturbed.
+
+  Keyword arguments:
+  model -- An ArrayModel.
+  path -- Where to write it.
+  split_words -- If true, the model is over letters rather than words.
+
+  """
+  order = model.order
+  tokens = [token.encode('utf-8') for token in model.vocab]
+  vocab_offsets = array('I', [0])
+  for token in tokens:
+    vocab_offsets.append(vocab_offsets[-1] + len(token))
+  vocab_order = array('I', sorted(range(len(tokens)), key=tokens.__getitem__))
+
+  # Copies, as they may be byteswapped below.
+  sections = [vocab_offsets, vocab_order, array('I', model.prefixes),
+      array('I', model.offsets), array('I', model.successors),
+      array('I', model.cumulative), array('i', model.next_rows),
+      array('I', model.head_rows), array('I', model.tail_ids)]
+
+  flags = 0
+  if split_words:
+    flags |= LETTERS
+  header = HEADER.pack(MAGIC, FORMAT_VERSION, flags, order, len(tokens),
+      vocab_offsets[-1], len(model), len(model.successors),
+      len(model.head_rows), len(model.tail_ids) // order)
+
+  temporary = '%s.%d.tmp' % (path, os.getpid())
+  with open(temporary, 'wb') as f:
+    f.write(header)
+    for section in sections:
+      if sys.byteorder != 'little':
+        section.byteswap()
+      f.write(section.tobytes())
+      f.write(b'\0' * (-f.tell() % 8))
+    for token in tokens:
+      f.write(token)
+  os.replace(temporary, path)
+
+
+class Vocab(object):
+  """The tokens of a mapped model, decoded one at a time as they're needed."""
+
+  def __init__(self, blob, offsets, order):
+    self.blob = blob
+    self.offsets = offsets
+    self.order = order
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, i):
+    return self.raw(i).decode('utf-8')
+
+  def raw(self, i):
+    return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]])
+
+  def index(self, token):
+    """Return the id of token, or None if the model never saw it."""
+    raw = token.encode('utf-8')
+    lo = 0
+    hi = len(self.order)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self.raw(self.order[mid]) < raw:
+        lo = mid + 1
+      else:
+        hi = mid
+    if lo < len(self.order) and self.raw(self.order[lo]) == raw:
+      return self.order[lo]
+    return None
+
+
+class MappedModel(object):
+  """A model saved by save_mapped(), mapped read-only.
+
+  Keyword arguments:
+  path -- The file to map.
+
+  """
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'rb') as f:
+      self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if len(self.map) < HEADER.size:
+      raise ValueError('%s is not a mapped model.' % path)
+    (magic, version, flags, order, tokens, blob, rows, edges, heads,
+        tails) = HEADER.unpack_from(self.map)
+    if magic != MAGIC:
+      raise ValueError('%s is not a mapped model.' % path)
+    if version != FORMAT_VERSION:
+      raise ValueError('%s is in format %d; this version reads format %d.'
+          % (path, version, FORMAT_VERSION))
+
+    self.order = order
+    self.split_words = bool(flags & LETTERS)
+    self._view = memoryview(self.map)
+    self._position = HEADER.size
+
+    vocab_offsets = self._section(tokens + 1)
+    vocab_order = self._section(tokens)
+    self.prefixes = self._section(rows * order)
+    self.offsets = self._section(rows + 1)
+    self.successors = self._section(edges)
+    self.cumulative = self._section(edges)
+    self.next_rows = self._section(edges, 'i')
+    self.head_rows = self._section(heads)
+    self.tail_ids = self._section(tails * order)
+    self.vocab = Vocab(self._view[self._position:self._position + blob],
+        vocab_offsets, vocab_order)
+
+  def _section(self, count, typecode='I'):
+    """Return the next count integers of the file, without copying them."""
+    start = self._position
+    end = start + 4 * count
+    self._position = end + (-end % 8)
+    if sys.byteorder == 'little':
+      return self._view[start:end].cast(typecode)
+
+    # There's no zero-copy view of little-endian data on this machine.
+    section = array(typecode, self.map[start:end])
+    section.byteswap()
+    return section
+
+  @property
+  def heads(self):
+    return HeadView(self)
+
+  @property
+  def tails(self):
+    return TailView(self)
+
+  def key(self, tokens):
+    """Return the list of ids of a tuple of tokens, or None if one is unseen."""
+    ids = []
+    for token in tokens:
+      i = self.vocab.index(token)
+      if i is None:
+        return None
+      ids.append(i)
+    return ids
+
+  def prefix(self, row):
+    """Return the prefix tuple for a row."""
+    start = row * self.order
+    return tuple(self.vocab[i] for i in self.prefixes[start:start + self.order])
+
+  def get(self, prefix, default=None):
+    if len(prefix) != self.order:
+      return default
+    ids = self.key(prefix)
+    if ids is None:
+      return default
+    row = search(self.prefixes, self.order, ids)
+    if row < 0:
+      return default
+    return Row(self, row)
+
+  def items(self):
+    for row in range(len(self)):
+      yield self.prefix(row), Row(self, row)
+
+  def iter_text(self):
+    """Yield the tokens of an endless text, as TweetList.iter_tokens does.
+
+    Each chain starts at a random head and runs until it reaches a prefix
+    with no successors. Over letters, a space marks the start of the next.
+    """
+    while True:
+      row = self.head_rows[int(random.random() * len(self.head_rows))]
+      for token in self.prefix(row):
+        yield token
+      for token in walk(self, row, self.vocab):
+        yield token
+
+      # Mark the end of a sentence.
+      if self.split_words:
+        yield ' '
+
+  def close(self):
+    """Unmap the file. The model can't be used afterwards."""
+    for section in (self.prefixes, self.offsets, self.successors,
+        self.cumulative, self.next_rows, self.head_rows, self.tail_ids, self.vocab.offsets,
+        self.vocab.order, self.vocab.blob):
+      if isinstance(section, memoryview):
+        section.release()
+    self._view.release()
+    self.map.close()
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __iter__(self):
+    for row in range(len(self)):
+      yield self.prefix(row)
+
+  def __contains__(self, prefix):
+    return self.get(prefix) is not None
+
+  def __getitem__(self, prefix):
+    row = self.get(prefix)
+    if row is None:
+      raise KeyError(prefix)
+    return row
+
+  # Only the path goes into a pickle, so handing a mapped model to a worker
+  # process costs nothing; the worker maps the file itself.
+  def __getstate__(self):
+    return self.path
+
+  def __setstate__(self, path):
+    self.__init__(path)
@@ -0,0 +1,54 @@
+"""Builds models from large corpora on every core.
+
+  Counting transitions is embarrassingly parallel: every tweet contributes
+  its n-grams independently, and the counts of separate shards simply add up.
+  map_reduce() splits a corpus into shards, builds a partial model of each
+  shard in a worker process, and hands the partials to a merge function that
+  sums them. Since the merge is associative, the result is exactly the model
+  a serial build over the whole corpus would have produced.
+
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# Below this many items per worker, process startup costs more than it saves.
+MIN_SHARD = 500
+
+
+def shard(items, count):
+  """Split the list items into at most count contiguous, near-equal shards."""
+  count = max(1, min(count, len(items)))
+  size, extra = divmod(len(items), count)
+  shards = []
+  start = 0
+  for i in range(count):
+    end = start + size + (i < extra)
+    shards.append(items[start:end])
+    start = end
+  return shards
+
+def map_reduce(items, build, merge, workers=1):
+  """Build partial models of shards of items in parallel, then merge them.
+
+  Keyword arguments:
+  items -- The corpus, e.g. a list of tweets.
+  build -- Builds a partial model from a list of items. It runs in a worker
+           process, so it must be picklable: a module-level function, or a
+           functools.partial of one.
+  merge -- Combines a list of partial models into one.
+  workers -- How many processes to use. None means one per CPU; 1 builds in
+             this process.
+
+  """
+  items = list(items)
+  if workers is None:
+    workers = os.cpu_count() or 1
+  workers = min(workers, len(items) // MIN_SHARD)
+
+  if workers <= 1:
+    return build(items)
+
+  with ProcessPoolExecutor(workers) as pool:
+    partials = list(pool.map(build, shard(items, workers)))
+  return merge(partials)
@@ -0,0 +1,124 @@
+"""Phase timers, counters and peak memory for both scripts.
+
+  Everything that takes real time is wrapped in a named phase, and anything
+  worth counting bumps a named counter:
+
+    with phase('fetch'):
+      ...
+    count('pages_fetched')
+
+  Phases record how often they ran and their total wall clock and CPU time.
+  They can nest; each records its own total, inner phases included. The
+  phases and counters the scripts use are:
+
+    cache_load, fetch, parse, build, chainify, prune, index, generate,
+    cache_save
+    pages_fetched, tweets_fetched, tweets_ingested, states, transitions,
+    pruned_states, pruned_transitions, pruned_bytes, restarts, seed_retries,
+    bounded_retries, and the cache_ counters of cachemanager.py
+
+  Both cost a dict update and, for phases, two clock reads, so they stay on
+  all the time. Peak memory needs tracemalloc, which slows every allocation
+  down, so it is only tracked between track_memory() and report().
+
+  Hooks see every measurement as it's made, to forward them to a monitoring
+  system. A hook is called as hook(kind, name, value): kind is 'phase', with
+  value a (wall, cpu) pair of seconds, or 'count', with value the increment.
+
+  The --profile flag of twittov.py and twittov2.py prints report() as JSON to
+  stderr once the text is out.
+
+"""
+
+import sys, json, time, tracemalloc
+from contextlib import contextmanager
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+
+class Metrics(object):
+
+  def __init__(self):
+    self.phases = {}
+    self.counters = {}
+    self.hooks = []
+
+  @contextmanager
+  def phase(self, name):
+    """Time the body of a with statement as the phase name."""
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+      yield
+    finally:
+      wall = time.perf_counter() - wall
+      cpu = time.process_time() - cpu
+      totals = self.phases.get(name)
+      if totals is None:
+        totals = self.phases[name] = {'calls': 0, 'wall': 0.0, 'cpu': 0.0}
+      totals['calls'] += 1
+      totals['wall'] += wall
+      totals['cpu'] += cpu
+      for hook in self.hooks:
+        hook('phase', name, (wall, cpu))
+
+  def count(self, name, n=1):
+    """Add n to the counter name."""
+    self.counters[name] = self.counters.get(name, 0) + n
+    for hook in self.hooks:
+      hook('count', name, n)
+
+  def add_hook(self, hook):
+    self.hooks.append(hook)
+
+  def remove_hook(self, hook):
+    self.hooks.remove(hook)
+
+  def track_memory(self):
+    """Start tracing allocations, so report() can include their peak."""
+    if not tracemalloc.is_tracing():
+      tracemalloc.start()
+
+  def report(self):
+    """Return everything measured so far as a dict, ready for JSON."""
+    report = {
+      'phases': dict((name, dict(totals)) for name, totals in self.phases.items()),
+      'counters': dict(self.counters),
+    }
+    if tracemalloc.is_tracing():
+      report['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1]
+    if resource is not None:
+      # ru_maxrss is in kilobytes on Linux, but in bytes on macOS.
+      scale = 1 if sys.platform == 'darwin' else 1024
+      report['max_rss_bytes'] = resource.getrusage(
+          resource.RUSAGE_SELF).ru_maxrss * scale
+    return report
+
+  def write(self, out=None):
+    """Write report() to out, by default stderr, as one line of JSON."""
+    if out is None:
+      out = sys.stderr
+    out.write(json.dumps(self.report(), sort_keys=True) + '\n')
+
+  def reset(self):
+    """Forget every phase and counter, but keep the hooks."""
+    self.phases.clear()
+    self.counters.clear()
+    if tracemalloc.is_tracing():
+      tracemalloc.reset_peak()
+
+
+# The instance the scripts record into.
+METRICS = Metrics()
+
+phase = METRICS.phase
+count = METRICS.count
+add_hook = METRICS.add_hook
+remove_hook = METRICS.remove_hook
+track_memory = METRICS.track_memory
+report = METRICS.report
+write = METRICS.write
+reset = METRICS.reset
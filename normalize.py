@@ -0,0 +1,132 @@
+"""One tokenizer for both engines, run once per tweet.
+
+  twittov.py used to split tweets on whitespace and twittov2.py split them
+  and glued stray '@'s back on, each again for every model it built. Now
+  tokenize() is the only place tweets are turned into words:
+
+    whitespace -- any run of it separates two tokens.
+    RT         -- a leading "RT", and the "@someone:" after it, are dropped.
+    mentions   -- a lone '@' (or run of them) is glued onto the next word, so
+                  "@ someone" comes out as "@someone". A trailing '@' is
+                  dropped.
+    URLs       -- anything starting with http://, https:// or www. is dropped;
+                  no chain ever says anything interesting through one.
+
+  A TokenStream keeps the tokens of a whole timeline as ids into one flat
+  array. It is built when tweets are fetched and pickled into the cache next
+  to them, and the models of both engines are built from it.
+
+"""
+
+import re
+from array import array
+
+URL = re.compile(r'(?:https?://|www\.)', re.IGNORECASE)
+
+
+def tokenize(text):
+  """Split one tweet into normalized tokens.
+
+  For example:
+  >>> tokenize('RT @someone: look @ me  http://t.co/x now')
+  ['look', '@me', 'now']
+
+  """
+  words = text.split()
+  if words and words[0] == 'RT':
+    del words[0]
+    if words and words[0].startswith('@') and words[0].endswith(':'):
+      del words[0]
+
+  tokens = []
+  at = ''
+  for word in words:
+    if word == '@':
+      at += '@'
+      continue
+    word = at + word
+    at = ''
+    if not URL.match(word):
+      tokens.append(word)
+  return tokens
+
+
+class TokenStream(object):
+  """The normalized tokens of many tweets, as ids into a shared vocabulary.
+
+  Tweet i owns the ids stream[offsets[i]:offsets[i+1]], so a stream of a
+  few thousand tweets is one array of 4-byte ids rather than a list of
+  lists of strings.
+
+  Keyword arguments:
+  tweets -- If specified, raw tweets to tokenize and add.
+
+  """
+
+  def __init__(self, tweets=()):
+    self.vocab = []
+    self.ids = {}
+    self.stream = array('I')
+    self.offsets = array('I', [0])
+    self.extend(tweets)
+
+  def add(self, tweet):
+    """Tokenize a raw tweet and add it."""
+    self.add_tokens(tokenize(tweet))
+
+  def add_tokens(self, tokens):
+    """Add a tweet that is already a list of normalized tokens."""
+    ids = self.ids
+    vocab = self.vocab
+    for token in tokens:
+      i = ids.get(token)
+      if i is None:
+        i = ids[token] = len(vocab)
+        vocab.append(token)
+      self.stream.append(i)
+    self.offsets.append(len(self.stream))
+
+  def extend(self, tweets):
+    for tweet in tweets:
+      self.add(tweet)
+
+  def merge(self, other):
+    """Add every tweet of another TokenStream, re-interning its ids."""
+    for tokens in other:
+      self.add_tokens(tokens)
+
+  def id_sequences(self, start=0):
+    """Yield each tweet from index start on as an array of ids."""
+    stream = self.stream
+    offsets = self.offsets
+    for i in range(start, len(offsets) - 1):
+      yield stream[offsets[i]:offsets[i + 1]]
+
+  def sequences(self, start=0):
+    """Yield each tweet from index start on as a list of tokens."""
+    vocab = self.vocab
+    for ids in self.id_sequences(start):
+      yield [vocab[i] for i in ids]
+
+  def texts(self, start=0):
+    """Yield each tweet from index start on as normalized text."""
+    for tokens in self.sequences(start):
+      yield ' '.join(tokens)
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __iter__(self):
+    return self.sequences()
+
+  # The ids are just the vocabulary inverted; don't pickle them twice.
+  def __getstate__(self):
+    return (self.vocab, self.stream, self.offsets)
+
+  def __setstate__(self, state):
+    self.vocab, self.stream, self.offsets = state
+    # Streams pickled before ids were 4 bytes held them in 'L' arrays.
+    if self.stream.typecode != 'I':
+      self.stream = array('I', self.stream)
+      self.offsets = array('I', self.offsets)
+    self.ids = dict((token, i) for i, token in enumerate(self.vocab))
@@ -0,0 +1,82 @@
+"""Opening one cache from many processes at once.
+
+  Run with python -m unittest discover tests, or with pytest.
+
+"""
+
+import os, sys, pickle, shutil, tempfile, unittest, multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cachestore import CacheStore, is_pickle
+
+PROCESSES = 8
+TRIALS = 10
+
+
+def _open_and_store(path, barrier, i):
+  """Open the cache at path together with the other processes, and store an
+  entry of our own. Returns an error message, or None."""
+  barrier.wait()
+  try:
+    store = CacheStore(path, 'test')
+    store['user%d' % i] = {'tweets': ['hello', str(i)]}
+    store.close()
+  except Exception as e:
+    return '%s: %s' % (type(e).__name__, e)
+  return None
+
+def _open_all(path):
+  """Have PROCESSES processes open the cache at path at the same moment."""
+  barrier = multiprocessing.Manager().Barrier(PROCESSES)
+  with multiprocessing.Pool(PROCESSES) as pool:
+    return pool.starmap(_open_and_store, [(path, barrier, i)
+        for i in range(PROCESSES)])
+
+
+class ConcurrentOpenTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix='twittov-test-')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory, ignore_errors=True)
+
+  def test_fresh_cache(self):
+    for trial in range(TRIALS):
+      path = os.path.join(self.directory, 'fresh%d.cache' % trial)
+      self.assertEqual(_open_all(path), [None] * PROCESSES)
+      self.assertFalse(os.path.exists(path + '.pickle'))
+
+      store = CacheStore(path, 'test')
+      self.assertEqual(len(store), PROCESSES)
+      store.close()
+
+  def test_old_pickle_cache(self):
+    for trial in range(TRIALS):
+      path = os.path.join(self.directory, 'old%d.cache' % trial)
+      with open(path, 'wb') as f:
+        pickle.dump({'old': {'tweets': ['from before']}}, f)
+
+      self.assertEqual(_open_all(path), [None] * PROCESSES)
+      self.assertTrue(os.path.exists(path + '.pickle'))
+
+      # Migrated exactly once, next to everyone's own entries.
+      store = CacheStore(path, 'test')
+      self.assertEqual(store['old'], {'tweets': ['from before']})
+      self.assertEqual(len(store), PROCESSES + 1)
+      self.assertEqual(store.db.execute("SELECT COUNT(*) FROM log WHERE name = "
+          "'old'").fetchone()[0], 1)
+      store.close()
+
+  def test_is_pickle(self):
+    path = os.path.join(self.directory, 'probe')
+    for data, expected in ((b'', False), (b'SQLite format 3\x00', False),
+        (b'SQLi', False), (pickle.dumps({}, 0), True), (pickle.dumps({}, 1),
+        True), (pickle.dumps({}), True)):
+      with open(path, 'wb') as f:
+        f.write(data)
+      self.assertEqual(is_pickle(path), expected, data)
+
+
+if __name__ == '__main__':
+  unittest.main()
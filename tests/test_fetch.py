@@ -0,0 +1,145 @@
+"""Fetching pages from a stand-in server running in this process.
+
+  Run with python -m unittest discover tests, or with pytest.
+
+"""
+
+import os, sys, time, threading, unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fetch import HTTPError, fetch_users
+
+# How many pages every user has; the next one is empty.
+PAGES = 3
+ITEMS = 4
+
+
+def items(user, page):
+  if page > PAGES:
+    return []
+  return ['%s-%d-%d' % (user, page, i) for i in range(ITEMS)]
+
+def parse(body):
+  return body.decode('utf-8').split()
+
+
+class Handler(BaseHTTPRequestHandler):
+  """Serves /USER?page=N. 'missing' is a 404, 'moved' redirects, and 'chunked'
+  is sent in chunks."""
+
+  protocol_version = 'HTTP/1.1'
+
+  def setup(self):
+    with self.server.lock:
+      self.server.connections += 1
+    BaseHTTPRequestHandler.setup(self)
+
+  def do_GET(self):
+    url = urlsplit(self.path)
+    user = url.path.strip('/')
+    page = int(parse_qs(url.query)['page'][0])
+    with self.server.lock:
+      self.server.requests.append(time.monotonic())
+
+    if user == 'missing':
+      self.send_response(404)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+    if user == 'moved':
+      # A body that would parse, were redirects taken for pages.
+      body = b'elsewhere'
+      self.send_response(302)
+      self.send_header('Location', '/alice?page=%d' % page)
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+      return
+
+    body = ' '.join(items(user, page)).encode('utf-8')
+    self.send_response(200)
+    if user == 'chunked':
+      self.send_header('Transfer-Encoding', 'chunked')
+      self.end_headers()
+      for i in range(0, len(body), 7):
+        chunk = body[i:i + 7]
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+      self.wfile.write(b'0\r\n\r\n')
+    else:
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+class FetchUsersTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    self.server.daemon_threads = True
+    self.server.lock = threading.Lock()
+    self.server.connections = 0
+    self.server.requests = []
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    self.base = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def fetch(self, usernames, **limits):
+    return fetch_users(usernames, lambda user: self.base + user + '?page=',
+        parse, **limits)
+
+  def expected(self, user):
+    return [item for page in range(1, PAGES + 1) for item in items(user, page)]
+
+  def test_every_page(self):
+    results = self.fetch(['alice', 'bob'])
+    self.assertEqual(results['alice'], self.expected('alice'))
+    self.assertEqual(results['bob'], self.expected('bob'))
+
+  def test_keep_alive(self):
+    # One request at a time goes over one connection, page after page.
+    results = self.fetch(['alice', 'bob'], concurrency=1)
+    self.assertEqual(results['bob'], self.expected('bob'))
+    self.assertEqual(len(self.server.requests), 2 * (PAGES + 1))
+    self.assertEqual(self.server.connections, 1)
+
+  def test_chunked(self):
+    results = self.fetch(['chunked'])
+    self.assertEqual(results['chunked'], self.expected('chunked'))
+
+  def test_rate_limit(self):
+    # Bursts of up to rate, then rate requests per period.
+    rate, period = 4, 0.2
+    start = time.monotonic()
+    results = self.fetch(['alice', 'bob', 'carol'], rate=rate, period=period)
+    elapsed = time.monotonic() - start
+
+    requests = 3 * (PAGES + 1)
+    self.assertEqual(len(self.server.requests), requests)
+    self.assertGreaterEqual(elapsed, (requests - rate) * period / rate * 0.9)
+    for user in ('alice', 'bob', 'carol'):
+      self.assertEqual(results[user], self.expected(user))
+
+  def test_user_errors(self):
+    # A user whose pages fail doesn't sink the others.
+    results = self.fetch(['alice', 'missing', 'bob'])
+    self.assertIsInstance(results['missing'], HTTPError)
+    self.assertEqual(results['missing'].code, 404)
+    self.assertEqual(results['alice'], self.expected('alice'))
+    self.assertEqual(results['bob'], self.expected('bob'))
+
+  def test_redirect(self):
+    results = self.fetch(['moved'])
+    self.assertIsInstance(results['moved'], HTTPError)
+    self.assertEqual(results['moved'].code, 302)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,350 @@
+"""Count-weighted Markov transitions with constant time sampling.
+
+  A Transitions object holds every suffix seen after one prefix together with
+  how often it was seen. Sampling uses Vose's alias method: the table is built
+  once, the first time the prefix is sampled, and each draw after that costs
+  two random numbers no matter how many suffixes there are.
+
+  For example:
+  >>> t = Transitions()
+  >>> t.add('cats'); t.add('cats'); t.add('bats')
+  >>> t
+  Transitions({'cats': 2, 'bats': 1})
+  >>> t.total
+  3
+
+"""
+
+import pickle, random
+from array import array
+
+# What branch_reach() gives prefixes from which a walk can branch forever.
+UNBOUNDED = 0xFFFFFFFF
+
+
+class Transitions(object):
+  __slots__ = ('counts', 'total', '_table')
+
+  def __init__(self, counts=None):
+    self.counts = {}
+    self.total = 0
+    self._table = None
+
+    if counts:
+      for suffix, count in counts.items():
+        self.add(suffix, count)
+
+  def add(self, suffix, count=1):
+    """Record count more occurrences of suffix.
+
+    Keyword arguments:
+    suffix -- The word or letter that followed the prefix.
+    count -- How many times it was seen.
+
+    """
+    self.counts[suffix] = self.counts.get(suffix, 0) + count
+    self.total += count
+    self._table = None
+
+  def discard(self, suffix):
+    """Forget suffix and all its occurrences, if it was ever seen."""
+    count = self.counts.pop(suffix, None)
+    if count is not None:
+      self.total -= count
+      self._table = None
+
+  def update(self, other, weight=1):
+    """Add every count of other, a Transitions or anything with items().
+
+    Keyword arguments:
+    other -- The transitions to add.
+    weight -- An integer to multiply other's counts by.
+
+    """
+    for suffix, count in other.items():
+      self.add(suffix, count * weight)
+
+  def sample(self):
+    """Pick a suffix at random, weighted by how often it was seen."""
+    if len(self.counts) == 1:
+      for suffix in self.counts:
+        return suffix
+
+    if self._table is None:
+      self._table = self._build_table()
+    suffixes, probabilities, aliases = self._table
+
+    i = int(random.random() * len(suffixes))
+    if random.random() < probabilities[i]:
+      return suffixes[i]
+    return suffixes[aliases[i]]
+
+  def items(self):
+    return self.counts.items()
+
+  def __len__(self):
+    return len(self.counts)
+
+  def __iter__(self):
+    return iter(self.counts)
+
+  def __contains__(self, suffix):
+    return suffix in self.counts
+
+  def __eq__(self, other):
+    return isinstance(other, Transitions) and self.counts == other.counts
+
+  def __repr__(self):
+    return 'Transitions(%r)' % (self.counts,)
+
+  # The alias table is cheap to rebuild, so don't bloat the cache with it.
+  def __getstate__(self):
+    return (self.counts, self.total)
+
+  def __setstate__(self, state):
+    self.counts, self.total = state
+    self._table = None
+
+  def _build_table(self):
+    """Build the alias table for Vose's method."""
+    suffixes = list(self.counts)
+    n = len(suffixes)
+    probabilities = [self.counts[suffix] * n / float(self.total)
+        for suffix in suffixes]
+    aliases = [0] * n
+
+    small = [i for i in range(n) if probabilities[i] < 1.0]
+    large = [i for i in range(n) if probabilities[i] >= 1.0]
+
+    while small and large:
+      less = small.pop()
+      more = large.pop()
+      aliases[less] = more
+      probabilities[more] -= 1.0 - probabilities[less]
+      if probabilities[more] < 1.0:
+        small.append(more)
+      else:
+        large.append(more)
+
+    # Whatever is left over is only off by rounding error.
+    for i in small + large:
+      probabilities[i] = 1.0
+
+    return suffixes, probabilities, aliases
+
+
+def merge_chains(chains, weights=None):
+  """Sum dicts of prefix -> Transitions into a new dict, leaving them intact.
+
+  Merging is associative and order-independent, so partial chains built from
+  separate shards of a corpus merge into exactly the chains of the whole.
+
+  Keyword arguments:
+  chains -- A sequence of dicts (or ArrayModels) mapping prefixes to
+            Transitions.
+  weights -- If specified, one positive integer per dict to scale its counts
+             by, e.g. to blend several accounts unevenly.
+
+  """
+  if weights is None:
+    weights = [1] * len(chains)
+  if len(weights) != len(chains):
+    raise ValueError('Need one weight per model.')
+  for weight in weights:
+    if not isinstance(weight, int) or weight <= 0:
+      raise ValueError('Weights must be positive integers.')
+
+  merged = {}
+  for partial, weight in zip(chains, weights):
+    for prefix, transitions in partial.items():
+      if prefix not in merged:
+        merged[prefix] = Transitions()
+      merged[prefix].update(transitions, weight)
+  return merged
+
+def prune_chains(chains, min_count=1, top_k=None, ends=None):
+  """Return a smaller copy of chains, leaving them intact.
+
+  Rare suffixes mostly replay a single tweet word for word, so dropping them
+  costs little variety. Prefixes left with no suffixes are dropped too.
+  >>> chains = {('a', 'b'): Transitions({'c': 3, 'd': 1}),
+  ...     ('b', 'd'): Transitions({'e': 1}), ('b', 'c'): Transitions({'a': 2})}
+  >>> sorted(prune_chains(chains, min_count=2).items())
+  [(('a', 'b'), Transitions({'c': 3})), (('b', 'c'), Transitions({'a': 2}))]
+
+  Given ends, walks are cut where they branched off toward a prefix that
+  leads nowhere, rather than left to run into it. Here ('b', 'c') leads to
+  ('c', 'a'), which isn't in the chains, so it can stay only if ('c', 'a') is
+  a place to stop:
+  >>> sorted(prune_chains(chains, min_count=2, ends=[('c', 'a')]))
+  [('a', 'b'), ('b', 'c')]
+  >>> prune_chains(chains, min_count=2, ends=[])
+  {}
+
+  Keyword arguments:
+  chains -- A dict (or ArrayModel) mapping tuples of prefixes to Transitions.
+  min_count -- Drop the suffixes seen fewer times than this after a prefix.
+  top_k -- If specified, keep only the k most frequent suffixes of a prefix.
+  ends -- If specified, also drop dead ends. These are suffixes leading to a
+          prefix that has no suffixes left and isn't one of ends, where a
+          text may stop. Dropping them can leave more prefixes empty, so this
+          repeats until no dead end is left.
+
+  """
+  pruned = {}
+  for prefix, transitions in chains.items():
+    kept = [(suffix, count) for suffix, count in transitions.items()
+        if count >= min_count]
+    if top_k is not None and len(kept) > top_k:
+      # Ties go to the suffix seen first.
+      kept = sorted(kept, key=lambda item: -item[1])[:top_k]
+    if kept:
+      pruned[prefix] = Transitions(dict(kept))
+
+  if ends is None:
+    return pruned
+
+  ends = set(ends)
+  callers = {}
+  for prefix, transitions in pruned.items():
+    for suffix in transitions:
+      callers.setdefault(prefix[1:] + (suffix,), []).append(prefix)
+
+  dead = [state for state in callers if state not in pruned and state not in ends]
+  while dead:
+    state = dead.pop()
+    for prefix in callers.get(state, ()):
+      transitions = pruned.get(prefix)
+      if transitions is None:
+        continue
+      transitions.discard(state[-1])
+      if not transitions:
+        del pruned[prefix]
+        if prefix not in ends:
+          dead.append(prefix)
+  return pruned
+
+def chain_stats(chains, size=False):
+  """Return (prefixes, transitions, bytes) for chains.
+
+  bytes is the size chains pickle to, as in the cache, or None unless size is
+  true, as pickling a large model takes a while. For an ArrayModel or a
+  MappedModel, which pickles to a path, it is the size of its arrays and
+  tokens instead, as in the mapped format.
+  """
+  if hasattr(chains, 'next_rows'):
+    transitions = len(chains.successors)
+  else:
+    transitions = sum([len(suffixes) for prefix, suffixes in chains.items()])
+  if not size:
+    return len(chains), transitions, None
+
+  if hasattr(chains, 'next_rows'):
+    sections = (chains.prefixes, chains.offsets, chains.successors,
+        chains.cumulative, chains.next_rows, chains.head_rows, chains.tail_ids)
+    # Every token also has an offset and a place in the sorted order.
+    return len(chains), transitions, sum([len(section) * section.itemsize
+        for section in sections]) + sum([len(chains.vocab[i].encode('utf-8')) + 8
+        for i in range(len(chains.vocab))])
+  return len(chains), transitions, len(pickle.dumps(chains,
+      pickle.HIGHEST_PROTOCOL))
+
+def branch_reach(chains):
+  """Return the most branches a walk from each prefix of chains can pass.
+
+  A prefix's branching is its total count less one, and a walk passes the
+  branching of every prefix it visits. The result is an array('I') in the
+  order chains iterate, with UNBOUNDED for prefixes that can reach a loop
+  through a prefix that branches:
+  >>> chains = {('a', 'b'): Transitions({'c': 2, 'd': 1}),
+  ...     ('b', 'c'): Transitions({'e': 1}), ('b', 'd'): Transitions({'a': 3}),
+  ...     ('d', 'a'): Transitions({'b': 1}), ('c', 'e'): Transitions({'e': 1})}
+  >>> [reach == UNBOUNDED or reach for reach in branch_reach(chains)]
+  [True, 0, True, True, 0]
+
+  The loops are found as strongly connected components, in one pass over the
+  edges, so this takes time linear in the size of chains.
+
+  Keyword arguments:
+  chains -- A dict (or ArrayModel) mapping tuples of prefixes to Transitions.
+
+  """
+  branching = []
+  following = []
+  if hasattr(chains, 'next_rows'):
+    # The rows are linked already.
+    offsets = chains.offsets
+    for row in range(len(chains)):
+      branching.append(chains.cumulative[offsets[row + 1] - 1] - 1)
+      following.append([next_row for next_row in
+          chains.next_rows[offsets[row]:offsets[row + 1]] if next_row >= 0])
+  else:
+    ids = dict((prefix, i) for i, prefix in enumerate(chains))
+    for prefix, transitions in chains.items():
+      branching.append(transitions.total - 1)
+      following.append([ids[state] for state in (prefix[1:] + (suffix,)
+          for suffix in transitions) if state in ids])
+    del ids
+
+  # Tarjan's algorithm, without recursion. Components come out after every
+  # component they lead to, so those have their reach already.
+  size = len(branching)
+  index = [-1] * size
+  low = [0] * size
+  component = [-1] * size
+  reach = array('I', [0]) * size
+  stack = []
+  counter = 0
+  for root in range(size):
+    if index[root] >= 0:
+      continue
+    index[root] = low[root] = counter
+    counter += 1
+    stack.append(root)
+    work = [(root, 0)]
+    while work:
+      state, edge = work[-1]
+      if edge < len(following[state]):
+        work[-1] = (state, edge + 1)
+        other = following[state][edge]
+        if index[other] < 0:
+          index[other] = low[other] = counter
+          counter += 1
+          stack.append(other)
+          work.append((other, 0))
+        elif component[other] < 0 and index[other] < low[state]:
+          low[state] = index[other]
+        continue
+
+      work.pop()
+      if work and low[state] < low[work[-1][0]]:
+        low[work[-1][0]] = low[state]
+      if low[state] != index[state]:
+        continue
+
+      members = []
+      while True:
+        other = stack.pop()
+        component[other] = state
+        members.append(other)
+        if other == state:
+          break
+
+      total = 0
+      best = 0
+      looped = len(members) > 1
+      for member in members:
+        total += branching[member]
+        for other in following[member]:
+          if component[other] == state:
+            looped = True
+          elif reach[other] > best:
+            best = reach[other]
+      if looped and total:
+        value = UNBOUNDED
+      else:
+        value = min(UNBOUNDED, total + best)
+      for member in members:
+        reach[member] = value
+
+  return reach
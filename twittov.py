@@ -25,10 +25,20 @@
 
 """
 
-import string, sys, random, pickle
+import string, os, sys, io, random, sqlite3, json, functools, heapq
+from bisect import bisect_right
 from optparse import OptionParser
-from twython import Twython
+from twython import Twython, TwythonError
 from util import ingrams
+from transitions import Transitions, merge_chains, prune_chains, chain_stats
+from arraymodel import ArrayModel, walk
+from charmodel import CharModel
+from mappedmodel import save_mapped
+from normalize import TokenStream
+from cachestore import CacheStore
+from cachemanager import CacheManager, parse_size, parse_duration
+from mapreduce import map_reduce
+import metrics
 from xml.dom import minidom
 import xml.etree.cElementTree as ET
 
@@ -49,31 +59,33 @@ def markov(sequence, order, distribution=None, heads=None):
   """Process the text to gather a->b frequency distributions.
 
   For example:
-  >>> pprint(frequency_distribution(
-  ["Under","my","closet","I","found","cats","and","a","bat"],2))
-
-  {('I', 'found'): set(['cats']),
-  ('Under', 'my'): set(['closet']),
-  ('and', 'a'): set(['bat']),
-  ('cats', 'and'): set(['a']),
-  ('closet', 'I'): set(['found']),
-  ('found', 'cats'): set(['and']),
-  ('my', 'closet'): set(['I'])}
+  >>> from pprint import pprint
+  >>> pprint(markov(
+  ...     ["Under","my","closet","I","found","cats","and","a","bat"],2)[0])
+  {('I', 'found'): Transitions({'cats': 1}),
+   ('Under', 'my'): Transitions({'closet': 1}),
+   ('and', 'a'): Transitions({'bat': 1}),
+   ('cats', 'and'): Transitions({'a': 1}),
+   ('closet', 'I'): Transitions({'found': 1}),
+   ('found', 'cats'): Transitions({'and': 1}),
+   ('my', 'closet'): Transitions({'I': 1})}
 
   We can also apply this algorithm to letters:
-   >>> pprint(db.frequency_distribution("Cats and a bat.",2))
-
-  {(' ', 'a'): set([' ', 'n']),
-   (' ', 'b'): set(['a']),
-   ('C', 'a'): set(['t']),
-   ('a', ' '): set(['b']),
-   ('a', 'n'): set(['d']),
-   ('a', 't'): set(['.', 's']),
-   ('b', 'a'): set(['t']),
-   ('d', ' '): set(['a']),
-   ('n', 'd'): set([' ']),
-   ('s', ' '): set(['a']),
-   ('t', 's'): set([' '])}
+  >>> pprint(markov("Cats and a bat.",2)[0])
+  {(' ', 'a'): Transitions({'n': 1, ' ': 1}),
+   (' ', 'b'): Transitions({'a': 1}),
+   ('C', 'a'): Transitions({'t': 1}),
+   ('a', ' '): Transitions({'b': 1}),
+   ('a', 'n'): Transitions({'d': 1}),
+   ('a', 't'): Transitions({'s': 1, '.': 1}),
+   ('b', 'a'): Transitions({'t': 1}),
+   ('d', ' '): Transitions({'a': 1}),
+   ('n', 'd'): Transitions({' ': 1}),
+   ('s', ' '): Transitions({'a': 1}),
+   ('t', 's'): Transitions({' ': 1})}
+
+  Each suffix keeps a count of how often it followed the prefix, so sampling
+  from a Transitions is frequency-correct.
 
   Keyword arguments:
   sequence -- A sequence of characters or words.
@@ -87,7 +99,7 @@ def markov(sequence, order, distribution=None, heads=None):
     return;
 
   if distribution is None:
-    distributon = {}
+    distribution = {}
   if heads is None:
     heads = set()
 
@@ -98,13 +110,119 @@ def markov(sequence, order, distribution=None, heads=None):
     suffix = ngram[-1]
 
     if prefix not in distribution:
-      distribution[prefix] = set([suffix])
-    else:
-      distribution[prefix].add(suffix)
+      distribution[prefix] = Transitions()
+    distribution[prefix].add(suffix)
+
+  return distribution, heads
+
+def write_tokens(out, tokens, length, split_words):
+  """Write tokens to out until they add up to length characters.
+
+  Returns the number of characters written, separators included.
+
+  Keyword arguments:
+  out -- Anything with a write method taking strings.
+  tokens -- An iterable of words or letters, e.g. TweetList.iter_tokens().
+  length -- How much text, in characters, should we generate?
+  split_words -- If true, the tokens are letters rather than words.
+
+  """
+  if split_words:
+    separator = ''
+  else:
+    separator = ' '
+
+  # Count the letters, but not the separators.
+  current_length = 0
+  written = 0
+  for token in tokens:
+    if written:
+      out.write(separator)
+      written += len(separator)
+    out.write(token)
+    written += len(token)
+    current_length += len(token)
+    if current_length >= length:
+      break
+
+  return written
+
+def build_model(sequences, order):
+  """Apply the Markov algorithm to every tweet, returning (distribution, heads).
+
+  Keyword arguments:
+  sequences -- The tweets, as lists of words, or as text for letters.
+  order -- The order of the Markov model.
+
+  """
+  distribution = {}
+  heads = set()
+
+  for sequence in sequences:
+    markov(sequence, order, distribution, heads)
+
+  return distribution, heads
+
+def merge_models(models, weights=None):
+  """Sum (distribution, heads) models into a new one, leaving them intact.
+
+  This is how parallel builds combine their per-shard partial models, and it
+  also blends accounts: merging the models of several users of the same order
+  gives a model that talks like all of them.
+  >>> a = build_model([['Under', 'my', 'closet']], 2)
+  >>> b = build_model([['Under', 'my', 'bed']], 2)
+  >>> merge_models([a, b], [3, 1])[0]
+  {('Under', 'my'): Transitions({'closet': 3, 'bed': 1})}
+
+  Keyword arguments:
+  models -- A sequence of (distribution, heads) pairs of the same order.
+  weights -- If specified, one positive integer per model to scale its counts
+             by.
 
+  """
+  distribution = merge_chains([model[0] for model in models], weights)
+  heads = set()
+  for model in models:
+    heads.update(model[1])
   return distribution, heads
 
-def get_tweets(username, amount, AK, AS, OT, OTS):
+def end_distances(distribution, cost, ends=()):
+  """Find the fewest characters from each prefix to the end of a chain.
+
+  A chain ends at a prefix with no successors, or at any of ends. Those are
+  no characters away, and the rest are found with Dijkstra's algorithm over
+  the edges in reverse. Prefixes that only ever loop are left out.
+
+  Keyword arguments:
+  distribution -- A dict of Transitions (or an ArrayModel).
+  cost -- Maps a suffix to the characters it adds to the text.
+  ends -- If specified, more prefixes where a text may end.
+
+  """
+  callers = {}
+  heap = [(0, prefix) for prefix in ends]
+  for prefix, transitions in distribution.items():
+    for suffix in transitions:
+      following = prefix[1:] + (suffix,)
+      if following in distribution:
+        callers.setdefault(following, []).append((prefix, cost(suffix)))
+      else:
+        heap.append((cost(suffix), prefix))
+  heapq.heapify(heap)
+
+  shortest = {}
+  while heap:
+    chars, prefix = heapq.heappop(heap)
+    if prefix in shortest:
+      continue
+    shortest[prefix] = chars
+    for caller, step in callers.get(prefix, ()):
+      if caller not in shortest:
+        heapq.heappush(heap, (chars + step, caller))
+
+  return shortest
+
+def get_tweets(username, amount, AK, AS, AT, ATS):
   """Given a Twitter username, scrape up to $amount entries.
 
   We do not fetch exactly $amount tweets. The account may not have $amount tweets,
@@ -115,117 +233,721 @@ def get_tweets(username, amount, AK, AS, OT, OTS):
   amount -- The number of tweets to scrape.
 
   """
-  tweets = []
-  twitter = Twython(AK, AS, AT, ATS)	#APP_KEY, APP_SECRET, AUTH_TOKEN, AUTH_TOKEN_SECRET
+  return [result['text'] for result in
+      get_timeline(username, amount, AK, AS, AT, ATS)]
+
+def get_timeline(username, amount, AK, AS, AT, ATS, since_id=None,
+    checkpoint=None):
+  """Like get_tweets, but return the raw results, newest first.
+
+  We page backwards through the timeline with max_id cursors. With a
+  checkpoint file, progress is saved after every page. If the fetch dies
+  halfway, through an API error or a rate limit, the next call with the same
+  arguments picks up where it stopped instead of starting over.
 
-  finished = False
-  page = 1
-  while not finished:
+  Keyword arguments:
+  username -- The string username of the twitter user.
+  amount -- The number of tweets to scrape, or None for as many as there are.
+  since_id -- If specified, only fetch tweets newer than this id.
+  checkpoint -- If specified, the file to save progress in.
+
+  """
+  state = {'username': username, 'amount': amount, 'since_id': since_id,
+      'max_id': None, 'results': []}
+  if checkpoint:
+    saved = load_checkpoint(checkpoint)
+    if saved and all(saved[key] == state[key]
+        for key in ('username', 'amount', 'since_id')):
+      state = saved
 
-    if amount <= 200:
-      # Make the API call.
-      search_results = twitter.get_user_timeline(screen_name=username,
-          page=str(page), count=str(amount))
-      finished = True
+  twitter = Twython(AK, AS, AT, ATS)	#APP_KEY, APP_SECRET, AUTH_TOKEN, AUTH_TOKEN_SECRET
 
+  results = state['results']
+  while amount is None or len(results) < amount:
+    if amount is None:
+      count = 200
     else:
-      # Make the API call.
-      search_results = twitter.get_user_timeline(screen_name=username,
-          page=str(page), count='200')
-      amount -= 200
-      page += 1
+      count = min(200, amount - len(results))
+
+    # Make the API call.
+    arguments = {'screen_name': username, 'count': str(count)}
+    if since_id is not None:
+      arguments['since_id'] = str(since_id)
+    if state['max_id'] is not None:
+      arguments['max_id'] = str(state['max_id'])
+    with metrics.phase('fetch'):
+      search_results = twitter.get_user_timeline(**arguments)
 
     if isinstance(search_results, dict) and search_results['error']:
       raise TwitterAPIException(str(search_results['error']))
     elif not search_results:
-      raise TwitterAPIException('User has no tweets.')
+      break
 
-    for result in search_results:
-      tweets.append(result['text']) 
+    results.extend({'id': result['id'], 'text': result['text']}
+        for result in search_results)
+    metrics.count('pages_fetched')
+    metrics.count('tweets_fetched', len(search_results))
+    state['max_id'] = min(result['id'] for result in search_results) - 1
+    if checkpoint:
+      save_checkpoint(checkpoint, state)
 
-  return tweets
+  if not results and since_id is None:
+    raise TwitterAPIException('User has no tweets.')
+
+  if checkpoint and os.path.exists(checkpoint):
+    os.remove(checkpoint)
+  return results
+
+def get_new_tweets(username, since_id, AK, AS, AT, ATS, checkpoint=None):
+  """Fetch only the tweets posted after the tweet since_id, newest first.
+
+  We walk back from the newest tweet with max_id until we meet since_id, so
+  however many tweets are new, none of the old ones are fetched again.
+
+  Keyword arguments:
+  username -- The string username of the twitter user.
+  since_id -- The id of the newest tweet we already have.
+  checkpoint -- If specified, the file to save progress in.
+
+  """
+  return get_timeline(username, None, AK, AS, AT, ATS, since_id, checkpoint)
+
+def load_checkpoint(path):
+  """Return the fetch state saved in path, or None if there isn't any."""
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return None
+
+def save_checkpoint(path, state):
+  """Save the fetch state to path, atomically, so a crash can't corrupt it."""
+  directory = os.path.dirname(path)
+  if directory and not os.path.isdir(directory):
+    os.makedirs(directory)
+
+  with open(path + '.tmp', 'w') as f:
+    json.dump(state, f)
+  os.replace(path + '.tmp', path)
+
+def save_cache(cache, username, tweets, verbose=False):
+  """Store one user's TweetList in the cache, leaving other entries alone.
+
+  Keyword arguments:
+  cache -- A CacheManager, or a plain dict if the cache file couldn't be opened.
+  username -- The string username of the twitter user.
+  tweets -- Their TweetList.
+  verbose -- If true, report what happened.
+
+  """
+  try:
+    cache[username] = tweets
+  except sqlite3.Error:
+    if verbose:
+      print ("Cannot write %s\'s tweets to the cache." % username)
+    return False
+  return True
+
+def get_credentials(options):
+  """Return the API keys given on the command line, or the ones saved in .td.
+
+  Keys given on the command line are saved to .td for next time.
+  """
+  if (options.AK=='0' or options.AS=='0' or options.AT=='0' or options.ATS=='0'): #nothing in input
+    try: #try to open xml file and search key element
+      tok_doc = minidom.parse('.td')
+      itemlist = tok_doc.getElementsByTagName('key')
+      AK=itemlist[0].firstChild.data
+      AS=itemlist[1].firstChild.data
+      AT=itemlist[2].firstChild.data
+      ATS=itemlist[3].firstChild.data
+    except IOError: #if failed, ERROR
+      print ("There aren't token saved or in input. The application will close.")
+      sys.exit(1)
+    print ('No input data, using saved data')
+
+  else:
+    try: #try to open xml file
+      tok_doc = minidom.parse('.td')
+      itemlist = tok_doc.getElementsByTagName('key')
+      rx = input('Saved data found, would you like to replace it?[Y/n]') #replace data found?
+
+      if (rx!='n'): #YES
+
+        os.remove('.td') #rimuovo file e riscrivo
+        root = ET.Element('root')
+        keys = ET.SubElement(root, 'keys')
+        key1 = ET.SubElement(keys, 'key')
+        key1.text = options.AK
+        key2 = ET.SubElement(keys, 'key')
+        key2.text = options.AS
+        key3 = ET.SubElement(keys, 'key')
+        key3.text = options.AT
+        key4 = ET.SubElement(keys, 'key')
+        key4.text = options.ATS
+        tree = ET.ElementTree(root)
+        tree.write('.td')
+      
+
+    except IOError: #file not exist, write it
+      root = ET.Element('root')
+      keys = ET.SubElement(root, 'keys')
+      key1 = ET.SubElement(keys, 'key')
+      key1.text = options.AK
+      key2 = ET.SubElement(keys, 'key')
+      key2.text = options.AS
+      key3 = ET.SubElement(keys, 'key')
+      key3.text = options.AT
+      key4 = ET.SubElement(keys, 'key')
+      key4.text = options.ATS
+      tree = ET.ElementTree(root)
+      tree.write('.td')
+
+    AK = options.AK
+    AS = options.AS
+    AT = options.AT
+    ATS = options.ATS
+
+  return AK, AS, AT, ATS
+
+# Bump this whenever the layout of a compiled model changes, so models pickled
+# by an older version are rebuilt instead of reused. Version 4 models are built
+# from normalized tokens (see normalize.py); version 5 CharModels keep 4-byte
+# arrays.
+MODEL_VERSION = 5
+
+# How many times a bounded text is restarted before giving up. Restarts only
+# happen when an early chain leaves too little room to reach the minimum.
+BOUNDED_TRIES = 100
 
 class TweetList:
-  def __init__(self, username, num_tweets, AK, AS, AT, ATS):
+  # TweetLists pickled by older versions lack these attributes.
+  models = None
+  newest_id = None
+
+  # The tweets tokenized, as a TokenStream. It holds the same tweets as
+  # self.tweets but not in the same order: tweets are newest first, while
+  # refresh appends each batch of new tweets to the end of the stream, so
+  # _sequences(start) yields just those. Models don't depend on the order of
+  # their tweets, so nothing else may rely on it either; index i of the
+  # stream is not tweets[i].
+  tokens = None
+
+  # (min_count, top_k, dead_ends) to prune dict and array models with, as
+  # prune_chains() does, or None. Part of the signature, so models compiled
+  # with other settings are rebuilt from the tweets.
+  pruning = None
+
+  # Indexes for bounded generation, rebuilt on demand and never pickled.
+  _ends = None
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state.pop('_ends', None)
+    return state
+
+  def __init__(self, username, num_tweets, AK, AS, AT, ATS, checkpoint=None):
     self.username = username
-    self.tweets = get_tweets(username, num_tweets, AK, AS, AT, ATS)	#APP_KEY, APP_SECRET, AUTH_TOKEN, AUTH_TOKEN_SECRET
+    results = get_timeline(username, num_tweets, AK, AS, AT, ATS,	#APP_KEY, APP_SECRET, AUTH_TOKEN, AUTH_TOKEN_SECRET
+        checkpoint=checkpoint)
+    self.tweets = [result['text'] for result in results]
+    self.newest_id = max(result['id'] for result in results)
+    self.models = {}
+    # Tokenize once, now, and cache the tokens with the tweets.
+    self.tokens = TokenStream(self.tweets)
+
+  def refresh(self, AK, AS, AT, ATS, checkpoint=None):
+    """Fetch the tweets posted since the last fetch and merge them in.
+
+    Only the new tweets are downloaded and tokenized: they are put in front
+    of the tweets, appended to the tokens (see TweetList.tokens), and added
+    to every compiled dict model. Array models can't grow, so they
+    are dropped and get rebuilt the next time they are used. Returns the
+    number of new tweets.
+
+    Keyword arguments:
+    AK, AS, AT, ATS -- The app key and secret, and the access token and secret.
+    checkpoint -- If specified, the file to save fetch progress in.
 
-  def generate_text(self, order, length, split_words):
+    """
+    if self.newest_id is None:
+      raise TwitterAPIException('No tweet ids cached for %s; fetch again with -f.'
+          % self.username)
+
+    results = get_new_tweets(self.username, self.newest_id, AK, AS, AT, ATS,
+        checkpoint)
+    if not results:
+      return 0
+
+    new_tweets = [result['text'] for result in results]
+    old_signature = self._signature()
+    stream = self._token_stream()
+    start = len(stream)
+    stream.extend(new_tweets)
+    self.tweets = new_tweets + self.tweets
+    self.newest_id = max(result['id'] for result in results)
+    signature = self._signature()
+
+    for key, model in list((self.models or {}).items()):
+      order, split_words, backend = key
+      # New tweets could bring back what pruning dropped; rebuild those too.
+      if model[0] != old_signature or backend != 'dict' or self.pruning:
+        del self.models[key]
+        continue
+
+      distribution, heads = model[1], model[2]
+      added = set()
+      for tweet in self._sequences(split_words, start):
+        markov(tweet, order, distribution, added)
+      known = set(heads)
+      heads = heads + tuple(head for head in added if head not in known)
+      self.models[key] = (signature, distribution, heads)
+
+    return len(new_tweets)
+
+  def is_compiled(self, order, split_words, backend='dict'):
+    """Check whether an up to date model for these settings is stored.
+
+    Keyword arguments:
+    order -- The order of the Markov model.
+    split_words -- If true, we apply Markov to letters rather than words.
+    backend -- 'dict' for a dict of Transitions, 'array' for an ArrayModel,
+               'char' for a CharModel (letters only).
+
+    """
+    if not self.models:
+      return False
+    model = self.models.get((order, split_words, backend))
+    return model is not None and model[0] == self._signature()
+
+  def compile(self, order, split_words, backend='dict', workers=1):
+    """Return the (distribution, heads) model, building it only if needed.
+
+    Compiled models live on the TweetList itself, so they are pickled into the
+    cache next to the raw tweets and reused by later runs until the corpus
+    or the pruning changes.
+
+    Keyword arguments:
+    order -- The order of the Markov model.
+    split_words -- If true, we apply Markov to letters rather than words.
+    backend -- 'dict' for a dict of Transitions, 'array' for an ArrayModel,
+               'char' for a CharModel (letters only).
+    workers -- How many processes build a dict model; None means one per CPU.
+
+    """
+    if self.models is None:
+      self.models = {}
+
+    if not self.is_compiled(order, split_words, backend):
+      # Models of an older corpus are no use to anyone; drop them.
+      signature = self._signature()
+      for key, model in list(self.models.items()):
+        if model[0] != signature:
+          del self.models[key]
+
+      with metrics.phase('build'):
+        if backend == 'char':
+          if not split_words:
+            raise ValueError('The char backend only works on letters.')
+          if self.pruning:
+            raise ValueError('The char backend can\'t be pruned.')
+          distribution = CharModel.build(self._sequences(True), order)
+          heads = distribution.heads
+          transitions = len(distribution.successors)
+        elif backend == 'array' and self.pruning:
+          chains, heads = self._pruned_distribution(order, split_words, workers)
+          distribution = ArrayModel.from_chains(chains, order, heads,
+              self._tails(order, split_words))
+          heads = distribution.heads
+          transitions = len(distribution.successors)
+        elif backend == 'array':
+          if split_words:
+            distribution = ArrayModel.build(self._sequences(True), order)
+          else:
+            # Already interned: take the token ids as they are.
+            stream = self._token_stream()
+            distribution = ArrayModel.build(stream.id_sequences(), order,
+                stream.vocab)
+          heads = distribution.heads
+          transitions = len(distribution.successors)
+        elif self.pruning:
+          distribution, heads = self._pruned_distribution(order, split_words,
+              workers)
+          transitions = sum([len(suffixes) for suffixes in distribution.values()])
+        else:
+          distribution, heads = self._generate_distribution(order, split_words,
+              workers)
+          heads = tuple(heads)
+          transitions = sum([len(suffixes) for suffixes in distribution.values()])
+      metrics.count('tweets_ingested', len(self.tweets))
+      metrics.count('states', len(distribution))
+      metrics.count('transitions', transitions)
+      self.models[(order, split_words, backend)] = (signature, distribution,
+          heads)
+
+    signature, distribution, heads = self.models[(order, split_words, backend)]
+    return distribution, heads
+
+  def generate_text(self, order, length, split_words, backend='dict',
+      max_length=None):
     """Use the Markov chains to generate text.
 
     Keyword arguments:
     order -- The order of the Markov model.
-    heads -- A set of heads, or strings to start from.
     length -- How much text, in characters, should we generate?
     split_words -- If true, we apply Markov to letters rather than words.
+    backend -- 'dict' for a dict of Transitions, 'array' for an ArrayModel,
+               'char' for a CharModel (letters only).
+    max_length -- If specified, the most characters the text may have. The
+                  text then always ends where a chain does.
+
+    """
+    if max_length is not None:
+      # Compile and index first, so neither counts as generating.
+      self.compile(order, split_words, backend)
+      if backend != 'char':
+        with metrics.phase('index'):
+          self._end_index(order, split_words, backend)
+      with metrics.phase('generate'):
+        return self._generate_bounded(order, length, max_length, split_words,
+            backend)
+
+    text = io.StringIO()
+    self.write_text(text, order, length, split_words, backend)
+    return text.getvalue().encode('utf-8')
+
+  def write_text(self, out, order, length, split_words, backend='dict'):
+    """Stream generated text to a file-like object as it is produced.
+
+    Nothing but the current prefix is kept in memory, so this can write
+    text of any length. Returns the number of characters written.
+
+    Keyword arguments:
+    out -- Anything with a write method taking strings.
+    order -- The order of the Markov model.
+    length -- How much text, in characters, should we generate?
+    split_words -- If true, we apply Markov to letters rather than words.
+    backend -- 'dict' for a dict of Transitions, 'array' for an ArrayModel,
+               'char' for a CharModel (letters only).
 
     """
-    distribution, heads = self._generate_distribution(order, split_words)
-    prefix = random.sample(heads, 1)[0] # Pick a random head.
-    text = list(prefix)
-
-    # Count the letters.
-    current_length = sum([ len(i) for i in text ])
-
-    while current_length < length:
-      if prefix in distribution:
-        suffix = random.sample(distribution[prefix], 1)[0]
-        text.append(suffix)
-        current_length += len(suffix)
+    # Compile first, so building doesn't count as generating.
+    self.compile(order, split_words, backend)
+    with metrics.phase('generate'):
+      return write_tokens(out, self.iter_tokens(order, split_words, backend),
+          length, split_words)
+
+  def iter_tokens(self, order, split_words, backend='dict'):
+    """Yield the words (or letters) of an endless generated text.
+
+    Keyword arguments:
+    order -- The order of the Markov model.
+    split_words -- If true, we apply Markov to letters rather than words.
+    backend -- 'dict' for a dict of Transitions, 'array' for an ArrayModel,
+               'char' for a CharModel (letters only).
+
+    """
+    distribution, heads = self.compile(order, split_words, backend)
+    if backend == 'char':
+      for token in distribution.iter_text():
+        yield token
+      return
+
+    # Follow the rows an ArrayModel links its edges to, rather than search
+    # for every prefix.
+    if backend == 'array':
+      while True:
+        row = random.choice(distribution.head_rows)
+        for token in distribution.prefix(row):
+          yield token
+        for token in walk(distribution, row, distribution.vocab):
+          yield token
+
+        metrics.count('restarts')
+        # Mark the end of a sentence.
+        if split_words:
+          yield ' '
+
+    prefix = random.choice(heads) # Pick a random head.
+    for token in prefix:
+      yield token
+
+    while True:
+      transitions = distribution.get(prefix)
+      if transitions is not None:
+        suffix = transitions.sample()
+        yield suffix
         # Readjust the prefix.
-        prefix = tuple(text[-order:])
+        prefix = prefix[1:] + (suffix,)
 
       # If we have reached the end of a chain, start a new one.
       else:
+        metrics.count('restarts')
         # Mark the end of a sentence.
         if split_words:
-          text.append(' ')
+          yield ' '
 
-        prefix = random.sample(heads, 1)[0]
+        prefix = random.choice(heads)
+        for token in prefix:
+          yield token
+
+  def _generate_bounded(self, order, length, max_length, split_words, backend):
+    """Generate text of between length and max_length characters in one pass.
+
+    A text may end wherever a tweet did, or where a chain runs out. Every step
+    only considers the successors from which such an end is still within
+    max_length, sampled in proportion to their counts, so the text never
+    overshoots. Chains are strung together, as in generate_text, until one
+    ends past length.
+    """
+    if backend == 'char':
+      raise ValueError('Bounded generation needs the dict or array backend.')
+
+    distribution, heads = self.compile(order, split_words, backend)
+    shortest, tails, starts, start_costs = self._end_index(order, split_words,
+        backend)
+
+    # Words are joined with spaces, and chains of letters with one space.
+    if split_words:
+      gap, marker = 0, 1
+    else:
+      gap, marker = 1, 0
+
+    for attempt in range(BOUNDED_TRIES):
+      text = []
+      used = 0
+      while not text or used < length:
+        # The first chain has no separator in front of it.
+        if text:
+          offset = marker
+        else:
+          offset = -gap
+        fits = bisect_right(start_costs, max_length - used - offset)
+        if not fits:
+          # Too little room left to reach length; start over.
+          metrics.count('bounded_retries')
+          break
+
+        prefix = random.choice(starts[:fits])
+        if text and split_words:
+          text.append(' ')
         text.extend(prefix)
-        current_length += sum([ len(i) for i in prefix])
+        used += offset + sum([len(token) + gap for token in prefix])
+
+        while prefix in distribution:
+          if used >= length and prefix in tails:
+            break
+
+          candidates = []
+          total = 0
+          for suffix, count in distribution[prefix].items():
+            following = prefix[1:] + (suffix,)
+            if following in distribution:
+              rest = shortest.get(following)
+            else:
+              rest = 0
+            if rest is not None and used + len(suffix) + gap + rest <= max_length:
+              candidates.append((suffix, following, count))
+              total += count
+
+          # Only a tail can run out of room; end the chain there.
+          if not candidates:
+            break
+
+          r = random.random() * total
+          for suffix, following, count in candidates:
+            r -= count
+            if r < 0:
+              break
+          text.append(suffix)
+          used += len(suffix) + gap
+          prefix = following
 
+      else:
+        if split_words:
+          separator = ''
+        else:
+          separator = ' '
+        return separator.join(text).encode('utf-8')
+
+    raise ValueError('Cannot generate between %d and %d characters.'
+        % (length, max_length))
+
+  def _end_index(self, order, split_words, backend):
+    """Return (shortest, tails, starts, start_costs) for bounded generation.
+
+    tails holds the prefixes tweets ended with. shortest maps each prefix to
+    the fewest characters to a tail or the end of its chain. starts holds the
+    heads from which one can be reached at all, sorted by start_costs: the
+    fewest characters a whole chain from them takes.
+    """
+    if self._ends is None:
+      self._ends = {}
+    key = (order, split_words, backend)
+    signature = self._signature()
+    cached = self._ends.get(key)
+    if cached is not None and cached[0] == signature:
+      return cached[1:]
+
+    distribution, heads = self.compile(order, split_words, backend)
     if split_words:
-      separator = ''
+      gap = 0
     else:
-      separator = ' '
+      gap = 1
+
+    tails = self._tails(order, split_words)
+    shortest = end_distances(distribution, lambda token: len(token) + gap,
+        tails)
+
+    ranked = sorted((sum([len(token) + gap for token in head]) + shortest[head],
+        head) for head in heads if head in shortest)
+    starts = [head for cost, head in ranked]
+    start_costs = [cost for cost, head in ranked]
+
+    self._ends[key] = (signature, shortest, tails, starts, start_costs)
+    return shortest, tails, starts, start_costs
+
+  def generate_batch(self, n, order, length, split_words):
+    """Generate n texts in one call, advancing all of them in lockstep.
+
+    This needs NumPy, and always runs on the array backend.
+
+    Keyword arguments:
+    n -- How many texts to generate.
+    order -- The order of the Markov model.
+    length -- How much text, in characters, should each one have?
+    split_words -- If true, we apply Markov to letters rather than words.
+
+    """
+    model, heads = self.compile(order, split_words, 'array')
+    return model.generate_batch(n, length, split_words)
+
+  def export(self, path, order, split_words):
+    """Save the array model to path in the mapped format (see mappedmodel.py).
+
+    Keyword arguments:
+    path -- Where to write it.
+    order -- The order of the Markov model.
+    split_words -- If true, we apply Markov to letters rather than words.
 
-    return separator.join(text).encode('utf-8')
+    """
+    model, heads = self.compile(order, split_words, 'array')
+    save_mapped(model, path, split_words)
 
-  def _generate_distribution(self, order, split_words):
+  def _generate_distribution(self, order, split_words, workers=1):
     """Apply the Markov algorithm repeatedly to self.tweets.
 
+    With more than one worker, each builds a partial model of a shard of the
+    tweets and the partials are merged.
+
     Keyword arguments:
     order -- The order of the Markov model.
     split_words -- If true, we apply Markov to letters rather than words.
+    workers -- How many processes to use; None means one per CPU.
 
     """
-    distribution = {}
-    heads = set()
+    build = functools.partial(build_model, order=order)
+    return map_reduce(list(self._sequences(split_words)), build, merge_models,
+        workers)
 
-    for tweet in self.tweets:
-      if not split_words:
-        tweet = tweet.split()
-      markov(tweet, order, distribution, heads)
+  def _pruned_distribution(self, order, split_words, workers=1):
+    """Build a dict model and prune it as self.pruning says.
 
+    Returns (distribution, heads), like _generate_distribution, keeping only
+    the heads whose prefix survived. Raises ValueError if none did.
+    """
+    distribution, heads = self._generate_distribution(order, split_words,
+        workers)
+    min_count, top_k, dead_ends = self.pruning
+    ends = None
+    if dead_ends:
+      ends = self._tails(order, split_words)
+
+    with metrics.phase('prune'):
+      before = chain_stats(distribution, True)
+      distribution = prune_chains(distribution, min_count, top_k, ends)
+      after = chain_stats(distribution, True)
+    metrics.count('pruned_states', before[0] - after[0])
+    metrics.count('pruned_transitions', before[1] - after[1])
+    metrics.count('pruned_bytes', before[2] - after[2])
+
+    heads = tuple(head for head in heads if head in distribution)
+    if not heads:
+      raise ValueError('Pruning left no heads to start from. Try pruning less.')
     return distribution, heads
 
+  def _tails(self, order, split_words):
+    """Return the set of prefixes the tweets end with."""
+    tails = set()
+    for tweet in self._sequences(split_words):
+      if len(tweet) > order:
+        tails.add(tuple(tweet[-order:]))
+    return tails
+
+  def _sequences(self, split_words, start=0):
+    """Yield each tweet as a list of tokens, or as normalized text for letters.
+
+    Keyword arguments:
+    split_words -- If true, we apply Markov to letters rather than words.
+    start -- If specified, skip the tweets tokenized before this index.
+
+    """
+    stream = self._token_stream()
+    if split_words:
+      return stream.texts(start)
+    return stream.sequences(start)
+
+  def _token_stream(self):
+    """Return the tokenized tweets, tokenizing them if an older version didn't."""
+    if self.tokens is None or len(self.tokens) != len(self.tweets):
+      self.tokens = TokenStream(self.tweets)
+    return self.tokens
+
+  def _signature(self):
+    """Identify the current corpus cheaply, without walking every tweet.
+
+    The newest tweet comes first, so a refetch changes it, and adding tweets
+    changes the count.
+    """
+    if self.tweets:
+      newest = self.tweets[0]
+    else:
+      newest = None
+    signature = (MODEL_VERSION, len(self.tweets), newest)
+    if self.pruning:
+      signature += (self.pruning,)
+    return signature
+
 # Routine script stuff. We parse the arguments, generate the database, and
-# run the Markov algorithm. Note that we use the pickle() functions to cache
-# everything in .twittov.cache.
+# run the Markov algorithm. Note that we cache everything in .twittov.cache, one
+# pickled entry per user (see cachestore.py).
 if __name__ == '__main__':
 
     
     # Standard argument parsing using the optparse module.
     parser = OptionParser(usage='Usage: twittov.py [options] username')
-    parser.set_defaults(length=160, split_words=False, cache='.twittov.cache', must_cache=False, order=3, cache_size=200, verbose=False)
+    parser.set_defaults(length=160, split_words=False, cache='.twittov.cache', must_cache=False, order=3, cache_size=200, verbose=False, backend='dict', compact=False, update=False, checkpoints='.twittov.checkpoints', workers=1, max_length=None, export=None, profile=False, cache_budget=None, evict='lru', ttl=None, min_count=1, top_k=None, dead_ends=False)
 
     parser.add_option('-l', '--length', type='int', dest='length', metavar='LENGTH', help='Set the *minimum* output length in characters. LENGTH must be a positive integer. Default is 160.')
+    parser.add_option('-m', '--max-length', type='int', dest='max_length', metavar='LENGTH', help='If set, the *maximum* output length in characters. The output then ends where a chain does.')
     parser.add_option('-c', '--cache-file', dest='cache', type='string', metavar='FILE', help='Sets the cache file. By default, we save to .twittov.cache')
     parser.add_option('-f', '--force-cache-update', action='store_true', dest='mustCache', help='Force download all tweets and update cache, even if username is already in cache.')
+    parser.add_option('-u', '--update', action='store_true', dest='update', help='Fetch only tweets newer than the cached ones and merge them in.')
+    parser.add_option('--checkpoint-dir', dest='checkpoints', type='string', metavar='DIR', help='Where interrupted fetches save their progress, to resume from next time. By default, .twittov.checkpoints')
+    parser.add_option('-C', '--compact-cache', action='store_true', dest='compact', help='Rewrite the cache file without superseded entries, then exit.')
+    parser.add_option('--cache-budget', dest='cache_budget', type='string', metavar='SIZE', help='Evict the coldest users once the cache holds more than SIZE, e.g. 500M. Unbounded by default.')
+    parser.add_option('--evict', type='choice', choices=['lru', 'lfu'], dest='evict', help='Which users --cache-budget evicts first: "lru", least recently used, or "lfu", least often used. Default is lru.')
+    parser.add_option('--ttl', dest='ttl', type='string', metavar='DURATION', help='Update users cached longer ago than DURATION, e.g. 12h or 7d, as with -u. Never by default.')
     parser.add_option('-s', '--cache-size', type='int', dest='amount', default=200, help='How many tweets to scrape. Default is 200.')
     parser.add_option('-o', '--order', type='int', dest='order', help='The order of the markov chains. Default is 3.')
     parser.add_option('-x', '--split', action='store_true', dest='split_words', metavar='SPLIT', help='If set, operates on groups of letters rather than words.')
+    parser.add_option('-b', '--backend', type='choice', choices=['dict', 'array', 'char'], dest='backend', help='How to store the model: "dict", the compact "array", or "char", for letters. Default is dict.')
+    parser.add_option('--min-count', type='int', dest='min_count', metavar='COUNT', help='Prune successors seen fewer than COUNT times after a prefix. Default is 1, keeping them all.')
+    parser.add_option('--top-k', type='int', dest='top_k', metavar='K', help='Prune all but the K most frequent successors of each prefix. All are kept by default.')
+    parser.add_option('--drop-dead-ends', action='store_true', dest='dead_ends', help='Prune successors that lead only where no tweet ended and nothing follows.')
+    parser.add_option('-j', '--workers', type='int', dest='workers', help='How many processes build the model. 0 means one per CPU. Default is 1.')
+    parser.add_option('--export', dest='export', type='string', metavar='FILE', help='Write the model to FILE in the mapped format (see mappedmodel.py), then exit.')
+    parser.add_option('--profile', action='store_true', dest='profile', help='When done, print JSON timings, counters and peak memory to stderr.')
     parser.add_option('-v', '--verbose', action='store_true', dest='verbose', metavar='SPLIT', help='If set, displays verbose output.')
     parser.add_option('--API_KEY', type='string', dest='AK', default='0', help='Your API Key')
     parser.add_option('--API_SECRET', type='string', dest='AS', default='0', help='Your API Secret')
@@ -234,6 +956,16 @@ if __name__ == '__main__':
 
     (options, args) = parser.parse_args()
 
+    if options.profile:
+      metrics.track_memory()
+
+    # Compacting the cache doesn't need a username.
+    if options.compact:
+      dropped = CacheStore(options.cache, 'twittov').compact()
+      if options.verbose:
+        print ("Dropped %d stale entries from %s." % (dropped, options.cache))
+      sys.exit(0)
+
     # Check if the parameters are all well formed.
     if len(args) != 1:
       parser.error('Incorrect number of arguments. Remember to specify a Twitter username.')
@@ -243,109 +975,151 @@ if __name__ == '__main__':
     if options.length <= 0:
       parser.error('Length must be a positive integer.')
 
+    if options.backend == 'char' and not options.split_words:
+      parser.error('The char backend needs -x.')
+
+    if options.max_length is not None and options.max_length < options.length:
+      parser.error('Max length must be at least the length.')
+
     if options.cache_size <= 0:
       parser.error('Cache size must be a positive integer.')
 
+    if options.workers < 0:
+      parser.error('Workers must be a positive integer, or 0 for one per CPU.')
+
+    if options.min_count <= 0:
+      parser.error('Min count must be a positive integer.')
+
+    if options.top_k is not None and options.top_k <= 0:
+      parser.error('Top k must be a positive integer.')
+
+    if options.min_count > 1 or options.top_k is not None or options.dead_ends:
+      if options.backend == 'char':
+        parser.error('The char backend can\'t be pruned.')
+      pruning = (options.min_count, options.top_k, bool(options.dead_ends))
+    else:
+      pruning = None
+
+    try:
+      if options.cache_budget is not None:
+        options.cache_budget = parse_size(options.cache_budget)
+      if options.ttl is not None:
+        options.ttl = parse_duration(options.ttl)
+    except ValueError as error:
+      parser.error(str(error))
+
     # We're caching all previous chains for now, so we don't overload Twitter.
+    # Only the entry for this username is ever unpickled.
     try:
-      f = open(options.cache, 'rb')
-    except IOError:
+      cache = CacheManager(CacheStore(options.cache, 'twittov'),
+          disk_budget=options.cache_budget, policy=options.evict, ttl=options.ttl)
+    except (IOError, OSError, sqlite3.Error):
       if options.verbose:
         print ("Cannot open %s for reading." % options.cache)
       cache = {}
     else:
-      cache = pickle.load(f)
       if options.verbose:
-        print ("Loaded cache from %s successfully." % options.cache)
-      f.close()
+        print ("Opened cache %s successfully." % options.cache)
+
+    # Fetches save their progress here, page by page.
+    checkpoint = os.path.join(options.checkpoints, username + '.json')
 
     # If it's in the cache, let's not generate anything.
     if not options.mustCache and username in cache:
-      tweets = cache[username]
+      with metrics.phase('cache_load'):
+        tweets = cache[username]
       found = True
       if options.verbose:
         print ("%s\'s tweets are already cached." % username)
 
+      # Pick up anything tweeted since, without redownloading the rest. Tweets
+      # cached longer ago than --ttl are brought up to date the same way.
+      stale = isinstance(cache, CacheManager) and cache.is_stale(username)
+      if options.update or stale:
+        AK, AS, AT, ATS = get_credentials(options)
+        try:
+          new_tweets = tweets.refresh(AK, AS, AT, ATS, checkpoint)
+        except (TwitterAPIException, TwythonError) as error:
+          print ("Stopped fetching: %s. Run again to resume." % error)
+          sys.exit(1)
+        if new_tweets or stale:
+          found = False
+        if options.verbose:
+          print ("Fetched %d new tweets for %s." % (new_tweets, username))
+
     # Otherwise, we should parse pages.
     else:
-      if (options.AK=='0' or options.AS=='0' or options.AT=='0' or options.ATS=='0'): #nothing in input
-        try: #try to open xml file and search key element
-          tok_doc = minidom.parse('.td')
-          itemlist = tok_doc.getElementByTagName('key')
-          AK=itemlist[0]
-          AS=itemlist[1]
-          AT=itemlist[2]
-          ATS=itemlist[3]
-        except IOError: #if failed, ERROR
-          print ("There aren't token saved or in input. The application will close.")
-          sys.exit(1)
-        print ('No input data, using saved data')
+      AK, AS, AT, ATS = get_credentials(options)
+      found = False
+      try:
+        tweets = TweetList(username,
+                           options.amount,
+                           AK,   #APP_KEY
+                           AS,   #APP_SECRET
+                           AT,   #AUTH_TOKEN
+                           ATS,  #AUTH_TOKEN_SECRET
+                           checkpoint)
+      except (TwitterAPIException, TwythonError) as error:
+        # Every page fetched so far is in the checkpoint.
+        print ("Stopped fetching: %s. Run again to resume." % error)
+        sys.exit(1)
+
+    # Build the model once and store it next to the tweets, so later runs for
+    # the same settings go straight to generation. Pruning differently, or not
+    # at all, rebuilds it from the tweets.
+    tweets.pruning = pruning
+    if not tweets.is_compiled(options.order, options.split_words, options.backend):
+      try:
+        tweets.compile(options.order, options.split_words, options.backend,
+            options.workers or None)
+      except ValueError as error:
+        print (error)
+        sys.exit(1)
+      found = False
+      if pruning and options.verbose:
+        counters = metrics.report()['counters']
+        print ("Pruned %d states, %d transitions and %d bytes." % (
+            counters['pruned_states'], counters['pruned_transitions'],
+            counters['pruned_bytes']))
+
+    if not found:
+      # Try to cache the new tweets and chains.
+      with metrics.phase('cache_save'):
+        saved = save_cache(cache, username, tweets, options.verbose)
+      if saved and options.verbose:
+        print ("Wrote %s with data for %s." % (options.cache, username))
+
+    if options.export:
+      tweets.export(options.export, options.order, options.split_words)
+      if options.verbose:
+        print ("Wrote the model to %s." % options.export)
+      sys.exit(0)
 
+    # Unbounded text is streamed out as it is generated, however long it is.
+    if options.max_length is None:
+      tweets.write_text(sys.stdout, options.order, options.length, options.split_words, options.backend)
+      print ()
+    else:
+      try:
+        print (tweets.generate_text(options.order, options.length, options.split_words, options.backend, options.max_length).decode('utf-8'))
+      except ValueError as error:
+        print (error)
+        sys.exit(1)
+
+    # Now that the output is out, evict whatever is over budget, and tidy up
+    # if superseded entries have piled up.
+    if isinstance(cache, CacheManager):
+      try:
+        evicted = cache.enforce(keep=(username,))
+      except sqlite3.Error:
+        if options.verbose:
+          print ("Cannot compact %s." % options.cache)
       else:
-        try: #try to open xml file
-          tok_doc = minidom.parse('.td')
-          itemlist = tok_doc.getElementByTagName('key')
-          rx = raw_input('Saved data found, would you like to replace it?[Y/n]') #replace data found?
-
-          if (rx!='n'): #YES
-
-            remove('.td') #rimuovo file e riscrivo
-            root = ET.element('root')
-            keys = ET.SubElement(root, 'keys')
-            key1 = ET.SubElement(keys, 'key')
-            key1.text = options.AK
-            key2 = ET.SubElement(keys, 'key')
-            key2.text = options.AS
-            key3 = ET.SubElement(keys, 'key')
-            key3.text = options.AK
-            key4 = ET.SubElement(keys, 'key')
-            key4.text = options.AK
-            tree = ET.ElementTree(root)
-            tree.write('.td')
-          
-
-        except IOError: #file not exist, write it
-          root = ET.element('root')
-          keys = ET.SubElement(root, 'keys')
-          key1 = ET.SubElement(keys, 'key')
-          key1.text = options.AK
-          key2 = ET.SubElement(keys, 'key')
-          key2.text = options.AS
-          key3 = ET.SubElement(keys, 'key')
-          key3.text = options.AK
-          key4 = ET.SubElement(keys, 'key')
-          key4.text = options.AK
-          tree = ET.ElementTree(root)
-          tree.write('.td')
-
-        AK = options.AK
-        AS = options.AS
-        AT = options.AT
-        ATS = options.ATS
-        
-      
-      found = False
-      cache[username] = TweetList(username,
-                                  options.amount,
-                                  AK,   #APP_KEY
-                                  AS,   #APP_SECRET
-                                  AT,   #AUTH_TOKEN
-                                  ATS)  #AUTH_TOKEN_SECRET
-      tweets = cache[username]
-
-      if not found:
-        # Try to cache the new chains.
-        try:
-          f = open(options.cache, 'w')
-        except IOError:
-          if options.verbose:
-            print ("Cannot open %s for writing." % options.cache)
-        else:
-          print (type(cache))
-          print (type(f))
-          pickle.dump(cache, f)
-          f.close()
-          if options.verbose:
-            print ("Wrote %s with data for %s." % (options.cache, username))
-
-    print (tweets.generate_text(options.order, options.length, options.split_words))
+        if options.verbose:
+          if evicted:
+            print ("Evicted %s from %s." % (', '.join(evicted), options.cache))
+          print ("Cache: %s" % ', '.join('%s=%d' % item
+              for item in sorted(cache.stats().items())))
+
+    if options.profile:
+      metrics.write()
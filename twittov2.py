@@ -6,9 +6,6 @@ Twittov
 	twittov applies the Markov model to a user's Twitter feed. For more info, see:
 		http://yaymukund.com/twittov/
 
-	It depends on the BeautifulSoup module, which you can get at:
-		http://www.crummy.com/software/BeautifulSoup/#Download
-
 	It should also be noted that twittov creates a file .twittov.cache for caching,
 	so we don't hammer the Twitter servers. However, the script never checks or
 	updates the cache. This means if you tweet after twittov has cached your
@@ -33,46 +30,185 @@ Twittov
 
 """
 
-import string, sys, urllib.request, urllib.error, random, pickle
-from bs4 import BeautifulSoup, SoupStrainer
+import string, sys, urllib.request, urllib.error, random, sqlite3, codecs
+from array import array
+from html.parser import HTMLParser
 from optparse import OptionParser
+from util import itrigrams
+from transitions import Transitions, merge_chains, prune_chains, chain_stats, branch_reach
+from arraymodel import ArrayModel
+from mappedmodel import MappedModel, save_mapped
+from cachestore import CacheStore
+from cachemanager import CacheManager, parse_size, parse_duration
+from fetch import fetch_users
+from mapreduce import map_reduce
+from normalize import tokenize, TokenStream
+import metrics
 
-def scrape(url): 
+# Where the tweet pages live. Point this somewhere else to test against a
+# local stand-in server.
+BASE_URL = 'http://www.twitter.com/'
 
-	"""	Returns a list of tweets, given a page like http://twitter.com/user?page=#
-			If there aren't any tweets on the page, we return an empty list.
+def pageURL(username, base=BASE_URL):
+
+	""" Returns the URL of a user's pages, up to the page number.
+	"""
+
+	return base + username + '?page='
+
+# How many bytes of a page we read at a time.
+CHUNK_SIZE = 16384
+
+class EntryParser(HTMLParser):
+
+	""" Pulls the text of every span.entry-content out of HTML fed to it in
+			chunks. Finished tweets collect in self.entries as soon as their closing
+			tag arrives, and nothing else on the page is kept.
+	"""
+
+	def __init__(self):
+		HTMLParser.__init__(self)
+		self.entries = []
+		self.text = []
+		self.depth = 0
+
+	def handle_starttag(self, tag, attrs):
+		if tag != 'span':
+			if self.depth:
+				self.text.append(' ')
+			return
+
+		if self.depth:
+			self.depth += 1
+		else:
+			for name, value in attrs:
+				if name == 'class' and value and 'entry-content' in value.split():
+					self.depth = 1
+					self.text = []
+
+	def handle_endtag(self, tag):
+		if not self.depth:
+			return
+		if tag != 'span':
+			self.text.append(' ')
+			return
+
+		self.depth -= 1
+		if not self.depth:
+			self.entries.append(''.join(self.text))
+
+	def handle_data(self, data):
+		if self.depth:
+			self.text.append(data)
+
+def entries(chunks, encoding = 'utf-8'):
+
+	""" Yields the tweets in a page as its chunks of bytes come in, without ever
+			holding the whole page. Outside of tweets we only search for the next
+			"entry-content" marker, so the parser never sees the rest of the markup.
+	"""
+
+	decoder = codecs.getincrementaldecoder(encoding)('replace')
+	parser = EntryParser()
+	text = ''
+
+	for chunk in chunks:
+		text = skim(parser, text + decoder.decode(chunk))
+		for entry in parser.entries:
+			yield entry
+		del parser.entries[:]
+
+	skim(parser, text + decoder.decode(b'', True))
+	parser.close()
+	for entry in parser.entries:
+		yield entry
+
+def skim(parser, text):
+
+	""" Feeds the parser just the tags that might open a tweet, and the tweets
+			themselves. Returns whatever is left over, to be continued in the next
+			chunk.
+	"""
+
+	while text:
+		if parser.depth:
+			# Inside a tweet: feed up to the next closing span.
+			end = text.find('</span>')
+			if end < 0:
+				end = text.rfind('<')
+				if end < 0:
+					end = len(text)
+				parser.feed(text[:end])
+				return text[end:]
+			parser.feed(text[:end + 7])
+			text = text[end + 7:]
+
+		else:
+			marker = text.find('entry-content')
+			if marker < 0:
+				# Keep the tag we're in the middle of, if any.
+				start = text.rfind('<')
+				if start < 0:
+					return ''
+				return text[start:]
+
+			start = text.rfind('<', 0, marker)
+			end = text.find('>', marker)
+			if start < 0 or end < 0:
+				return text[max(start, 0):]
+			parser.feed(text[start:end + 1])
+			text = text[end + 1:]
+
+	return ''
+
+def parse(page):
+
+	"""	Returns a list of tweets, given the HTML of a page of tweets. If there
+			aren't any tweets on the page, we return an empty list.
 	"""
 
-	tweets = []
+	if isinstance(page, str):
+		page = page.encode('utf-8')
+	metrics.count('pages_fetched')
+	with metrics.phase('parse'):
+		return list(entries([page]))
+
+def iterScrape(url):
 
-	# We make a SoupStrainer to speed up parsing.
-	entriesOnly  = SoupStrainer('span', 'entry-content')
+	"""	Yields the tweets on a page like http://twitter.com/user?page=# while it
+			downloads.
+	"""
 
 	try:
-	  page = urllib.request.urlopen(url).read()
-	  entries = BeautifulSoup(page, parseOnlyThese = entriesOnly)
+	  response = urllib.request.urlopen(url)
 
 	except urllib.error.HTTPError as error:
 		print ('The server couldn\'t fulfill your request.')
 		print ('Error code:', error.code)
 		exit(1)
 
-	else:
-		for entry in entries:
-			# Strip tags, convert to string, append to list.
-			tweet = entry.findAll(text = True)
-			tweet = string.join(tweet).encode('utf-8')
-			tweets.append(tweet)
+	metrics.count('pages_fetched')
+	with response:
+		encoding = response.headers.get_content_charset() or 'utf-8'
+		chunks = iter(lambda: response.read(CHUNK_SIZE), b'')
+		for entry in entries(chunks, encoding):
+			yield entry
+
+def scrape(url): 
+
+	"""	Returns a list of tweets, given a page like http://twitter.com/user?page=#
+			If there aren't any tweets on the page, we return an empty list.
+	"""
 
-	return tweets
+	return list(iterScrape(url))
 
-def getTweets(username):
+def getTweets(username, base=BASE_URL):
 
 	""" Given a Twitter username, we scrape their entries and return them as a list.
 	"""
 
 	allTweets = []
-	baseURL = 'http://www.twitter.com/' + username + '?page='
+	baseURL = pageURL(username, base)
 	pageNumber = 1
 
 	finished = False
@@ -86,7 +222,10 @@ def getTweets(username):
 			sys.stdout.flush()
 			sys.stdout.write('|')
 
-		tweets = scrape(baseURL + str(pageNumber))
+		# Pages are parsed while they download, so this times both.
+		with metrics.phase('fetch'):
+			tweets = scrape(baseURL + str(pageNumber))
+		metrics.count('tweets_fetched', len(tweets))
 		if not tweets: # Empty.
 			finished = True
 		else:
@@ -100,100 +239,448 @@ def getTweets(username):
 	
 	return allTweets
 
-def triples(words):
-	
-	""" Generates triples from the given data string. So if our string were
-			"What a lovely day", we'd generate (What, a, lovely) and then
-			(a, lovely, day).
+def warm(usernames, cache, base=BASE_URL):
+
+	""" Fetches many users' tweets at once and caches a table for each. Returns
+			the usernames that couldn't be fetched.
 	"""
-	
-	if len(words) < 3:
-		return
-	
-	for i in range(len(words) - 2):
-		yield (words[i], words[i+1], words[i+2])
+
+	failed = []
+	with metrics.phase('fetch'):
+		results = fetch_users(usernames, lambda username: pageURL(username, base),
+				parse, concurrency = options.concurrency, rate = options.rate)
+
+	for username, tweets in results.items():
+		if isinstance(tweets, Exception):
+			if not options.quiet:
+				print ('Couldn\'t fetch {0}: {1}'.format(username, tweets))
+			failed.append(username)
+			continue
+
+		metrics.count('tweets_fetched', len(tweets))
+		table = buildTable(tweets, username, options.workers or None)
+		try:
+			table, pruned = pruneTable(table)
+		except ValueError as e:
+			if not options.quiet:
+				print (e)
+			failed.append(username)
+			continue
+		if options.backend == 'array':
+			table.freeze()
+		with metrics.phase('cache_save'):
+			cache[username] = table
+		if options.verbose:
+			print ('Cached {0} tweets for {1}.'.format(len(tweets), username))
+
+	return failed
+
+def splitSentences(words):
+
+	""" Splits a list of words with a '\n' after each sentence into lists of
+			words, one per sentence.
+	"""
+
+	sentence = []
+	for word in words:
+		if word == '\n':
+			yield sentence
+			sentence = []
+		else:
+			sentence.append(word)
+	if sentence:
+		yield sentence
+
+def paragraphs(sentences):
+
+	""" Joins sentences, each a list of words, into paragraphs of
+			PARAGRAPH_SENTENCES sentences. Paragraphs are yielded as soon as they
+			are complete, so this works on an endless stream of sentences.
+	"""
+
+	paragraph = []
+	for sentence in sentences:
+		paragraph.append(' '.join(sentence))
+		if len(paragraph) == PARAGRAPH_SENTENCES:
+			yield ' '.join(paragraph)
+			paragraph = []
+	if paragraph:
+		yield ' '.join(paragraph)
+
+# How many sentences MarkovTable.seed tries before giving up.
+SEED_TRIES = 1000
+
+# The most words a sentence runs to. Pruning can leave loops that never reach
+# a tail, and sentences caught in one end here.
+SENTENCE_WORDS = 200
+
+# How many sentences make a paragraph.
+PARAGRAPH_SENTENCES = 6
 
 class MarkovTable:
 
-	""" This maintains a dictionary of Markov chains and heads.
+	""" This maintains a dictionary of Markov chains and heads. Heads and tails
+			are kept in order in lists, for picking at random, and indexed by sets,
+			for constant time lookups.
 	"""
 
+	# (randomness, heads) from the last call to reach(). Never pickled.
+	reachIndex = None
+
+	# The most branches a walk can pass from each pair (see branch_reach), in
+	# a dict for dict chains and in row order for frozen ones. Pickled, so it
+	# is only worked out when the chains change.
+	branchIndex = None
+
+	# The ArrayModel generate_batch converts dict chains to. Never pickled.
+	batchModel = None
+
+	# (heads, starts, model): the reach() heads generate_batch last started
+	# from, and their indices into model's heads. Never pickled.
+	batchStarts = None
+
+	# Tables pickled by older versions didn't keep their tokens.
+	tokens = None
+
+	# The (minCount, topK, deadEnds) the table was last pruned with, or None.
+	pruning = None
+
 	def __init__(self, data, name):
 		
 		self.name = name
 		self.chains = {}
 		self.heads = []
 		self.tails = []
+		self.headSet = set()
+		self.tailSet = set()
+		# Every tweet's normalized tokens, cached with the table.
+		self.tokens = TokenStream()
 
 		try:
 			self.chainify(data)
 		except TypeError as e:
 			if not options.quiet:
-				print ('Error: Data contains at least one non-str, non-list element.')
+				print ('Error: Data contains at least one element that is neither a string nor iterable.')
 			exit(1)
 
+	def __getstate__(self):
+
+		""" The head and tail sets are rebuilt on load rather than pickled twice.
+		"""
+
+		state = self.__dict__.copy()
+		state.pop('headSet', None)
+		state.pop('tailSet', None)
+		state.pop('reachIndex', None)
+		state.pop('batchModel', None)
+		state.pop('batchStarts', None)
+		return state
+
+	def __setstate__(self, state):
+
+		""" Tables pickled by older versions keep every successor in a list, so
+				we fold those into counted Transitions on load.
+		"""
+
+		self.__dict__.update(state)
+		if isinstance(self.chains, (ArrayModel, MappedModel)):
+			# The views are indexed already.
+			self.headSet = self.heads
+			self.tailSet = self.tails
+			return
+
+		self.headSet = set(self.heads)
+		self.tailSet = set(self.tails)
+
+		for pair, results in self.chains.items():
+			if isinstance(results, list):
+				transitions = Transitions()
+				for word in results:
+					transitions.add(word)
+				self.chains[pair] = transitions
+
 	def chainify(self, data):
 		
 		""" Processes the text and gathers a->b relations for the database. Input
-				can be either a sequence of strings, or a single string.
+				can be either a single string, any iterable of strings, such as a
+				generator streaming tweets in, or a TokenStream of tweets tokenized
+				already; each tweet is read exactly once.
 		"""
 
+		# New data invalidates the branching bounds and the batch model.
+		self.reachIndex = None
+		self.branchIndex = None
+		self.batchModel = None
+
 		if isinstance(data, str):
-			words = data.split()
-			for i in range(words.count('@')):
-				index = words.index('@')
-				if index < len(words) - 1:
-					words[index+1] = '@' + words[index+1]
-				words.pop(index)
-
-			if len(words) >= 3:
-				head = (words[0], words[1])
-				if head not in self.heads:
-					self.heads.append(head)
-
-				tail = (words[-2], words[-1])
-				if tail not in self.tails:
-					self.tails.append(tail)
-
-			for w1, w2, w3 in triples(words):
-				pair = (w1, w2)
-				if pair not in self.chains:
-					self.chains[pair] = [w3]
-				else:
-					self.chains[pair].append(w3)
-
-		elif isinstance(data, list) or isinstance(data, tuple):
-			for tweet in data:
-				try:
-					self.chainify(tweet)
-				except TypeError:
-					raise
+			self.addTweet(data)
+			return
+
+		if isinstance(data, TokenStream):
+			for words in data:
+				self.addWords(words)
+			return
+
+		try:
+			tweets = iter(data)
+		except TypeError:
+			raise TypeError('cannot chainify %r' % type(data).__name__)
+
+		for tweet in tweets:
+			if isinstance(tweet, str):
+				self.addTweet(tweet)
+			else:
+				self.chainify(tweet)
+
+	def addTweet(self, text):
+
+		""" Tokenizes a single tweet (see normalize.py) and adds it.
+		"""
+
+		self.addWords(tokenize(text))
+
+	def addWords(self, words):
+
+		""" Adds a single tweet's words, heads and tails, in one pass over them.
+		"""
+
+		if self.tokens is not None:
+			self.tokens.add_tokens(words)
+		if len(words) < 3:
+			return
+
+		head = (words[0], words[1])
+		if head not in self.headSet:
+			self.headSet.add(head)
+			self.heads.append(head)
+
+		tail = (words[-2], words[-1])
+		if tail not in self.tailSet:
+			self.tailSet.add(tail)
+			self.tails.append(tail)
+
+		chains = self.chains
+		for w1, w2, w3 in itrigrams(words):
+			transitions = chains.get((w1, w2))
+			if transitions is None:
+				transitions = chains[(w1, w2)] = Transitions()
+			transitions.add(w3)
+
+	@staticmethod
+	def merge(tables, weights = None, name = None):
+
+		""" Sums several tables into a new one, leaving them intact. Parallel
+				builds merge their per-shard tables this way, and merging the tables of
+				several users blends them; weights, one positive integer per table,
+				scale their counts. Frozen tables can be merged too, but the result
+				isn't frozen. Each table's tokens are kept as many times as its weight,
+				so rebuilding from them gives the blend back; if any table has no
+				tokens, neither has the result, and it can't be rebuilt.
+		"""
+
+		table = MarkovTable([], name)
+		table.chains = merge_chains([other.chains for other in tables], weights)
+		if weights is None:
+			weights = [1] * len(tables)
+
+		for other, weight in zip(tables, weights):
+			if other.tokens is None:
+				table.tokens = None
+			elif table.tokens is not None:
+				for i in range(weight):
+					table.tokens.merge(other.tokens)
+			for head in other.heads:
+				if head not in table.headSet:
+					table.headSet.add(head)
+					table.heads.append(head)
+			for tail in other.tails:
+				if tail not in table.tailSet:
+					table.tailSet.add(tail)
+					table.tails.append(tail)
+
+		return table
+
+	def freeze(self):
+
+		""" Swaps the chains, heads and tails for a compact, array-backed copy.
+				Generation works exactly as before, but the table can't take any more
+				data afterwards.
+		"""
+
+		if not isinstance(self.chains, ArrayModel):
+			model = ArrayModel.from_chains(self.chains, 2, self.heads, self.tails)
+			if self.branchIndex is not None:
+				self.branchIndex = array('I', [self.branchIndex[pair] for pair in model])
+			self.chains = model
+			self.reachIndex = None
+			self.batchModel = None
+			self.heads = self.headSet = model.heads
+			self.tails = self.tailSet = model.tails
+
+	def prune(self, minCount = 1, topK = None, deadEnds = False):
+
+		""" Compacts the chains after a build: drops successors seen fewer than
+				minCount times after a pair, keeps only the topK most frequent ones
+				of each pair, and, with deadEnds, drops successors that lead only to
+				pairs with nowhere left to go, unless a tweet ended there. Pairs left
+				with no successors go, and so do heads whose pair went. Generation
+				works as before, with a little less variety. A frozen or mapped table
+				comes back frozen. Returns a dict of (before, after) pairs for states,
+				transitions and bytes, the size of the pickled chains, or of their
+				arrays for a frozen or mapped table; bytes are None if there was
+				nothing to prune.
+		"""
 
+		self.pruning = (minCount, topK, deadEnds)
+		with metrics.phase('prune'):
+			before = chain_stats(self.chains)
+			chains = prune_chains(self.chains, minCount, topK,
+					self.tails if deadEnds else None)
+			after = chain_stats(chains)
+			if after == before:
+				return dict(states = (before[0],) * 2, transitions = (before[1],) * 2,
+						bytes = (None, None))
+
+			# Only now is it worth pickling both to see what was saved.
+			before = chain_stats(self.chains, True)
+			frozen = not isinstance(self.chains, dict)
+			self.chains = chains
+			self.reachIndex = None
+			self.branchIndex = None
+			self.batchModel = None
+			self.heads = [head for head in self.heads if head in chains]
+			self.headSet = set(self.heads)
+			self.tails = list(self.tails)
+			self.tailSet = set(self.tails)
+			if frozen:
+				self.freeze()
+			self.indexBranches()
+			after = chain_stats(self.chains, True)
+
+		metrics.count('pruned_states', before[0] - after[0])
+		metrics.count('pruned_transitions', before[1] - after[1])
+		return dict(states = (before[0], after[0]),
+				transitions = (before[1], after[1]), bytes = (before[2], after[2]))
+
+	def export(self, path):
+
+		""" Saves the chains, heads and tails to path in the mapped format (see
+				mappedmodel.py), for mapped() to open.
+		"""
+
+		if isinstance(self.chains, ArrayModel):
+			model = self.chains
+		else:
+			model = ArrayModel.from_chains(self.chains, 2, self.heads, self.tails)
+		save_mapped(model, path)
+
+	@staticmethod
+	def mapped(path, name = None):
+
+		""" Opens a table saved by export(). Like a frozen table, it generates
+				but takes no more data, and its chains stay on disk: every process
+				that opens the same file shares one copy of it.
+		"""
+
+		table = MarkovTable([], name)
+		model = MappedModel(path)
+		table.chains = model
+		table.heads = table.headSet = model.heads
+		table.tails = table.tailSet = model.tails
+		return table
+
+	def indexBranches(self):
+
+		""" Works out how many branches a sentence can still collect from each
+				pair, for reach(). A pair's branching is the number of its successors
+				beyond the first, counted by weight, and its reach is its branching
+				plus the best reach among the pairs it leads to, unbounded where it can
+				loop through a pair that branches.
+		"""
+
+		with metrics.phase('index'):
+			reach = branch_reach(self.chains)
+			if isinstance(self.chains, dict):
+				reach = dict(zip(self.chains, reach))
+			self.branchIndex = reach
+			self.reachIndex = None
+
+	def reachOf(self, pair):
+
+		""" Returns the reach of a pair (see indexBranches), or 0 if it has no
+				successors.
+		"""
+
+		if isinstance(self.branchIndex, dict):
+			return self.branchIndex.get(pair, 0)
+		row = self.chains.get(pair)
+		if row is None:
+			return 0
+		return self.branchIndex[row.row]
+
+	def reach(self, randomness):
+
+		""" Bounds how many branches a sentence can still collect from each pair,
+				so genSeed can skip heads and give up on walks that can't meet the
+				randomness threshold. Returns (reach, heads), where reach is
+				reachOf and heads are the heads that can meet the threshold. The
+				index behind reach is built once for the chains; heads are kept
+				until the randomness changes.
+		"""
+
+		if self.branchIndex is None:
+			self.indexBranches()
+		if self.reachIndex is not None and self.reachIndex[0] == randomness:
+			return self.reachOf, self.reachIndex[1]
+
+		# The first word after a head is free: genSeed doesn't count it.
+		chains = self.chains
+		if isinstance(self.branchIndex, dict):
+			heads = [head for head in self.heads if max(self.reachOf((head[1], word))
+					for word in chains[head]) >= randomness]
 		else:
-			raise TypeError
+			# Follow the rows rather than look every pair up.
+			index, offsets = self.branchIndex, chains.offsets
+			heads = [self.heads[i] for i, row in enumerate(chains.head_rows)
+					if max(index[following] if following >= 0 else 0 for following in
+					chains.next_rows[offsets[row]:offsets[row + 1]]) >= randomness]
+
+		self.reachIndex = (randomness, heads)
+		return self.reachOf, heads
 
 	def genSeed(self, randomness):
 	
 		""" Uses the Markov chains to generate a single sentence. If we can't meet
-				the randomness threshold, the function returns False.
+				the randomness threshold, the function returns False. Only heads that
+				can meet it are tried, and the walk is abandoned as soon as it can't.
 		"""
 
-		seed = random.choice(self.heads)
-		text = [ seed[0], seed[1], random.choice(self.chains[seed]) ]
+		reach, heads = self.reach(randomness)
+		if not heads:
+			return False
+
+		seed = random.choice(heads)
+		text = [ seed[0], seed[1], self.chains[seed].sample() ]
 
 		branches = 0
 		while (text[-2], text[-1]) in self.chains:
 			results = self.chains[(text[-2], text[-1])]
-			branches = branches + len(results) - 1
-			text.append(random.choice(results))
+			branches = branches + results.total - 1
+			text.append(results.sample())
 
 			# If it's long and we're at a tail, we can stop.
-			if len(text) >= 10 and (text[-2], text[-1]) in self.tails:
+			if len(text) >= 10 and (text[-2], text[-1]) in self.tailSet:
 				break
 
 			# We check to make sure we're not infinite looping.
 			if len(text) >= 3 and text[-1] == text[-2] and text[-2] == text[-3]:
 				break
+			if len(text) >= SENTENCE_WORDS:
+				break
+
+			# Give up early if the rest of the walk can't make up the difference.
+			if branches + reach((text[-2], text[-1])) < randomness:
+				return False
 			
 		if branches < randomness:
 			return False 
@@ -206,49 +693,208 @@ class MarkovTable:
 		""" Converts the text to a string, and then converts to paragraphs.
 		"""
 
-		text = string.join(textArray)
-		text = text.split('\n')
+		return '\n\n'.join(paragraphs(splitSentences(textArray)))
 
-		i = 1
-		length = len(text)
-		while i < length:
-			if not i % 6:
-				i += 1
-				text.insert(i, '\n\n')
-			i += 1
-			length = len(text)
-
-		text = string.join(text).strip()
-		return text
-
-	def markov(self, length, randomness, text = ''):
+	def markov(self, length, randomness):
 	
 		""" Uses our markov chains to generate text of a minimum no. words.
 		"""
 
-		# If text is empty, we have to generate a seed.
-		tries = 0
-		while not text:
+		with metrics.phase('generate'):
+			return '\n\n'.join(self.iterParagraphs(length, randomness))
+
+	def iterSentences(self, randomness):
+
+		""" Yields sentences that meet the randomness threshold, forever. Each is
+				a list of words.
+		"""
+
+		while True:
+			yield self.seed(randomness)[:-1]
+
+	def iterParagraphs(self, length, randomness):
+
+		""" Yields the paragraphs of a text of a minimum no. words, one at a time,
+				so only the current paragraph is ever held in memory.
+		"""
+
+		def sentences():
+			words = 0
+			for sentence in self.iterSentences(randomness):
+				yield sentence
+				words += len(sentence)
+				if words >= length:
+					return
+
+		return paragraphs(sentences())
+
+	def writeText(self, out, length, randomness):
+
+		""" Streams a text of a minimum no. words to out, anything with a write
+				method taking strings, a paragraph at a time.
+		"""
+
+		with metrics.phase('generate'):
+			for i, paragraph in enumerate(self.iterParagraphs(length, randomness)):
+				if i:
+					out.write('\n\n')
+				out.write(paragraph)
+
+	def seed(self, randomness):
+
+		""" Calls genSeed until it produces a sentence, and exits if it can't. Walks
+				that can't succeed are cut short, so we can afford many more tries
+				than we could when every one of them ran to the end of a chain.
+		"""
+
+		if not self.reach(randomness)[1]:
+			print ('No sentence can reach that randomness. Try decreasing it.')
+			exit(1)
+
+		for i in range(SEED_TRIES):
 			text = self.genSeed(randomness)
-			tries += 1
-			if tries > 100:
-				print ('Couldn\'t produce a seed. Try decreasing the randomness.')
-				exit(1)
-		if len(text) >= length:
-			return self.prettify(text)
+			if text:
+				metrics.count('seed_retries', i)
+				return text
 
+		metrics.count('seed_retries', SEED_TRIES)
+		print ('Couldn\'t produce a seed. Try decreasing the randomness.')
+		exit(1)
+
+	def generate_batch(self, n, length, randomness):
+
+		""" Generates n texts in one call, walking their sentences in lockstep.
+				Each text gets sentences that meet the randomness threshold until it
+				has at least length words, counted as markov counts them, and
+				sentences start only from heads that can meet the threshold. This
+				needs NumPy. Dict chains are converted to an ArrayModel on the first
+				call, and the conversion is kept until the chains change.
+		"""
+
+		if isinstance(self.chains, ArrayModel):
+			model = self.chains
 		else:
-			text.extend(self.genSeed(randomness))
-			return self.markov(length, randomness, text)
+			if self.batchModel is None:
+				self.batchModel = ArrayModel.from_chains(self.chains, 2, self.heads, self.tails)
+			model = self.batchModel
+
+		heads = self.reach(randomness)[1]
+		if not heads:
+			print ('No sentence can reach that randomness. Try decreasing it.')
+			exit(1)
+		if self.batchStarts is None or self.batchStarts[0] is not heads or self.batchStarts[2] is not model:
+			positions = dict((head, i) for i, head in enumerate(model.heads))
+			self.batchStarts = (heads, [positions[head] for head in heads], model)
+		starts = self.batchStarts[1]
+
+		with metrics.phase('generate'):
+			texts = [[] for i in range(n)]
+			words = [0] * n
+			waiting = list(range(n))
+			tries = 0
+			while waiting:
+				sentences, branches = model.sample_sentences(len(waiting),
+						max_length = SENTENCE_WORDS, starts = starts)
+				kept = [text for text, count in zip(sentences, branches) if count >= randomness]
+				metrics.count('seed_retries', len(sentences) - len(kept))
+				# Every waiting text gets one try a round, so give up after as many
+				# fruitless rounds as seed gives one sentence tries.
+				if not kept:
+					tries += 1
+					if tries >= SEED_TRIES:
+						print ('Couldn\'t produce a seed. Try decreasing the randomness.')
+						exit(1)
+					continue
+				tries = 0
+
+				for i, text in zip(list(waiting), kept):
+					texts[i].extend(text)
+					texts[i].append('\n')
+					words[i] += len(text)
+					if words[i] >= length:
+						waiting.remove(i)
+
+			return [self.prettify(text) for text in texts]
+
+def pruneTable(table):
+
+	""" Prunes a table as the command line asks, building it afresh from its
+			tokens first if it was pruned some other way. Returns the table, which
+			may be a new one, and whether it changed. Raises ValueError if pruning
+			left no heads, so the table can't generate and mustn't be cached.
+	"""
+
+	if options.minCount > 1 or options.topK is not None or options.deadEnds:
+		pruning = (options.minCount, options.topK, bool(options.deadEnds))
+	else:
+		pruning = None
+	if table.pruning == pruning:
+		return table, False
+
+	# Without its tokens, a table can only be pruned further.
+	changed = False
+	if table.pruning is not None and table.tokens is not None:
+		table = rebuildTable(table)
+		changed = True
+	if pruning is None:
+		return table, changed
+
+	report = table.prune(*pruning)
+	states, transitions, size = report['states'], report['transitions'], report['bytes']
+	if options.verbose and size[0] is not None:
+		print ('Pruned {0} to {1} of {2} states and {3} of {4} transitions, '
+				'from {5} to {6} bytes ({7:.0%} saved).'.format(table.name, states[1],
+				states[0], transitions[1], transitions[0], size[0], size[1],
+				1 - size[1] / float(size[0])))
+	if not table.heads:
+		raise ValueError('Pruning left {0} no heads to start from. Try pruning less.'.format(table.name))
+	return table, True
+
+def rebuildTable(table):
+
+	""" Builds a table afresh from the tokens cached with it, undoing any
+			pruning or freezing.
+	"""
+
+	with metrics.phase('chainify'):
+		fresh = MarkovTable(table.tokens, table.name)
+	fresh.indexBranches()
+	return fresh
+
+def partialTable(tweets):
+
+	""" Builds an unnamed table from a shard of tweets, in a worker process.
+	"""
+
+	return MarkovTable(tweets, None)
+
+def buildTable(tweets, name, workers = 1):
+
+	""" Builds the table for a list of tweets, on workers processes at once if
+			there are enough tweets to make that pay. None means one per CPU.
+	"""
+
+	with metrics.phase('chainify'):
+		table = map_reduce(tweets, partialTable, MarkovTable.merge, workers)
+	table.name = name
+
+	# Counted here, as workers' counts stay in their own processes.
+	metrics.count('tweets_ingested', len(tweets))
+	metrics.count('states', len(table.chains))
+	metrics.count('transitions', sum([len(results) for results in table.chains.values()]))
+
+	# Index now, so the index is cached along with the table.
+	table.indexBranches()
+	return table
 
 """	Routine script stuff. We parse the arguments, generate the database, and
-		run the Markov algorithm. Note that we use the pickle() functions to cache
-		everything in .twittov.cache.
+		run the Markov algorithm. Note that we cache everything in .twittov.cache,
+		one pickled entry per user (see cachestore.py).
 """
 
 # Standard argument parsing using the optparse module.
 parser = OptionParser(usage='Usage: twittov.py [options] username')
-parser.set_defaults(verbose=False, quiet=False, randomness=15, length=1, cache='.twittov.cache', mustCache=False)
+parser.set_defaults(verbose=False, quiet=False, randomness=15, length=1, cache='.twittov.cache', mustCache=False, backend='dict', compact=False, warm=None, base=BASE_URL, concurrency=16, rate=None, workers=1, profile=False, minCount=1, topK=None, deadEnds=False, cache_budget=None, evict='lru', ttl=None)
 
 parser.add_option('-q', '--quiet', action='store_true', dest='quiet', help='Don\'t print status messages to stdout.')
 parser.add_option('-v', '--verbose', action='store_true', dest='verbose', help='Print all messages to stdout.')
@@ -256,62 +902,178 @@ parser.add_option('-r', '--randomness', type='int', dest='randomness', help='Set
 parser.add_option('-l', '--length', type='int', dest='length', metavar='NUMWORDS', help='Sets the *minimum* output length, in number of words. NUMWORDS must be a positive integer. Default is 1.')
 parser.add_option('-c', '--cache-file', dest='cache', type='string', metavar='FILE', help='Sets the cache file. By default, we save to .twittov.cache')
 parser.add_option('-f', '--force-cache-update', action='store_true', dest='mustCache', help='Force download all tweets and update cache, even if username is already in cache.')
+parser.add_option('-C', '--compact-cache', action='store_true', dest='compact', help='Rewrite the cache file without superseded entries, then exit.')
+parser.add_option('--cache-budget', dest='cache_budget', type='string', metavar='SIZE', help='Evict the coldest users once the cache holds more than SIZE, e.g. 500M. Unbounded by default.')
+parser.add_option('--evict', type='choice', choices=['lru', 'lfu'], dest='evict', help='Which users --cache-budget evicts first: "lru", least recently used, or "lfu", least often used. Default is lru.')
+parser.add_option('--ttl', dest='ttl', type='string', metavar='DURATION', help='Fetch users cached longer ago than DURATION, e.g. 12h or 7d, again, as with -f. Never by default.')
+parser.add_option('-b', '--backend', type='choice', choices=['dict', 'array'], dest='backend', help='How to store the chains: "dict" or the compact "array". Default is dict.')
+parser.add_option('--min-count', type='int', dest='minCount', metavar='COUNT', help='Prune successors seen fewer than COUNT times after a pair. Default is 1, keeping them all.')
+parser.add_option('--top-k', type='int', dest='topK', metavar='K', help='Prune all but the K most frequent successors of each pair. All are kept by default.')
+parser.add_option('--drop-dead-ends', action='store_true', dest='deadEnds', help='Prune successors that lead only where no tweet ended and nothing follows.')
+parser.add_option('-w', '--warm', dest='warm', type='string', metavar='FILE', help='Fetch and cache every username listed in FILE, many at once, then exit.')
+parser.add_option('--base-url', dest='base', type='string', metavar='URL', help='Where to fetch pages from. Default is http://www.twitter.com/')
+parser.add_option('--concurrency', type='int', dest='concurrency', help='How many pages --warm fetches at once. Default is 16.')
+parser.add_option('-j', '--workers', type='int', dest='workers', help='How many processes build each table. 0 means one per CPU. Default is 1.')
+parser.add_option('--rate', type='float', dest='rate', help='The most requests per second --warm sends to one host. Unlimited by default.')
+parser.add_option('--profile', action='store_true', dest='profile', help='When done, print JSON timings, counters and peak memory to stderr.')
 
-(options, args) = parser.parse_args()
+# The defaults stand in for the command line when we're imported as a module.
+options = parser.get_default_values()
 
-# Check if the parameters are all well formed.
-if len(args) != 1:
-	parser.error('Incorrect number of arguments. Remember to specify a Twitter username.')
-else:
-	username = args[0]
+if __name__ == '__main__':
 
-if options.quiet and options.verbose:
-	parser.error('"quiet" and "verbose" are mutually exclusive.')
+	(options, args) = parser.parse_args()
 
-if options.length <= 0:
-	parser.error('Length must be a positive integer.')
+	if options.profile:
+		metrics.track_memory()
 
-# We're caching all previous chains for now, so we don't overload Twitter.
-try:
-	with open(options.cache, 'rb') as f:
-		cache = pickle.load(f)
-except IOError:
-	if options.verbose:
-		print ('Cannot open {0} for reading.'.format(options.cache))
-	cache = {}
-except EOFError:
-	cache = {}
-else:
-	
-	if options.verbose:
-		print ('Loaded cache from "{0}" successfully.'.format(options.cache))
-	f.close()
+	# Compacting the cache doesn't need a username.
+	if options.compact:
+		dropped = CacheStore(options.cache, 'twittov2').compact()
+		if options.verbose:
+			print ('Dropped {0} stale entries from "{1}".'.format(dropped, options.cache))
+		sys.exit(0)
 
-# If it's in the cache, let's not generate anything.
-if not options.mustCache and username in cache:
-	table = cache[username]
-	found = True
-	if options.verbose:
-		print ('{0}\'s tweets are already cached.'.format(username))
+	# Check if the parameters are all well formed.
+	if options.warm:
+		if args:
+			parser.error('--warm takes its usernames from a file, not the command line.')
+	elif len(args) != 1:
+		parser.error('Incorrect number of arguments. Remember to specify a Twitter username.')
+	else:
+		username = args[0]
+
+	if options.quiet and options.verbose:
+		parser.error('"quiet" and "verbose" are mutually exclusive.')
+
+	if options.length <= 0:
+		parser.error('Length must be a positive integer.')
+
+	if options.concurrency <= 0:
+		parser.error('Concurrency must be a positive integer.')
+
+	if options.workers < 0:
+		parser.error('Workers must be a positive integer, or 0 for one per CPU.')
+
+	if options.minCount <= 0:
+		parser.error('Min count must be a positive integer.')
+
+	if options.topK is not None and options.topK <= 0:
+		parser.error('Top k must be a positive integer.')
 
-# Otherwise, we should parse pages.
-else:
-	found = False
-	tweets = getTweets(username)
-	table = MarkovTable(tweets, username)
-	cache[username] = table
+	try:
+		if options.cache_budget is not None:
+			options.cache_budget = parse_size(options.cache_budget)
+		if options.ttl is not None:
+			options.ttl = parse_duration(options.ttl)
+	except ValueError as error:
+		parser.error(str(error))
+
+	# We're caching all previous chains for now, so we don't overload Twitter.
+	# Only the entry for this username is ever unpickled.
+	try:
+		cache = CacheManager(CacheStore(options.cache, 'twittov2'),
+			disk_budget=options.cache_budget, policy=options.evict, ttl=options.ttl)
+	except (IOError, OSError, sqlite3.Error):
+		if options.verbose:
+			print ('Cannot open {0} for reading.'.format(options.cache))
+		cache = {}
+	else:
+		if options.verbose:
+			print ('Opened cache "{0}" successfully.'.format(options.cache))
+
+	def isFresh(name):
+		""" Checks whether name is cached, and not for longer than --ttl. """
+		if name not in cache:
+			return False
+		return not (isinstance(cache, CacheManager) and cache.is_stale(name))
+
+	# Bulk warm-up: fetch everyone in the list that isn't cached yet.
+	if options.warm:
+		with open(options.warm) as f:
+			usernames = [line.strip() for line in f if line.strip()]
+		if not options.mustCache:
+			usernames = [name for name in usernames if not isFresh(name)]
+		failed = warm(usernames, cache, options.base)
+		if not options.quiet:
+			print ('Cached {0} of {1} users.'.format(len(usernames) - len(failed), len(usernames)))
+		if isinstance(cache, CacheManager):
+			cache.enforce(keep=set(usernames))
+		if options.profile:
+			metrics.write()
+		sys.exit(1 if failed else 0)
+
+	# If it's in the cache, let's not generate anything.
+	if not options.mustCache and isFresh(username):
+		with metrics.phase('cache_load'):
+			table = cache[username]
+		found = True
+		if options.verbose:
+			print ('{0}\'s tweets are already cached.'.format(username))
+
+	# Otherwise, we should parse pages.
+	else:
+		found = False
+		tweets = getTweets(username, options.base)
+		table = buildTable(tweets, username, options.workers or None)
+
+	# A cached table frozen for -b array goes back to dicts, built again from
+	# its tokens, when run without it.
+	if options.backend == 'dict' and isinstance(table.chains, ArrayModel) and table.tokens is not None:
+		table = rebuildTable(table)
+		found = False
+
+	# Prune before freezing and caching. A cached table pruned differently is
+	# built again from its tokens and cached again, so later runs load it as
+	# asked.
+	try:
+		table, pruned = pruneTable(table)
+	except ValueError as e:
+		print (e)
+		exit(1)
+	if pruned:
+		found = False
+
+	# A cached table that isn't frozen yet is frozen now, and cached again.
+	if options.backend == 'array' and not isinstance(table.chains, ArrayModel):
+		table.freeze()
+		found = False
+
+	# So is one cached before tables kept their branch index.
+	if table.branchIndex is None:
+		table.indexBranches()
+		found = False
 
 	if not found:
 		# Try to cache the new chains.
 		try:
-			f = open(options.cache, 'wb')
-		except IOError:
+			with metrics.phase('cache_save'):
+				cache[username] = table
+		except sqlite3.Error:
 			if not options.quiet:
-				print ('Cannot open "{0}" for writing.'.format(options.cache))
+				print ('Cannot write to "{0}".'.format(options.cache))
 		else:
-			pickle.dump(cache, f)
-			f.close()
 			if not options.quiet:
 				print ('Wrote "{0}" with data for {1}.'.format(options.cache, username))
 
-print (table.markov(options.length, options.randomness))
+	# Stream the text out, so even book-length output runs in little memory.
+	table.writeText(sys.stdout, options.length, options.randomness)
+	print ()
+
+	# Now that the output is out, evict whatever is over budget, and tidy up if
+	# superseded entries have piled up.
+	if isinstance(cache, CacheManager):
+		try:
+			evicted = cache.enforce(keep=(username,))
+		except sqlite3.Error:
+			if options.verbose:
+				print ('Cannot compact "{0}".'.format(options.cache))
+		else:
+			if options.verbose:
+				if evicted:
+					print ('Evicted {0} from "{1}".'.format(', '.join(evicted), options.cache))
+				print ('Cache: {0}'.format(', '.join('{0}={1}'.format(*item)
+					for item in sorted(cache.stats().items()))))
+
+	if options.profile:
+		metrics.write()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+"""Serves generated text from models kept warm in memory.
+
+  Every run of twittov.py or twittov2.py pays for interpreter startup, opening
+  the cache and building a model before it produces one string. twittovd
+  loads each account once, keeps the most recently used ones in memory, and
+  answers generate requests over HTTP, on a TCP port or a Unix socket.
+
+  GET /generate?user=NAME answers with {"text": ...}. Other parameters:
+
+    engine      -- twittov (the default) or twittov2.
+    order       -- twittov: the order of the markov chains. Default is 3.
+    length      -- twittov: minimum length in characters. Default is 160.
+                   twittov2: minimum length in words. Default is 1.
+    max_length  -- twittov: maximum length in characters. Unbounded by default.
+    split_words -- twittov: 1 to work on letters rather than words.
+    backend     -- twittov: dict (the default), array or char (with split_words).
+    randomness  -- twittov2: the randomness of the output. Default is 15.
+
+  GET /stats answers with request counts, p50 and p99 latencies and the
+  accounts currently in memory.
+
+  Only accounts already in the cache are served; fetch new ones with the
+  regular scripts. Each account loads and compiles under a lock of its own,
+  so a slow load never holds up requests for accounts already in memory.
+
+"""
+
+import sys, json, time, threading, collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import urlsplit, parse_qs
+from optparse import OptionParser
+from cachestore import CacheStore
+
+ENGINES = ('twittov', 'twittov2')
+BACKENDS = ('dict', 'array', 'char')
+
+# How many recent request latencies the percentiles are taken over.
+LATENCY_WINDOW = 10000
+
+
+class ModelServer(object):
+  """Keeps up to max_models accounts in memory, least recently used first out.
+
+  Keyword arguments:
+  cache -- The cache file to load accounts from.
+  max_models -- How many accounts to keep warm.
+
+  """
+
+  def __init__(self, cache, max_models=64):
+    self.cache = cache
+    self.max_models = max_models
+    self.models = collections.OrderedDict()
+    self.lock = threading.Lock()
+    # One lock per account, held while it loads or compiles.
+    self.locks = {}
+    self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+    self.requests = 0
+    self.loads = 0
+
+  def get(self, engine, user):
+    """Return the TweetList or MarkovTable for user, loading it if needed."""
+    key = (engine, user)
+    with self.lock:
+      if key in self.models:
+        self.models.move_to_end(key)
+        return self.models[key]
+      lock = self.locks.setdefault(key, threading.Lock())
+
+    with lock:
+      # Another request may have loaded it while we waited.
+      with self.lock:
+        if key in self.models:
+          self.models.move_to_end(key)
+          return self.models[key]
+
+      # A connection can't be shared across threads, so open one per load.
+      store = CacheStore(self.cache, engine)
+      try:
+        model = store[user]
+      except KeyError:
+        # Don't keep a lock around for every name anyone asked for.
+        with self.lock:
+          self.locks.pop(key, None)
+        raise
+      finally:
+        store.close()
+
+      with self.lock:
+        self.models[key] = model
+        self.loads += 1
+        while len(self.models) > self.max_models:
+          evicted, _ = self.models.popitem(last=False)
+          self.locks.pop(evicted, None)
+      return model
+
+  def lock_for(self, engine, user):
+    """Return the lock that guards loading and compiling user's model."""
+    with self.lock:
+      return self.locks.setdefault((engine, user), threading.Lock())
+
+  def generate(self, params):
+    """Generate one text for the parsed query string params."""
+    def param(name, default, kind=int):
+      return kind(params.get(name, [default])[0])
+
+    def positive(name, default):
+      try:
+        value = param(name, default)
+      except ValueError:
+        value = 0
+      if value <= 0:
+        raise ValueError('%s must be a positive integer' % name)
+      return value
+
+    engine = param('engine', 'twittov', str)
+    if engine not in ENGINES:
+      raise ValueError('engine must be one of %s' % ', '.join(ENGINES))
+    backend = param('backend', 'dict', str)
+    if backend not in BACKENDS:
+      raise ValueError('backend must be one of %s' % ', '.join(BACKENDS))
+    split_words = bool(param('split_words', 0))
+    if backend == 'char' and not split_words:
+      raise ValueError('the char backend needs split_words=1')
+    order = positive('order', 3)
+    length = positive('length', 160 if engine == 'twittov' else 1)
+    max_length = None
+    if 'max_length' in params:
+      max_length = positive('max_length', None)
+    randomness = param('randomness', 15)
+
+    user = param('user', None, str)
+    model = self.get(engine, user)
+
+    if engine == 'twittov':
+      with self.lock_for(engine, user):
+        model.compile(order, split_words, backend)
+      text = model.generate_text(order, length, split_words, backend,
+          max_length).decode('utf-8')
+    else:
+      text = model.markov(length, randomness)
+
+    return text
+
+  def record(self, seconds):
+    with self.lock:
+      self.requests += 1
+      self.latencies.append(seconds)
+
+  def stats(self):
+    with self.lock:
+      latencies = sorted(self.latencies)
+      accounts = ['%s/%s' % key for key in self.models]
+
+    def percentile(p):
+      if not latencies:
+        return None
+      return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+
+    return {
+      'requests': self.requests,
+      'loads': self.loads,
+      'p50_ms': percentile(0.50),
+      'p99_ms': percentile(0.99),
+      'models': accounts,
+    }
+
+
+class Handler(BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    url = urlsplit(self.path)
+    if url.path == '/stats':
+      return self.reply(200, self.server.models.stats())
+    if url.path != '/generate':
+      return self.reply(404, {'error': 'unknown path %s' % url.path})
+
+    start = time.perf_counter()
+    params = parse_qs(url.query)
+    if 'user' not in params:
+      return self.reply(400, {'error': 'user is required'})
+
+    try:
+      text = self.server.models.generate(params)
+    except KeyError:
+      return self.reply(404, {'error': '%s is not cached' % params['user'][0]})
+    except ValueError as error:
+      return self.reply(400, {'error': str(error)})
+    except SystemExit:
+      # twittov2 gives up this way when it can't meet the randomness.
+      return self.reply(422, {'error': 'could not generate; try less randomness'})
+    except Exception as error:
+      return self.reply(500, {'error': '%s: %s' % (type(error).__name__, error)})
+
+    self.server.models.record(time.perf_counter() - start)
+    self.reply(200, {'text': text})
+
+  def reply(self, code, body):
+    data = json.dumps(body).encode('utf-8')
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      sys.stderr.write('%s\n' % (format % args))
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+  daemon_threads = True
+
+  def get_request(self):
+    # BaseHTTPRequestHandler expects a (host, port) client address.
+    request, address = UnixStreamServer.get_request(self)
+    return request, ('unix', 0)
+
+
+def serve(models, host='127.0.0.1', port=8321, path=None, verbose=False):
+  """Serve models until interrupted, on path if given, else on host:port."""
+  if path:
+    server = UnixHTTPServer(path, Handler)
+  else:
+    server = ThreadingHTTPServer((host, port), Handler)
+  server.models = models
+  server.verbose = verbose
+
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+
+if __name__ == '__main__':
+
+  parser = OptionParser(usage='Usage: twittovd.py [options]')
+  parser.set_defaults(host='127.0.0.1', port=8321, socket=None, cache='.twittov.cache', max_models=64, verbose=False)
+
+  parser.add_option('-H', '--host', dest='host', type='string', help='The address to listen on. Default is 127.0.0.1.')
+  parser.add_option('-p', '--port', dest='port', type='int', help='The port to listen on. Default is 8321.')
+  parser.add_option('-u', '--socket', dest='socket', type='string', metavar='PATH', help='Listen on a Unix socket at PATH instead of a port.')
+  parser.add_option('-c', '--cache-file', dest='cache', type='string', metavar='FILE', help='Sets the cache file. By default, we read .twittov.cache')
+  parser.add_option('-m', '--max-models', dest='max_models', type='int', help='How many accounts to keep in memory. Default is 64.')
+  parser.add_option('-v', '--verbose', action='store_true', dest='verbose', help='Log every request to stderr.')
+
+  (options, args) = parser.parse_args()
+
+  if args:
+    parser.error('twittovd.py takes no arguments.')
+
+  if options.max_models <= 0:
+    parser.error('Max models must be a positive integer.')
+
+  serve(ModelServer(options.cache, options.max_models), options.host,
+      options.port, options.socket, options.verbose)
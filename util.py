@@ -5,7 +5,8 @@
 # URL: <http://www.nltk.org/>
 # For license information, see LICENSE.TXT
 
-from itertools import chain
+from array import array
+from itertools import chain, islice, tee
 
 def ingrams(sequence, n, pad_left=False, pad_right=False, pad_symbol=None):
     """
@@ -36,20 +37,98 @@ def ingrams(sequence, n, pad_left=False, pad_right=False, pad_symbol=None):
     @rtype: C{iterator} of C{tuple}s
     """
 
-    sequence = iter(sequence)
-    if pad_left:
-        sequence = chain((pad_symbol,) * (n-1), sequence)
-    if pad_right:
-        sequence = chain(sequence, (pad_symbol,) * (n-1))
-
-    history = []
-    while n > 1:
-        history.append(sequence.next())
-        n -= 1
-    for item in sequence:
-        history.append(item)
-        yield tuple(history)
-        del history[0]
+    if pad_left or pad_right:
+        sequence = pad_sequence(sequence, n, pad_left, pad_right, pad_symbol)
+
+    # Anything we can slice gets zipped against shifted copies of itself,
+    # which builds every tuple in C.
+    if isinstance(sequence, (list, tuple, str)):
+        return zip(*[sequence[i:] for i in range(n)])
+
+    return _window(iter(sequence), n)
+
+def _window(sequence, n):
+    """
+    Slide a window of n items along an iterator, one tuple per position:
+    n copies of the iterator, each advanced one further than the last,
+    zipped together. A sequence shorter than n yields nothing.
+    """
+
+    iterators = tee(sequence, n)
+    for i, iterator in enumerate(iterators):
+        next(islice(iterator, i, i), None)
+    return zip(*iterators)
+
+def pad_sequence(sequence, n, pad_left=False, pad_right=False, pad_symbol=None):
+    """
+    Pad a sequence with n-1 pad symbols on either side, so that every item
+    starts and ends an ngram.
+
+    >>> list(pad_sequence([1,2,3], 3, pad_left=True))
+    [None, None, 1, 2, 3]
+
+    @param sequence: the source data to be padded
+    @type sequence: C{sequence} or C{iterator}
+    @param n: the degree of the ngrams
+    @type n: C{int}
+    @return: The padded sequence; a list or tuple stays one
+    @rtype: C{list}, C{tuple} or C{iterator}
+    """
+
+    left = (pad_symbol,) * (n-1) if pad_left else ()
+    right = (pad_symbol,) * (n-1) if pad_right else ()
+    if isinstance(sequence, list):
+        return list(left) + sequence + list(right)
+    if isinstance(sequence, tuple):
+        return left + sequence + right
+    return chain(left, sequence, right)
+
+def ngram_ids(sequences, n, ids=None, **kwargs):
+    """
+    Extract the ngrams of a whole corpus at once, as integer ids.
+
+    Every distinct item is interned to an id, in the order first seen, and
+    each ngram is stored as n ids back to back in one flat array, so a
+    corpus of millions of ngrams costs 4 bytes an id rather than a tuple
+    each. Ngrams never span two sequences.
+
+    >>> grams, ids = ngram_ids([['a','b','c'], ['b','c','d']], 2)
+    >>> list(grams)
+    [0, 1, 1, 2, 1, 2, 2, 3]
+    >>> ids
+    {'a': 0, 'b': 1, 'c': 2, 'd': 3}
+
+    @param sequences: the source sequences
+    @type sequences: C{iterator} of C{sequence}s
+    @param n: the degree of the ngrams
+    @type n: C{int}
+    @param ids: if given, ids to extend rather than a new dict
+    @type ids: C{dict}
+    @param kwargs: pad_left, pad_right and pad_symbol, as for ingrams
+    @return: The flat ngram array and the item ids
+    @rtype: C{tuple} of C{array} and C{dict}
+    """
+
+    if ids is None:
+        ids = {}
+    grams = array('I')
+
+    for sequence in sequences:
+        if kwargs.get('pad_left') or kwargs.get('pad_right'):
+            sequence = pad_sequence(sequence, n, **kwargs)
+        row = array('I', [ids.setdefault(item, len(ids)) for item in sequence])
+        count = len(row) - n + 1
+        if count <= 0:
+            continue
+
+        # Interleave n shifted copies of the row: column k of the ngrams is
+        # the row starting at k.
+        block = array('I', bytes(count * n * row.itemsize))
+        for k in range(n):
+            block[k::n] = row[k:k+count]
+        grams.extend(block)
+
+    return grams, ids
         
 def ibigrams(sequence, **kwargs):
     """
@@ -68,8 +147,7 @@ def ibigrams(sequence, **kwargs):
     @rtype: C{iterator} of C{tuple}s
     """
 
-    for item in ingrams(sequence, 2, **kwargs):
-        yield item
+    return ingrams(sequence, 2, **kwargs)
         
 def itrigrams(sequence, **kwargs):
     """
@@ -77,7 +155,7 @@ def itrigrams(sequence, **kwargs):
     
     For example:
     
-    >>> list(itrigrams([1,2,3,4,5])
+    >>> list(itrigrams([1,2,3,4,5]))
     [(1, 2, 3), (2, 3, 4), (3, 4, 5)]
     
     Use trigrams for a list version of this function.
@@ -88,5 +166,4 @@ def itrigrams(sequence, **kwargs):
     @rtype: C{iterator} of C{tuple}s
     """
 
-    for item in ingrams(sequence, 3, **kwargs):
-        yield item
+    return ingrams(sequence, 3, **kwargs)